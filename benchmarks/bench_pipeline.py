@@ -0,0 +1,327 @@
+"""
+Benchmarks for the scrape -> preprocess -> upload pipeline.  No network needed.
+
+    python benchmarks/bench_pipeline.py --scale 1 10 100
+
+Field pages are taken from the scrape cache (cache/) when it has them,
+otherwise synthetic pages are generated from the tables in output/.  Every
+data set can be scaled synthetically: each copy of a country gets a suffixed
+name and link and trades with the copies of its partners, so countries, edges
+and goods rows all grow with the scale.
+
+Timed:
+    parse <table>   the scrape_cia parsers on the field page html
+    preprocess      preprocess_upload_neo4j.preprocess on the tables
+    upload          neo4j_upload.upload_all into a recording Cypher sink, or a
+                    real bolt server when --bolt-url is given (credentials from
+                    neo4j_config, the environment or factbook.ini)
+    local_rank      local_rank.rank_countries
+
+Results are appended to benchmarks/results/results.jsonl with the git commit
+and compared with the previous run of the same scale.
+"""
+import argparse
+import datetime
+import html
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+from pathlib2 import Path
+
+# the pipeline scripts live in the repository root
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import fetch_cia
+import local_rank
+import neo4j_config
+import neo4j_upload
+import preprocess_upload_neo4j
+import scrape_cia
+
+F_RESULTS = Path(ROOT, "benchmarks", "results", "results.jsonl")
+
+# table -> (field page url, parser, parser arguments)
+FIELDS = {"exports": ("https://www.cia.gov/the-world-factbook/field/exports",
+                      scrape_cia.import_export_get, {}),
+          "exports_goods": ("https://www.cia.gov/the-world-factbook/field/exports-commodities/",
+                            scrape_cia.trade_goods, {"trade_type": "exports"}),
+          "exports_partners": ("https://www.cia.gov/the-world-factbook/field/exports-partners/",
+                               scrape_cia.partners, {"trade_type": "exports"}),
+          "population": ("https://www.cia.gov/the-world-factbook/field/population",
+                         scrape_cia.population, {}),
+          "country_region": ("https://www.cia.gov/the-world-factbook/field/map-references",
+                             scrape_cia.region, {})
+          }
+
+
+# ==============================================================================
+# Synthetic data
+def scale_tables(di_raw, scale):
+    """
+    Returns the tables with every country repeated scale times.  Copy i of a
+    country is called "<country> <i>" and only trades with copy i of its
+    partners.
+    """
+    if scale == 1:
+        return {name: df.copy() for name, df in di_raw.items()}
+
+    di_scaled = {}
+    for name, df in di_raw.items():
+        if "country" not in df.columns:
+            di_scaled[name] = df.copy()
+            continue
+        copies = [df]
+        for i in range(1, scale):
+            df_i = df.copy()
+            for col in ["country", "trade_country"]:
+                if col in df_i.columns:
+                    df_i[col] = df_i[col] + " " + str(i)
+            if "link" in df_i.columns:
+                df_i["link"] = df_i["link"] + "-" + str(i)
+            copies.append(df_i)
+        di_scaled[name] = pd.concat(copies, ignore_index=True)
+    return di_scaled
+
+
+def _money(amount):
+    for unit, size in [("trillion", 10**12), ("billion", 10**9), ("million", 10**6)]:
+        if amount >= size:
+            return "${} {}".format(round(amount / size, 3), unit)
+    return "${:,.0f}".format(amount)
+
+
+def _page(blocks):
+    # blocks are (link, country, inner html)
+    divs = ['<div class="pb30"><h3><a href="{}">{}</a></h3><p>{}</p></div>'.format(
+            link, html.escape(country), text) for link, country, text in blocks]
+    return ("<html><head><meta charset=\"utf-8\"></head><body>"
+            + "".join(divs) + "</body></html>").encode("utf-8")
+
+
+def _year(year, suffix=" est."):
+    return "" if pd.isnull(year) else " ({}{})".format(int(year), suffix)
+
+
+def synthetic_pages(di_raw):
+    """
+    Builds field page html that the scrape_cia parsers read back into the
+    given tables.
+    """
+    di_pages = {}
+
+    blocks = []
+    for (link, country), df in di_raw["exports"].groupby(["link", "country"], sort=False):
+        parts = [_money(a) + _year(y) for a, y in zip(df["amount"], df["year"])
+                 if pd.notnull(a) & pd.notnull(y)]
+        blocks.append((link, country, "<br><br>".join(parts)))
+    di_pages["exports"] = _page(blocks)
+
+    blocks = []
+    for (link, country), df in di_raw["exports_goods"].groupby(["link", "country"], sort=False):
+        goods = ", ".join(html.escape(str(g)) for g in df["goods"])
+        blocks.append((link, country, goods + _year(df["year"].iloc[0], "")))
+    di_pages["exports_goods"] = _page(blocks)
+
+    blocks = []
+    df_part = di_raw["exports_partners"]
+    for (link, country), df in df_part.groupby(["link", "country"], sort=False):
+        items = ["{} {}%".format(html.escape(str(t)), round(p * 100)) if pd.notnull(p)
+                 else html.escape(str(t))
+                 for t, p in zip(df["trade_country"], df["percentage"])]
+        blocks.append((link, country, ", ".join(items) + _year(df["year"].iloc[0], "")))
+    di_pages["exports_partners"] = _page(blocks)
+
+    di_link = dict(zip(di_raw["country_region"]["country"], di_raw["country_region"]["link"]))
+    blocks = []
+    for country, pop, year in zip(di_raw["population"]["country"],
+                                  di_raw["population"]["population"],
+                                  di_raw["population"]["year"]):
+        text = "uninhabited" if pd.isnull(pop) else "{:,}".format(int(pop))
+        blocks.append((di_link.get(country, "/the-world-factbook/countries/x"),
+                       country, text + _year(year)))
+    di_pages["population"] = _page(blocks)
+
+    blocks = []
+    for (link, country), df in di_raw["country_region"].groupby(["link", "country"], sort=False):
+        if country == "France":
+            text = "<br>".join(r + ";" for r in df["regions"])
+        else:
+            text = df["regions"].iloc[0]
+        blocks.append((link, country, text))
+    di_pages["country_region"] = _page(blocks)
+    return di_pages
+
+
+def cached_pages():
+    # field pages from the scrape cache, if every one of them is there
+    if not Path(ROOT, "cache", "index.json").exists():
+        return None
+    cache = fetch_cia.ResponseCache(Path(ROOT, "cache"), offline=True)
+    di_pages = {name: cache.get(url) for name, (url, _, _) in FIELDS.items()}
+    if any(content is None for content in di_pages.values()):
+        return None
+    return di_pages
+
+
+# ==============================================================================
+# Cypher sink
+class RecordingGraph:
+    """
+    Stands in for a py2neo Graph.  Statements are recorded and their
+    parameters serialized, roughly the client side work of a real upload.
+    """
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def begin(self, readonly=False):
+        return self
+
+    def commit(self, tx):
+        pass
+
+    def run(self, cql, parameters=None, **kwparameters):
+        self.statements += 1
+        rows = kwparameters.get("rows", [])
+        self.rows += len(rows)
+        self.bytes += len(json.dumps(kwparameters, default=str))
+
+
+# ==============================================================================
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "repeat": repeat}
+
+
+def run_benchmarks(di_raw, di_pages, scale, repeat, graph_factory):
+    di_scaled = scale_tables(di_raw, scale)
+    if (scale != 1) | (di_pages is None):
+        di_pages = synthetic_pages(di_scaled)
+
+    results = {}
+    # the parsers write to ./output, keep that away from the real output
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.mkdir("output")
+        try:
+            for name, (_, parser, kwargs) in FIELDS.items():
+                results["parse " + name] = timeit(
+                    lambda: parser(di_pages[name], f_name=name + ".csv",
+                                   skip_links=scrape_cia.SKIP_LINKS, country_fixes={},
+                                   **kwargs),
+                    repeat)
+        finally:
+            os.chdir(cwd)
+
+    # preprocess changes some frames in place so every run gets its own copy
+    results["preprocess"] = timeit(
+        lambda: preprocess_upload_neo4j.preprocess(
+            {name: df.copy() for name, df in di_scaled.items()}),
+        repeat)
+
+    di_tables = preprocess_upload_neo4j.preprocess(di_scaled)
+    results["upload"] = timeit(
+        lambda: neo4j_upload.upload_all(graph_factory(), **di_tables), repeat)
+    results["local_rank"] = timeit(
+        lambda: local_rank.rank_countries(di_tables["df_country"],
+                                          di_tables["df_trade"]),
+        repeat)
+
+    sizes = {"countries": len(di_tables["df_country"]),
+             "trades": len(di_tables["df_trade"]),
+             "goods_edges": len(di_tables["df_exp_good"]) + len(di_tables["df_imp_good"])}
+    return results, sizes
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                             cwd=str(ROOT), capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def previous_result(scale):
+    if not F_RESULTS.exists():
+        return None
+    previous = None
+    with open(F_RESULTS, "r") as f:
+        for line in f:
+            di = json.loads(line)
+            if di["scale"] == scale:
+                previous = di
+    return previous
+
+
+def print_results(di_run, previous):
+    print("scale {} ({} countries, {} trades, {} goods edges)".format(
+        di_run["scale"], *di_run["sizes"].values()))
+    print("{:<26}{:>12}{:>12}{:>10}".format("benchmark", "min (s)", "median (s)", "change"))
+    for name, di in di_run["benchmarks"].items():
+        change = ""
+        if previous is not None and name in previous["benchmarks"]:
+            before = previous["benchmarks"][name]["median"]
+            change = "{:+.0%}".format(di["median"] / before - 1) if before > 0 else ""
+        print("{:<26}{:>12.4f}{:>12.4f}{:>10}".format(name, di["min"], di["median"], change))
+    if previous is not None:
+        print("change is against commit {} ({})".format(previous["commit"], previous["timestamp"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scale", type=int, nargs="+", default=[1],
+                        help="how many times every country is repeated")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--bolt-url", default=None,
+                        help="upload to this Neo4j instead of the recording sink")
+    parser.add_argument("--no-save", action="store_true",
+                        help="don't append the results to the results file")
+    args = parser.parse_args()
+
+    if args.bolt_url is None:
+        graph_factory = RecordingGraph
+    else:
+        import py2neo
+        try:
+            _, username, password = neo4j_config.credentials(prompt=False)
+        except neo4j_config.MissingCredentials as e:
+            parser.error(str(e))
+        auth = (username, password)
+        graph_factory = lambda: py2neo.Graph(args.bolt_url, auth=auth)
+
+    di_raw = preprocess_upload_neo4j.read_tables(folder=str(Path(ROOT, "output")))
+    di_pages = cached_pages()
+    print("field pages from {}".format("the cache" if di_pages else "synthetic html"))
+
+    for scale in args.scale:
+        results, sizes = run_benchmarks(di_raw, di_pages, scale, args.repeat, graph_factory)
+        di_run = {"commit": git_commit(),
+                  "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                  "scale": scale,
+                  "sink": "recording" if args.bolt_url is None else "bolt",
+                  "sizes": sizes,
+                  "benchmarks": results}
+        print_results(di_run, previous_result(scale))
+        if not args.no_save:
+            F_RESULTS.parent.mkdir(parents=True, exist_ok=True)
+            with open(F_RESULTS, "a") as f:
+                f.write(json.dumps(di_run) + "\n")
+
+
+if __name__=="__main__":
+    main()
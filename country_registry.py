@@ -0,0 +1,157 @@
+"""
+Registry of the countries of the Factbook, shared by scrape_cia and
+preprocess_upload_neo4j.
+
+Every country is keyed by the slug of its Factbook link
+(/the-world-factbook/countries/korea-south -> korea-south) and gets an integer
+id that stays the same between runs, the registry is saved in
+output/country_registry.csv.  Names used by other pages are resolved through
+an alias index of normalized names:
+
+    - case, accents and punctuation are ignored
+    - "Korea, South" is also known as "South Korea"
+    - "Turkey (Turkiye)" is also known as "Turkey"
+    - abbreviations and typos from ALIASES ("UK", "Untied States")
+
+so partner names like "Democratic Republic of the Congo" match the country
+"Congo, Democratic Republic of the" instead of silently missing.
+"""
+import re
+import unicodedata
+
+import pandas as pd
+from pathlib2 import Path
+
+
+# names that normalization alone can't match to the Factbook name
+ALIASES = {"Korea, South": "South Korea",
+           "Korea, North": "North Korea",
+           "US": "United States",
+           "Untied States": "United States", # my personal favorite
+           "UK": "United Kingdom",
+           "UAE": "United Arab Emirates",
+           "NZ": "New Zealand"
+           }
+
+F_REGISTRY = Path("output", "country_registry.csv")
+
+
+def slug(link):
+    return str(link).strip("/").rsplit("/", 1)[-1]
+
+
+def normalize(name):
+    # lower case ascii letters and digits separated by single spaces
+    name = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode()
+    name = re.sub(r"[^a-z0-9]+", " ", name.lower()).strip()
+    return re.sub(r"^the ", "", name)
+
+
+def name_keys(name):
+    """
+    The normalized forms a country name is known by: the name itself, the
+    name without a parenthesis and "Korea, South" turned around.
+    """
+    names = {name, re.sub(r"\s*\(.*?\)", "", name)}
+    for n in list(names):
+        if n.count(",") == 1:
+            first, last = n.split(",")
+            names.add(last.strip() + " " + first.strip())
+    return {normalize(n) for n in names}
+
+
+class CountryRegistry:
+    def __init__(self):
+        self.slugs = []
+        self.names = []
+        self._by_slug = {}
+        self._by_key = {}
+
+    def __len__(self):
+        return len(self.slugs)
+
+    def add(self, link, name):
+        """Registers a country page, returns its id.  Known slugs keep their id."""
+        s = slug(link)
+        if s in self._by_slug:
+            country_id = self._by_slug[s]
+        else:
+            country_id = len(self.slugs)
+            self.slugs.append(s)
+            self.names.append(name)
+            self._by_slug[s] = country_id
+        # the first country to claim a key keeps it
+        for key in name_keys(name):
+            self._by_key.setdefault(key, country_id)
+        return country_id
+
+    def update(self, df):
+        # takes a table with link and country columns, e.g. country_region
+        for link, name in df[["link", "country"]].drop_duplicates().itertuples(index=False):
+            self.add(link, name)
+        self.add_aliases()
+        return self
+
+    def add_aliases(self, aliases=ALIASES):
+        for alias, name in aliases.items():
+            country_id = self.lookup(name)
+            if country_id is not None:
+                self._by_key.setdefault(normalize(alias), country_id)
+
+    def lookup(self, name):
+        if pd.isnull(name):
+            return None
+        return self._by_key.get(normalize(name))
+
+    def resolve(self, names):
+        """Country ids for a column of names, missing where unknown."""
+        di = {name: self.lookup(name) for name in pd.unique(names.dropna())}
+        return names.map(di).astype("Int64")
+
+    def resolve_links(self, links):
+        return links.map(lambda link: self._by_slug.get(slug(link))).astype("Int64")
+
+    def link_name(self, link):
+        # the Factbook name of a country page, None when it is not registered
+        country_id = self._by_slug.get(slug(link))
+        return None if country_id is None else self.names[country_id]
+
+    def canonical(self, names):
+        """Replaces every known name by the Factbook name, unknown names stay."""
+        di = {}
+        for name in pd.unique(names.dropna()):
+            country_id = self.lookup(name)
+            di[name] = name if country_id is None else self.names[country_id]
+        return names.map(di)
+
+    def categorical(self, names):
+        """
+        The names as a categorical in id order (the codes are the ids), unknown
+        names are added after the registered countries.
+        """
+        unknown = sorted(set(names.dropna()) - set(self.names))
+        return pd.Categorical(names, categories=self.names + unknown)
+
+    def save(self, f_registry=F_REGISTRY):
+        pd.DataFrame({"country_id": range(len(self.slugs)),
+                      "slug": self.slugs,
+                      "country": self.names}).to_csv(f_registry, index=False)
+
+
+def read_registry(f_registry=F_REGISTRY):
+    # the saved registry, or an empty one the first time
+    registry = CountryRegistry()
+    if Path(f_registry).exists():
+        df = pd.read_csv(f_registry, dtype=str).sort_values("country_id", key=lambda s: s.astype(int))
+        for s, name in zip(df["slug"], df["country"]):
+            registry.add(s, name)
+        registry.add_aliases()
+    return registry
+
+
+def fix_names(names, country_fixes):
+    # applies a {wrong name: right name} dict to a column of names
+    mask = names.isin(list(country_fixes.keys()))
+    names = names.copy()
+    names.loc[mask] = names.loc[mask].map(country_fixes)
+    return names
@@ -0,0 +1,314 @@
+"""
+Crawls the country pages of the Factbook to fill the gaps of the field pages.
+
+scrape_cia.py reads the field pages (one field for every country).  Some
+countries are missing from them or their block can't be parsed, every field
+of a country is also on its own page
+(https://www.cia.gov/the-world-factbook/countries/<slug>/).  The frontier is
+every country link scrape_cia found (the registry and the link columns of its
+tables).
+
+    - requests go through a token bucket, rate per second with bursts of
+      burst, over a few threads
+    - the frontier is kept in crawl/frontier.json with the state of every
+      url (pending, done or failed, attempts, last error, when to try again)
+      and saved after every page, an interrupted crawl resumes where it
+      stopped
+    - a fetched page is parsed right away into the field blocks the
+      scrape_cia parsers read, kept in crawl/records/<slug>.json, and the
+      page itself is dropped
+
+At the end the scrape_cia parsers run on the records and the rows of the
+crawled countries replace theirs in the output tables.
+"""
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lxml.html
+import pandas as pd
+from pathlib2 import Path
+
+import country_registry
+import fetch_cia
+import pipeline_metrics
+import scrape_cia
+import table_store
+
+
+URL_SITE = "https://www.cia.gov"
+
+F_CRAWL = Path("crawl")
+
+# every field h3 on a country page links to its field page
+FIELD_XPATH = "//h3[a[contains(@href, '/the-world-factbook/field/')]]"
+
+
+class TokenBucket:
+    """
+    Allows rate calls per second on average and up to burst at once.
+    acquire() blocks until a token is free.
+    """
+
+    def __init__(self, rate=4.0, burst=8):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class Frontier:
+    """
+    The urls of the crawl and their state, kept in f_frontier:
+
+        {url: {"status": "pending" | "done" | "failed",
+               "attempts": tries so far,
+               "error": last error,
+               "next_try": time before which it is not tried again}}
+
+    A url is failed after max_attempts tries, the wait before the next try
+    doubles with every attempt.
+    """
+
+    def __init__(self, f_frontier=Path(F_CRAWL, "frontier.json"), max_attempts=4, backoff=5.0):
+        self.f_frontier = Path(f_frontier)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        if self.f_frontier.exists():
+            with open(self.f_frontier, "r") as f:
+                self.state = json.load(f)
+        else:
+            self.state = {}
+
+    def add(self, urls):
+        with self._lock:
+            for url in urls:
+                self.state.setdefault(url, {"status": "pending", "attempts": 0,
+                                            "error": None, "next_try": 0})
+            self._save()
+
+    def ready(self):
+        # pending urls that may be tried now
+        now = time.time()
+        return [url for url, di in self.state.items()
+                if (di["status"] == "pending") and (di["next_try"] <= now)]
+
+    def waiting(self):
+        # seconds until the next pending url may be tried, None when none are left
+        times = [di["next_try"] for di in self.state.values() if di["status"] == "pending"]
+        return None if len(times) == 0 else max(0.0, min(times) - time.time())
+
+    def done(self, url):
+        with self._lock:
+            self.state[url].update(status="done", error=None)
+            self._save()
+
+    def failed(self, url, error):
+        with self._lock:
+            di = self.state[url]
+            di["attempts"] += 1
+            di["error"] = str(error)
+            if di["attempts"] >= self.max_attempts:
+                di["status"] = "failed"
+            else:
+                di["next_try"] = time.time() + self.backoff * 2 ** (di["attempts"] - 1) * random.uniform(0.5, 1.5)
+            self._save()
+
+    def retry_failed(self):
+        # gives the failed urls of an earlier crawl a new set of attempts
+        with self._lock:
+            for di in self.state.values():
+                if di["status"] == "failed":
+                    di.update(status="pending", attempts=0, next_try=0)
+            self._save()
+
+    def counts(self):
+        return pd.Series([di["status"] for di in self.state.values()]).value_counts().to_dict()
+
+    def _save(self):
+        # write then rename so an interrupted crawl can't corrupt the frontier
+        self.f_frontier.parent.mkdir(parents=True, exist_ok=True)
+        f_tmp = Path(str(self.f_frontier) + ".tmp")
+        with open(f_tmp, "w") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(f_tmp, self.f_frontier)
+
+
+def field_slug(url):
+    return url.rstrip("/").rsplit("/", 1)[-1]
+
+
+def country_page_records(content, link, country=None):
+    """
+    {field slug: FieldRecord} of a country page, in the form of the blocks of
+    a field page: the first line is the country name, then the field text.
+    Without a country name the heading of the page is used.
+    """
+    tree = lxml.html.document_fromstring(content, parser=scrape_cia.HTML_PARSER)
+    if country is None:
+        h1 = tree.xpath("//h1")
+        country = h1[0].text_content().strip() if len(h1) > 0 else field_slug(link)
+
+    di_records = {}
+    for h3 in tree.xpath(FIELD_XPATH):
+        slug = field_slug(h3.xpath("a")[0].get("href"))
+        # the field text runs until the next heading
+        text = []
+        for sibling in h3.itersiblings():
+            if sibling.tag in ("h2", "h3"):
+                break
+            text += [t.strip() for t in sibling.xpath(scrape_cia.TEXT_XPATH)]
+        lines = "\n".join([t for t in text if t != ""]).splitlines()
+        if len(lines) > 0:
+            di_records[slug] = scrape_cia.FieldRecord(link, country, [country] + lines)
+    return di_records
+
+
+def seed_urls(folder="output"):
+    # every country link scrape_cia has seen
+    links = set("/the-world-factbook/countries/" + s for s in country_registry.read_registry().slugs)
+    for name in ["country_region", "exports", "imports", "gdp"]:
+        if Path(folder, name + ".csv").exists():
+            links.update(table_store.read_table(name, folder=folder)["link"].dropna())
+    links = sorted(link.rstrip("/") for link in links)
+    return [URL_SITE + link + "/" for link in links if link not in scrape_cia.SKIP_LINKS
+            and link + "/" not in scrape_cia.SKIP_LINKS]
+
+
+def crawl(frontier, f_records=Path(F_CRAWL, "records"), rate=4.0, burst=8, max_workers=8,
+          timeout=30, cache=None, metrics=None):
+    """
+    Fetches every pending url of the frontier and stores its records in
+    f_records.  Returns when every url is done or failed.
+    """
+    Path(f_records).mkdir(parents=True, exist_ok=True)
+    bucket = TokenBucket(rate=rate, burst=burst)
+    # the names of the field pages, so the rows replace the right ones
+    registry = country_registry.read_registry()
+    # the frontier keeps the retry state, the session doesn't retry itself
+    session = fetch_cia.make_session(pool_size=max_workers, retries=0)
+
+    def fetch(url):
+        content = None if cache is None else cache.get(url)
+        try:
+            if content is None:
+                bucket.acquire()
+                r = session.get(url, timeout=timeout)
+                r.raise_for_status()
+                if cache is not None:
+                    cache.put(url, r)
+                content = r.content
+            link = url[len(URL_SITE):].rstrip("/")
+            di_records = country_page_records(content, link, country=registry.link_name(link))
+        except Exception as e:
+            # a page that can't be fetched or parsed is retried later instead
+            # of stopping the crawl and staying pending
+            print("Failed to crawl {}: {}".format(url, e))
+            frontier.failed(url, e)
+            return
+        with open(Path(f_records, field_slug(url) + ".json"), "w") as f:
+            json.dump({slug: rec._asdict() for slug, rec in di_records.items()}, f)
+        frontier.done(url)
+        if metrics is not None:
+            metrics.count(rows=1, bytes=len(content))
+
+    with session, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while True:
+            urls = frontier.ready()
+            if len(urls) > 0:
+                list(pool.map(fetch, urls))
+                continue
+            wait = frontier.waiting()
+            if wait is None:
+                return
+            time.sleep(wait)
+
+
+def read_records(f_records=Path(F_CRAWL, "records")):
+    """{field slug: [FieldRecord]} of every crawled page."""
+    di_records = {}
+    for f_page in sorted(Path(f_records).glob("*.json")):
+        with open(f_page, "r") as f:
+            for slug, di in json.load(f).items():
+                di_records.setdefault(slug, []).append(scrape_cia.FieldRecord(**di))
+    return di_records
+
+
+def write_tables(di_records, folder="output", f_staging=Path(F_CRAWL, "tables")):
+    """
+    Runs the scrape_cia parsers on the records and replaces the rows of the
+    crawled countries in the output tables.  Returns {table: crawled rows}.
+    """
+    Path(f_staging).mkdir(parents=True, exist_ok=True)
+    di_rows = {}
+    for label, url, parser, kwargs in scrape_cia.JOBS:
+        records = di_records.get(field_slug(url), [])
+        if len(records) == 0:
+            print("No {} on the country pages".format(label))
+            continue
+        name = Path(kwargs["f_name"]).stem
+        df_new = parser(records, skip_links=scrape_cia.SKIP_LINKS,
+                        country_fixes=scrape_cia.COUNTRY_FIXES, folder=f_staging, **kwargs)
+
+        # the crawled rows, not the whole table
+        di_rows[name] = len(df_new)
+
+        # population has no link column
+        key = "link" if "link" in df_new.columns else "country"
+        if Path(folder, name + ".csv").exists():
+            df_old = table_store.read_table(name, folder=folder)
+            df_old = df_old.loc[~df_old[key].isin(df_new[key])]
+            df_new = pd.concat([df_old, df_new], ignore_index=True, sort=False)
+        table_store.write_table(df_new, name, folder=folder)
+    return di_rows
+
+
+def main():
+    # requests per second and the most at once
+    rate = 4.0
+    burst = 8
+    max_workers = 8
+    # give the urls that failed in an earlier crawl another chance
+    retry_failed = False
+    # country pages are cached like the field pages
+    cache = fetch_cia.ResponseCache(Path("cache"), ttl=24 * 60 * 60, offline=False)
+
+    f_run_report = Path("output", "run_report_crawl.json")
+    metrics = pipeline_metrics.RunMetrics("crawl", profile_stage=None)
+
+    metrics.start("crawl")
+    frontier = Frontier()
+    frontier.add(seed_urls())
+    if retry_failed:
+        frontier.retry_failed()
+    crawl(frontier, rate=rate, burst=burst, max_workers=max_workers, cache=cache,
+          metrics=metrics)
+    print("Country pages: {}".format(frontier.counts()))
+
+    metrics.start("write")
+    di_rows = write_tables(read_records())
+    metrics.count(rows=sum(di_rows.values()))
+
+    metrics.print_report()
+    metrics.write_report(f_run_report)
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Command line entry point for every stage of the pipeline.
+
+    python factbook.py scrape [--offline] [--crawl]
+    python factbook.py preprocess [--parallel] [--reconcile]
+    python factbook.py upload [--sync | --load-csv DIR] [--workers N]
+    python factbook.py rank [--engine local] [--algorithms pageRank articleRank louvain]
+    python factbook.py export
+
+The Neo4j credentials come from the environment or factbook.ini (see
+neo4j_config.py), nothing is asked for so it can run from cron.  Modules are
+only imported by the command that needs them: rank and export never load the
+scraper, preprocess and a local rank never load py2neo.
+"""
+import argparse
+import sys
+
+# only the standard library and pathlib2
+import neo4j_config
+
+
+def scrape(args):
+    import scrape_cia
+    scrape_cia.main(offline=args.offline)
+    if args.crawl:
+        import crawl_cia
+        crawl_cia.main()
+
+
+def pipeline(args):
+    # preprocess, upload, rank and export all go through the same run
+    import pipeline_metrics
+    import preprocess_upload_neo4j
+
+    options = {"folder": args.folder,
+               "parallel_preprocess": args.parallel,
+               "max_workers": args.max_workers,
+               "reconcile_trades": args.reconcile,
+               "mirror_weight": args.mirror_weight}
+    if args.command == "upload":
+        options.update(erase_existing_neo4j=not args.keep_existing,
+                       incremental_sync=args.sync,
+                       load_csv_import_dir=args.load_csv,
+                       stream_trades=args.stream or args.stream_pages,
+                       stream_source="pages" if args.stream_pages else "tables",
+                       batch_size=args.batch_size,
+                       upload_workers=args.workers)
+    if args.command == "rank":
+        options.update(rank_engine=args.engine, gds_algorithms=args.algorithms)
+
+    if (args.command == "upload") or ((args.command == "rank") and (args.engine != "local")):
+        url, username, password = neo4j_config.credentials(prompt=False, f_config=args.config)
+        options.update(url=url, username=username, password=password)
+
+    metrics = pipeline_metrics.RunMetrics(args.command, profile_stage=args.profile)
+    preprocess_upload_neo4j.run([args.command], metrics=metrics, **options)
+    metrics.print_report()
+    if args.run_report is not None:
+        metrics.write_report(args.run_report)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("scrape", help="download and parse the Factbook field pages")
+    p.add_argument("--offline", action="store_true", help="only use the page cache")
+    p.add_argument("--crawl", action="store_true",
+                   help="afterwards fill gaps from the country pages (crawl_cia.py)")
+    p.set_defaults(func=scrape)
+
+    for name, help in [("preprocess", "clean and combine the scraped tables"),
+                       ("upload", "upload the nodes and edges to Neo4j"),
+                       ("rank", "compute pageRank and articleRank"),
+                       ("export", "write trade_partners.csv and the analytics tables")]:
+        p = commands.add_parser(name, help=help)
+        p.add_argument("--folder", default="output", help="folder of the tables")
+        p.add_argument("--config", default=None, help="config file, default factbook.ini")
+        p.add_argument("--parallel", action="store_true",
+                       help="run the preprocessing stages in a process pool")
+        p.add_argument("--max-workers", type=int, default=None,
+                       help="processes of --parallel, default one per cpu")
+        p.add_argument("--reconcile", action="store_true",
+                       help="balance both reports of a trade with the country totals")
+        p.add_argument("--mirror-weight", type=float, default=0.5,
+                       help="share of the exporter's report with --reconcile")
+        p.add_argument("--profile", default=None, help="stage to write a cProfile dump of")
+        p.add_argument("--run-report", default=None, help="write the stage timings to this file")
+        p.set_defaults(func=pipeline)
+
+        if name == "upload":
+            mode = p.add_mutually_exclusive_group()
+            mode.add_argument("--sync", action="store_true",
+                              help="only send what changed since the last upload")
+            mode.add_argument("--load-csv", default=None, metavar="DIR",
+                              help="cold load with LOAD CSV from the Neo4j import folder DIR")
+            p.add_argument("--keep-existing", action="store_true",
+                           help="don't erase the graph first")
+            p.add_argument("--stream", action="store_true",
+                           help="build the trades edges in chunks")
+            p.add_argument("--stream-pages", action="store_true",
+                           help="--stream straight from the field pages of the last scrape")
+            p.add_argument("--batch-size", type=int, default=1000)
+            p.add_argument("--workers", type=int, default=None,
+                           help="upload over this many Bolt sessions")
+        if name == "rank":
+            p.add_argument("--engine", choices=["gds", "local"], default="gds")
+            p.add_argument("--algorithms", nargs="+", default=["pageRank", "articleRank"],
+                           help="GDS algorithms, names of gds_ranking.ALGORITHMS")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, "reconcile", False) and (getattr(args, "stream", False)
+                                              or getattr(args, "stream_pages", False)):
+        parser.error("--reconcile needs the whole partner tables, it can't be used with --stream")
+    try:
+        args.func(args)
+    except neo4j_config.MissingCredentials as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+"""
+Fetch layer for the CIA Factbook pages.
+
+All of the field pages are downloaded concurrently through one pooled
+requests.Session (keep-alive, retries with backoff) with a limit on the number
+of requests in flight per host.  A page that fails is reported and returned as
+None so a single timeout no longer kills the whole scrape.
+
+Responses can be kept in an on-disk ResponseCache.  Bodies are stored by their
+sha256 so identical pages are only kept once, stale entries are revalidated
+with ETag / Last-Modified and offline mode serves only what is in the cache.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pathlib2 import Path
+
+
+class ResponseCache:
+    """
+    Content addressed cache of raw responses keyed by url.
+
+    cache_dir/objects/<sha256>  raw response bodies
+    cache_dir/index.json        url -> sha256, validators and timestamps
+
+    Entries younger than ttl seconds are served without touching the network.
+    Older entries are revalidated with a conditional GET.  When the objects
+    take more than max_bytes the least recently used ones are evicted.
+    """
+
+    def __init__(self, cache_dir="cache", ttl=24 * 60 * 60, offline=False,
+                 max_bytes=500 * 2**20):
+        self.cache_dir = Path(cache_dir)
+        self.objects_dir = Path(cache_dir, "objects")
+        self.index_file = Path(cache_dir, "index.json")
+        self.ttl = ttl
+        self.offline = offline
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        if self.index_file.exists():
+            with open(self.index_file, "r") as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    def _read(self, url):
+        # callers hold the lock
+        entry = self.index.get(url)
+        if entry is None:
+            return None
+        f_object = Path(self.objects_dir, entry["sha256"])
+        if not f_object.exists():
+            del self.index[url]
+            return None
+        entry["accessed"] = time.time()
+        return f_object.read_bytes()
+
+    def get(self, url):
+        """
+        Returns the cached body if it is still fresh (or if we are offline),
+        otherwise None.
+        """
+        with self._lock:
+            entry = self.index.get(url)
+            if entry is None:
+                return None
+            if self.offline or time.time() - entry["fetched"] < self.ttl:
+                return self._read(url)
+        return None
+
+    def get_stale(self, url):
+        # used when the site can not be reached, better old data than none
+        with self._lock:
+            return self._read(url)
+
+    def validators(self, url):
+        # headers for a conditional GET, none when the body is no longer cached
+        with self._lock:
+            entry = self.index.get(url)
+            if (entry is None) or not Path(self.objects_dir, entry["sha256"]).exists():
+                return {}
+            headers = {}
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+            return headers
+
+    def revalidated(self, url):
+        # the server answered 304, the cached body is current again
+        with self._lock:
+            content = self._read(url)
+            if content is not None:
+                self.index[url]["fetched"] = time.time()
+                self._save()
+            return content
+
+    def put(self, url, response):
+        content = response.content
+        sha = hashlib.sha256(content).hexdigest()
+        with self._lock:
+            f_object = Path(self.objects_dir, sha)
+            if not f_object.exists():
+                f_object.write_bytes(content)
+            now = time.time()
+            self.index[url] = {"sha256": sha,
+                               "size": len(content),
+                               "etag": response.headers.get("ETag"),
+                               "last_modified": response.headers.get("Last-Modified"),
+                               "fetched": now,
+                               "accessed": now}
+            self._evict()
+            self._save()
+
+    def _evict(self):
+        # objects can be shared by several urls so sizes are counted per object
+        di_size = {e["sha256"]: e["size"] for e in self.index.values()}
+        total = sum(di_size.values())
+        if total <= self.max_bytes:
+            return
+
+        # least recently used first
+        for url, entry in sorted(self.index.items(), key=lambda x: x[1]["accessed"]):
+            if total <= self.max_bytes:
+                break
+            del self.index[url]
+            sha = entry["sha256"]
+            if sha not in {e["sha256"] for e in self.index.values()}:
+                total -= di_size[sha]
+                f_object = Path(self.objects_dir, sha)
+                if f_object.exists():
+                    f_object.unlink()
+
+    def _save(self):
+        # write then rename so an interrupted run can't corrupt the index
+        f_tmp = Path(self.cache_dir, "index.json.tmp")
+        with open(f_tmp, "w") as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(f_tmp, self.index_file)
+
+
+def make_session(pool_size=8, retries=3, backoff=0.5):
+    retry = Retry(total=retries,
+                  backoff_factor=backoff,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=["GET", "HEAD"])
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def fetch_all(urls, max_workers=8, per_host=4, retries=3, backoff=0.5,
+              timeout=30, cache=None):
+    """
+    Downloads every url concurrently and returns {url: content}.  Pages that
+    could not be downloaded after the retries are returned as None.  When a
+    ResponseCache is given it is checked first and filled with the responses.
+    """
+    session = make_session(pool_size=max_workers, retries=retries,
+                           backoff=backoff)
+    # one semaphore per host so we never have more than per_host requests
+    # open against the same server
+    di_host_limits = {urlparse(u).netloc: threading.BoundedSemaphore(per_host)
+                      for u in urls}
+
+    def fetch(url):
+        headers = {}
+        if cache is not None:
+            content = cache.get(url)
+            if (content is not None) | cache.offline:
+                return content
+            headers = cache.validators(url)
+
+        with di_host_limits[urlparse(url).netloc]:
+            try:
+                r = session.get(url, headers=headers, timeout=timeout)
+                if (r.status_code == 304) & (cache is not None):
+                    content = cache.revalidated(url)
+                    if content is not None:
+                        return content
+                    # evicted after the validators were read, fetch it again
+                    r = session.get(url, timeout=timeout)
+                r.raise_for_status()
+            except requests.RequestException as e:
+                print("Failed to download {}: {}".format(url, e))
+                if cache is not None:
+                    return cache.get_stale(url)
+                return None
+
+        if cache is not None:
+            cache.put(url, r)
+        return r.content
+
+    unique_urls = list(dict.fromkeys(urls))
+    with session, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        contents = pool.map(fetch, unique_urls)
+        return dict(zip(unique_urls, contents))
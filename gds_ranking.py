@@ -0,0 +1,114 @@
+"""
+Centralities of the country nodes with the Neo4j GDS plugin.
+
+The trades graph is projected once under a name.  A projection left by an
+earlier run is dropped first, or reused when asked to (its properties from
+the earlier run are dropped instead).  Before anything runs the memory
+estimate of every algorithm is checked against a share of the heap.  Every
+algorithm then runs once in mutate mode, adding its property to the
+projection, and all properties go back to the database in a single
+gds.graph.nodeProperties.write.
+
+More centralities are added to the same pass by name:
+
+    df = rank(graph, algorithms=["pageRank", "articleRank", "betweenness", "louvain"])
+
+or by adding an Algorithm to ALGORITHMS.
+"""
+from collections import namedtuple
+
+import pandas as pd
+
+
+# procedure of gds.<procedure>.mutate, the node property it writes, its
+# configuration and the column of the returned table
+Algorithm = namedtuple("Algorithm", ["procedure", "node_property", "config", "column"])
+
+ALGORITHMS = {
+    "pageRank": Algorithm("pageRank", "pagerank",
+                          {"maxIterations": 20, "dampingFactor": 0.85}, "page_rank"),
+    "articleRank": Algorithm("articleRank", "articlerank", {}, "article_rank"),
+    "betweenness": Algorithm("betweenness", "betweenness", {}, "betweenness"),
+    "eigenvector": Algorithm("eigenvector", "eigenvector", {"maxIterations": 20}, "eigenvector"),
+    "louvain": Algorithm("louvain", "community", {}, "community"),
+}
+
+# ranks of preprocess_upload_neo4j, the columns of article_page_rank_countries
+DEFAULT_ALGORITHMS = ["pageRank", "articleRank"]
+
+CQL_PROJECT = """
+CALL gds.graph.project($name, 'country', 'trades', {relationshipProperties: 'amount'})
+YIELD nodeCount, relationshipCount
+"""
+
+
+def projection_exists(graph, name):
+    return graph.run("CALL gds.graph.exists($name) YIELD exists", name=name).evaluate()
+
+
+def project(graph, name="myGraph", reuse=False, properties=()):
+    """
+    Projects the country nodes and trades edges as name.  An existing
+    projection is dropped, or with reuse kept without the given node
+    properties so they can be mutated again.
+    """
+    if projection_exists(graph, name):
+        if reuse:
+            graph.run("""CALL gds.graph.nodeProperties.drop($name, $properties, {failIfMissing: false})""",
+                      name=name, properties=list(properties))
+            return
+        graph.run("CALL gds.graph.drop($name)", name=name)
+    graph.run(CQL_PROJECT, name=name)
+
+
+def check_memory(graph, name, algorithms, max_heap_percentage=80):
+    """
+    The memory estimate of every algorithm.  Raises a MemoryError when one of
+    them needs more than max_heap_percentage of the heap.
+    """
+    rows = []
+    for algorithm in algorithms:
+        cql = """CALL gds.{}.mutate.estimate($name, $config)
+                 YIELD requiredMemory, bytesMax, heapPercentageMax""".format(algorithm.procedure)
+        config = dict(algorithm.config, mutateProperty=algorithm.node_property)
+        row = graph.run(cql, name=name, config=config).data()
+        if len(row) == 0:
+            continue
+        row = dict(row[0], algorithm=algorithm.procedure)
+        if row["heapPercentageMax"] > max_heap_percentage:
+            raise MemoryError("gds.{} needs up to {} ({}% of the heap, at most {}% allowed)".format(
+                algorithm.procedure, row["requiredMemory"], row["heapPercentageMax"],
+                max_heap_percentage))
+        rows.append(row)
+    return rows
+
+
+def rank(graph, algorithms=DEFAULT_ALGORITHMS, name="myGraph", reuse=False, keep=False,
+         max_heap_percentage=80):
+    """
+    Runs the algorithms (names of ALGORITHMS) on the projection name and
+    writes their properties to the country nodes.  Returns a DataFrame with
+    country and a column per algorithm.  The projection is dropped afterwards
+    unless keep is set.
+    """
+    algorithms = [ALGORITHMS[a] for a in algorithms]
+    properties = [a.node_property for a in algorithms]
+    project(graph, name=name, reuse=reuse, properties=properties)
+    check_memory(graph, name, algorithms, max_heap_percentage=max_heap_percentage)
+
+    for algorithm in algorithms:
+        print("Calculating {}".format(algorithm.procedure))
+        cql = """CALL gds.{}.mutate($name, $config)
+                 YIELD nodePropertiesWritten""".format(algorithm.procedure)
+        graph.run(cql, name=name, config=dict(algorithm.config,
+                                               mutateProperty=algorithm.node_property))
+
+    # one write for every property
+    graph.run("""CALL gds.graph.nodeProperties.write($name, $properties, ['country'])
+                 YIELD propertiesWritten""", name=name, properties=properties)
+    if not keep:
+        graph.run("CALL gds.graph.drop($name)", name=name)
+
+    cql = "MATCH (n:country)\n    RETURN n.name AS country, " + ", ".join(
+        "n.{} AS {}".format(a.node_property, a.column) for a in algorithms)
+    return pd.DataFrame(graph.run(cql).data(), columns=["country"] + [a.column for a in algorithms])
@@ -0,0 +1,173 @@
+"""
+Maps the goods of exports_goods and imports_goods to the categories of
+output/goods_grouping.csv.
+
+A plain merge on the goods text only finds spellings that are already in
+goods_grouping, every new one ("Aircraft Parts", "heavy machinery") ends up
+without a category.  GoodsNormalizer tries, in order:
+
+    1) the exact text of goods_grouping
+    2) the stemmed words of it: case, punctuation, plurals and filler words
+       like "and" don't matter ("Apples" -> "apple")
+    3) the longest goods_grouping entry that ends the text, its head word
+       ("frozen fish fillets" ends with "fish fillets", "heavy machinery"
+       with "machinery"), with a trie of the entries.  A match anywhere else
+       would ignore what the goods are ("cotton seed oil" isn't cotton).
+       Single words in AMBIGUOUS_HEADS only match on their own, their
+       category depends on the modifier ("palm kernel oil" isn't petroleum)
+
+Everything else stays without a category.  Lookups are cached, the same
+goods repeat in every country and every edition.  unmapped_report lists the
+goods without a category with the category most of their words point to, as
+a hint for extending goods_grouping.csv, and the goods found by a phrase so
+they can be checked.
+"""
+import functools
+import re
+from collections import Counter
+
+import pandas as pd
+from pathlib2 import Path
+
+
+# words that say nothing about the category
+FILLER = {"and", "of", "the", "for", "in", "including", "other", "misc", "etc", "incl"}
+# filler for the suggestions of unmapped_report only, too common to vote
+GENERIC = FILLER | {"product", "part", "good", "item", "material", "equipment"}
+# head words that don't say the category without the words before them
+AMBIGUOUS_HEADS = {"oil", "equipment", "metal", "stone"}
+
+# spellings that aren't in goods_grouping.csv and the category they should
+# get, checked by running this module
+EXAMPLES = {"Aircraft Parts": "aerospace",
+            "heavy machinery": "machinery and equipment",
+            "frozen fish fillets": "seafood and ocean products",
+            "palm kernel oil": None,
+            "cotton seed oil": None}
+
+
+def stem(word):
+    # plurals to singular, enough for the Factbook lists
+    if (len(word) <= 3) or word.endswith(("ss", "us", "is")):
+        return word
+    for suffix, replacement in [("ies", "y"), ("ches", "ch"), ("shes", "sh"), ("xes", "x"),
+                                ("oes", "o"), ("s", "")]:
+        if word.endswith(suffix):
+            return word[:-len(suffix)] + replacement
+    return word
+
+
+def tokens(text):
+    """The stemmed words of text without filler."""
+    words = re.findall(r"[a-z0-9]+", str(text).lower())
+    return tuple(stem(w) for w in words if w not in FILLER)
+
+
+class GoodsNormalizer:
+    def __init__(self, df_goods_group, cache_size=65536):
+        self.exact = {}
+        self.by_tokens = {}
+        self.trie = {}
+        # the first entry of a spelling wins, like the first row of a merge
+        for goods, category in df_goods_group[["goods", "mapped_good"]].itertuples(index=False):
+            if pd.isnull(goods) or pd.isnull(category):
+                continue
+            self.exact.setdefault(goods, category)
+            key = tokens(goods)
+            if len(key) == 0:
+                continue
+            self.by_tokens.setdefault(key, category)
+            node = self.trie
+            for word in key:
+                node = node.setdefault(word, {})
+            node.setdefault(None, category)
+
+        # votes of every word for the categories, for unmapped_report
+        self.word_votes = {}
+        for key, category in self.by_tokens.items():
+            for word in set(key) - GENERIC:
+                self.word_votes.setdefault(word, Counter())[category] += 1
+
+        # per instance so every normalizer has its own cache
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    def _longest_match(self, key):
+        # the longest entry ending at the last word, from the left so the
+        # first hit is the longest
+        for start in range(len(key)):
+            if (start == len(key) - 1) and (key[start] in AMBIGUOUS_HEADS):
+                break
+            node = self.trie
+            for word in key[start:]:
+                node = node.get(word)
+                if node is None:
+                    break
+            if (node is not None) and (None in node):
+                return node[None]
+        return None
+
+    def _lookup(self, goods):
+        """(category, how it was found), category None when not found."""
+        if pd.isnull(goods):
+            return None, None
+        if goods in self.exact:
+            return self.exact[goods], "exact"
+        key = tokens(goods)
+        if key in self.by_tokens:
+            return self.by_tokens[key], "tokens"
+        category = self._longest_match(key)
+        if category is not None:
+            return category, "phrase"
+        return None, None
+
+    def map(self, goods):
+        """The category of every goods in a column, missing when not found."""
+        di = {g: self.lookup(g)[0] for g in pd.unique(goods.dropna())}
+        return goods.map(di)
+
+    def suggest(self, goods):
+        # the category most of the words vote for
+        votes = Counter()
+        for word in tokens(goods):
+            votes.update(self.word_votes.get(word, {}))
+        return votes.most_common(1)[0][0] if votes else None
+
+
+def unmapped_report(normalizer, di_goods):
+    """
+    Takes {direction: exports_goods or imports_goods with mapped_good} and
+    returns one row per goods without a category or with a category found
+    by a phrase: the direction, how many rows and countries list it, the
+    category and how it was found (empty or "phrase") and a suggested
+    category.  The goods without a category come first.
+    """
+    frames = []
+    for direction, df in di_goods.items():
+        df = df.loc[df["goods"].notnull()]
+        matched_by = df["goods"].map(lambda goods: normalizer.lookup(goods)[1])
+        df = df.assign(matched_by=matched_by)
+        df = df.loc[df["mapped_good"].isnull() | (df["matched_by"] == "phrase")]
+        df = df.astype({"country": object}).groupby("goods", as_index=False).agg(
+            rows=("country", "size"), countries=("country", "nunique"),
+            mapped_good=("mapped_good", "first"), matched_by=("matched_by", "first"))
+        df.insert(0, "direction", direction)
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+    df["suggested_good"] = df["goods"].map(normalizer.suggest)
+    return df.sort_values(["matched_by", "rows", "goods"], ascending=[True, False, True],
+                          na_position="first", ignore_index=True)
+
+
+def main():
+    df_goods_group = pd.read_csv(Path("output", "goods_grouping.csv"))
+    normalizer = GoodsNormalizer(df_goods_group)
+    wrong = 0
+    for goods, expected in EXAMPLES.items():
+        category, matched_by = normalizer.lookup(goods)
+        wrong += category != expected
+        print("{:<24}{:<32}{}".format(goods, str(category), matched_by or ""))
+    print("{} of {} examples with the wrong category".format(wrong, len(EXAMPLES)))
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Local PageRank and ArticleRank over the trades edges.
+
+Builds a sparse (CSR) adjacency matrix from the trade table and runs the same
+power iteration as gds.pageRank / gds.articleRank so the rankings can be
+computed without a running Neo4j.  Scores are not normalized, every node starts
+at (1 - dampingFactor) and the first of maxIterations is that starting value,
+which is how GDS counts them.
+
+Run directly to recompute the ranks from the files in output/ and compare them
+against the page_rank and article_rank columns written by GDS.
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from pathlib2 import Path
+
+
+def trade_matrix(df_trade, countries, weight_property=None):
+    """
+    CSR matrix with a row per exporting country and a column per importing
+    country.  Edges to countries that are not in countries are dropped, the
+    same as the MATCH in the upload.  Without a weight_property every edge
+    counts as 1.
+    """
+    di_index = {c: i for i, c in enumerate(countries)}
+    mask = df_trade["exports"].isin(di_index) & df_trade["imports"].isin(di_index)
+    df = df_trade.loc[mask]
+
+    rows = df["exports"].map(di_index).to_numpy()
+    cols = df["imports"].map(di_index).to_numpy()
+    if weight_property is None:
+        weights = np.ones(len(df))
+    else:
+        weights = df[weight_property].fillna(0).to_numpy(dtype=float)
+
+    n = len(countries)
+    return sp.csr_matrix((weights, (rows, cols)), shape=(n, n))
+
+
+def _power_iteration(M, damping_factor, max_iterations, tolerance):
+    # M is the column stochastic transition matrix (already transposed)
+    scores = np.full(M.shape[0], 1 - damping_factor)
+    for _ in range(max_iterations - 1):
+        new_scores = (1 - damping_factor) + damping_factor * (M @ scores)
+        delta = np.abs(new_scores - scores).max() if len(scores) else 0
+        scores = new_scores
+        if delta < tolerance:
+            break
+    return scores
+
+
+def page_rank(A, damping_factor=0.85, max_iterations=20, tolerance=1e-7):
+    out_degree = np.asarray(A.sum(axis=1)).ravel()
+    # nodes without outgoing edges don't pass their score on, same as GDS
+    inv_degree = np.divide(1, out_degree,
+                           out=np.zeros_like(out_degree),
+                           where=out_degree > 0)
+    M = (sp.diags(inv_degree) @ A).T.tocsr()
+    return _power_iteration(M, damping_factor, max_iterations, tolerance)
+
+
+def article_rank(A, damping_factor=0.85, max_iterations=20, tolerance=1e-7):
+    # ArticleRank lowers the influence of low degree nodes by adding the
+    # average out degree to every denominator
+    out_degree = np.asarray(A.sum(axis=1)).ravel()
+    avg_degree = out_degree.mean() if len(out_degree) else 0
+    inv_degree = np.divide(1, out_degree + avg_degree,
+                           out=np.zeros_like(out_degree),
+                           where=(out_degree + avg_degree) > 0)
+    M = (sp.diags(inv_degree) @ A).T.tocsr()
+    return _power_iteration(M, damping_factor, max_iterations, tolerance)
+
+
+def rank_countries(df_country, df_trade, weight_property=None,
+                   damping_factor=0.85, max_iterations=20):
+    """
+    Returns a DataFrame with country, page_rank and article_rank, the same
+    columns the GDS ranking adds to the country table.
+    """
+    countries = list(df_country["country"].drop_duplicates())
+    A = trade_matrix(df_trade, countries, weight_property=weight_property)
+
+    df = pd.DataFrame({"country": countries})
+    df["page_rank"] = page_rank(A,
+                                damping_factor=damping_factor,
+                                max_iterations=max_iterations)
+    # the GDS call for articleRank uses the default settings
+    df["article_rank"] = article_rank(A)
+    return df
+
+
+def main():
+    f_country = Path("output", "article_page_rank_countries.csv")
+    f_trade = Path("output", "trade_partners.csv")
+
+    df_country = pd.read_csv(f_country)
+    df_trade = pd.read_csv(f_trade)
+
+    df_local = rank_countries(df_country, df_trade)
+    df = pd.merge(df_country[["country", "page_rank", "article_rank"]],
+                  df_local, on="country", suffixes=("_gds", "_local"))
+
+    for name in ["page_rank", "article_rank"]:
+        diff = (df[name + "_gds"] - df[name + "_local"]).abs().max()
+        print("{} max difference to GDS: {:.2e}".format(name, diff))
+
+
+if __name__=="__main__":
+    main()
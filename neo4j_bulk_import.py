@@ -0,0 +1,256 @@
+"""
+Cold load of the graph from CSV files instead of Cypher batches.
+
+The node and relationship files are written in the header format of
+neo4j-admin import (name:ID(country), :START_ID(country), amount:float, ...).
+The same files can be loaded in two ways:
+
+    neo4j-admin   the database is built offline by
+                  neo4j-admin database import full.  Fastest, needs the
+                  database to be stopped and replaces its content.
+    load_csv      LOAD CSV ... CALL { } IN TRANSACTIONS against a running
+                  database.  The files have to be in its import folder.
+
+Both are meant for an empty database.  Run directly to write the files and run
+neo4j-admin:
+
+    python neo4j_bulk_import.py --neo4j-home /path/to/neo4j --database neo4j
+"""
+import argparse
+import subprocess
+import time
+
+import pandas as pd
+from pathlib2 import Path
+
+import neo4j_upload
+
+
+# Per data set of neo4j_upload.build_datasets: the file name, the label or
+# relationship type, the id columns and [(row key, property)].  Nodes have one
+# id column, relationships a (start, end) pair.  The property types are
+# neo4j_upload.VALUE_TYPES, the same as the batched upload.
+NODE_FILES = {
+    "COUNTRY nodes": ("country.csv", "country", ("country", "country"),
+                      [("country_id", "country_id"),
+                       ("link", "link"),
+                       ("amount_export", "amount_export"),
+                       ("year_export", "year_export"),
+                       ("amount_import", "amount_import"),
+                       ("year_import", "year_import"),
+                       ("primary_region", "primary_region"),
+                       ("gdp", "gdp"),
+                       ("year_gdp", "year_gdp"),
+                       ("real_gdp", "real_gdp"),
+                       ("real_gdp_per_capita", "real_gdp_per_capita"),
+                       ("year_real_gdp", "year_real_gdp"),
+                       ("population", "population"),
+                       ("year_population", "year_population"),
+                       ("retrieved", "date_retrieved"),
+                       ("content_hash", "content_hash")]),
+    "REGION nodes": ("region.csv", "region", ("regions", "region"),
+                     [("content_hash", "content_hash")]),
+    "GOOD nodes": ("good.csv", "good", ("mapped_good", "good"),
+                   [("goods", "sub_goods"),
+                    ("content_hash", "content_hash")]),
+}
+
+RELATIONSHIP_FILES = {
+    "TRADES edges": ("trades.csv", "trades",
+                     ("exports", "country"), ("imports", "country"),
+                     [("amount", "amount"),
+                      ("year", "year"),
+                      ("percentage_exports", "percentage_exports"),
+                      ("percentage_imports", "percentage_imports"),
+                      ("export_trade_rank", "export_trade_rank"),
+                      ("import_trade_rank", "import_trade_rank"),
+                      ("trade_type", "trade_source"),
+                      ("retrieved", "retrieved"),
+                      ("content_hash", "content_hash")]),
+    "CONTAINS edges": ("contains.csv", "contains",
+                       ("regions", "region"), ("country", "country"),
+                       [("rank", "rank"),
+                        ("retrieved", "retrieved"),
+                        ("content_hash", "content_hash")]),
+    "EXPORTS edges": ("exports.csv", "exports",
+                      ("country", "country"), ("mapped_good", "good"),
+                      [("goods", "sub_good"),
+                       ("rank", "rank"),
+                       ("year", "year"),
+                       ("retrieved", "retrieved"),
+                       ("content_hash", "content_hash")]),
+    "IMPORTS edges": ("imports.csv", "imports",
+                      ("mapped_good", "good"), ("country", "country"),
+                      [("goods", "sub_good"),
+                       ("rank", "rank"),
+                       ("year", "year"),
+                       ("retrieved", "retrieved"),
+                       ("content_hash", "content_hash")]),
+}
+
+# used for string[] properties, none of the goods contain it
+ARRAY_DELIMITER = ";"
+
+# how a LOAD CSV value is converted to the property type
+CONVERTERS = {"string": "{}",
+              "float": "toFloat({})",
+              "int": "toInteger({})",
+              "date": "date({})",
+              "string[]": "split({}, '" + ARRAY_DELIMITER + "')"}
+
+
+def _type(prop):
+    return neo4j_upload.VALUE_TYPES.get(prop, "string")
+
+
+def _header(prop):
+    type_ = _type(prop)
+    return prop if type_ == "string" else "{}:{}".format(prop, type_)
+
+
+def _property_frame(rows, props):
+    # the columns are given so an empty dataset still gets its header
+    df = pd.DataFrame(rows, columns=[key for key, _ in props])
+    df_out = pd.DataFrame(index=df.index)
+    for key, prop in props:
+        type_ = _type(prop)
+        col = df[key]
+        if type_ == "string[]":
+            col = col.apply(ARRAY_DELIMITER.join)
+        elif type_ == "int":
+            col = col.astype("Int64")
+        df_out[_header(prop)] = col
+    return df_out
+
+
+def write_import_files(datasets, import_dir):
+    """
+    Writes one csv per node label and relationship type into import_dir and
+    returns {"nodes": {label: file}, "relationships": {type: file}}.
+    Relationships whose start or end node is missing are dropped, the same
+    as the MATCH of the batched upload.
+    """
+    import_dir = Path(import_dir)
+    import_dir.mkdir(parents=True, exist_ok=True)
+    di_rows = {stage: rows for stage, _, rows, _ in datasets}
+
+    files = {"nodes": {}, "relationships": {}}
+    di_ids = {}
+    for stage, (f_name, label, (id_key, id_space), props) in NODE_FILES.items():
+        df = _property_frame(di_rows[stage], props)
+        df.insert(0, "name:ID({})".format(id_space),
+                  [row[id_key] for row in di_rows[stage]])
+        df = df.drop_duplicates("name:ID({})".format(id_space))
+        di_ids[id_space] = set(df["name:ID({})".format(id_space)])
+        df.to_csv(Path(import_dir, f_name), index=False)
+        files["nodes"][label] = Path(import_dir, f_name)
+
+    for stage, (f_name, rel_type, start, end, props) in RELATIONSHIP_FILES.items():
+        rows = [row for row in di_rows[stage]
+                if (row[start[0]] in di_ids[start[1]]) & (row[end[0]] in di_ids[end[1]])]
+        df = _property_frame(rows, props)
+        df.insert(0, ":START_ID({})".format(start[1]), [row[start[0]] for row in rows])
+        df.insert(1, ":END_ID({})".format(end[1]), [row[end[0]] for row in rows])
+        df.to_csv(Path(import_dir, f_name), index=False)
+        files["relationships"][rel_type] = Path(import_dir, f_name)
+    return files
+
+
+def admin_import_command(files, neo4j_home, database="neo4j"):
+    # neo4j 5 syntax, the database has to be stopped
+    cmd = [str(Path(neo4j_home, "bin", "neo4j-admin")), "database", "import", "full"]
+    cmd += ["--nodes={}={}".format(label, f) for label, f in files["nodes"].items()]
+    cmd += ["--relationships={}={}".format(t, f) for t, f in files["relationships"].items()]
+    cmd += ["--array-delimiter=" + ARRAY_DELIMITER,
+            "--overwrite-destination=true",
+            database]
+    return cmd
+
+
+def run_admin_import(files, neo4j_home, database="neo4j"):
+    cmd = admin_import_command(files, neo4j_home, database=database)
+    print(" ".join(cmd))
+    subprocess.run(cmd, check=True)
+
+
+def load_csv_statements(files, rows_per_transaction=10000):
+    """
+    LOAD CSV statements for the files, nodes first.  The file names are used
+    as file:/// urls so the files must be in the import folder of Neo4j.
+    """
+    def set_clause(var, props):
+        sets = ["{}.{} = {}".format(var, prop,
+                                    CONVERTERS[_type(prop)].format("row.`{}`".format(_header(prop))))
+                for _, prop in props]
+        return "SET " + ", ".join(sets) if sets else ""
+
+    statements = []
+    for stage, (f_name, label, (_, id_space), props) in NODE_FILES.items():
+        statements.append((stage, """
+LOAD CSV WITH HEADERS FROM 'file:///{f}' AS row
+CALL {{
+  WITH row
+  CREATE (n:{label} {{name: row.`name:ID({space})`}})
+  {sets}
+}} IN TRANSACTIONS OF {n} ROWS""".format(f=f_name, label=label, space=id_space,
+                                          sets=set_clause("n", props),
+                                          n=rows_per_transaction)))
+
+    di_labels = {space: label for _, label, (_, space), _ in NODE_FILES.values()}
+    for stage, (f_name, rel_type, start, end, props) in RELATIONSHIP_FILES.items():
+        statements.append((stage, """
+LOAD CSV WITH HEADERS FROM 'file:///{f}' AS row
+CALL {{
+  WITH row
+  MATCH (a:{start_label} {{name: row.`:START_ID({start})`}})
+  MATCH (b:{end_label} {{name: row.`:END_ID({end})`}})
+  CREATE (a)-[e:{rel_type}]->(b)
+  {sets}
+}} IN TRANSACTIONS OF {n} ROWS""".format(f=f_name, rel_type=rel_type,
+                                          start=start[1], end=end[1],
+                                          start_label=di_labels[start[1]],
+                                          end_label=di_labels[end[1]],
+                                          sets=set_clause("e", props),
+                                          n=rows_per_transaction)))
+    return statements
+
+
+def load_csv_import(graph, datasets, import_dir, rows_per_transaction=10000):
+    """
+    Writes the files into the Neo4j import folder and loads them with LOAD CSV.
+    Returns a timing report in the same format as neo4j_upload.upload_all.
+    """
+    files = write_import_files(datasets, import_dir)
+    di_rows = {stage: len(rows) for stage, _, rows, _ in datasets}
+
+    report = []
+    for stage, cql in load_csv_statements(files, rows_per_transaction):
+        print("Loading {} with LOAD CSV".format(stage))
+        start = time.perf_counter()
+        # CALL {} IN TRANSACTIONS has to run in an auto commit transaction
+        graph.run(cql)
+        report.append({"stage": stage,
+                       "rows": di_rows[stage],
+                       "batches": -(-di_rows[stage] // rows_per_transaction),
+                       "seconds": time.perf_counter() - start})
+    return report
+
+
+def main():
+    # imported here so preprocess_upload_neo4j can import this module
+    import preprocess_upload_neo4j
+
+    parser = argparse.ArgumentParser(description="Cold load the graph with neo4j-admin import")
+    parser.add_argument("--neo4j-home", required=True)
+    parser.add_argument("--database", default="neo4j")
+    parser.add_argument("--import-dir", default=str(Path("output", "neo4j_import")))
+    args = parser.parse_args()
+
+    di_tables = preprocess_upload_neo4j.preprocess(preprocess_upload_neo4j.read_tables())
+    datasets = neo4j_upload.build_datasets(**di_tables)
+    files = write_import_files(datasets, args.import_dir)
+    run_admin_import(files, args.neo4j_home, database=args.database)
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Neo4j connection settings without typing them in.
+
+Every setting is taken from the environment first, then from the [neo4j]
+section of factbook.ini (or the file in FACTBOOK_CONFIG):
+
+    NEO4J_URL       url        default bolt://localhost:7687
+    NEO4J_USERNAME  username
+    NEO4J_PASSWORD  password
+
+    [neo4j]
+    url = bolt://localhost:7687
+    username = neo4j
+    password = ...
+
+Keep factbook.ini out of version control, it is in .gitignore.
+"""
+import configparser
+import os
+from getpass import getpass
+
+from pathlib2 import Path
+
+
+F_CONFIG = Path("factbook.ini")
+DEFAULT_URL = "bolt://localhost:7687"
+
+
+class MissingCredentials(ValueError):
+    pass
+
+
+def credentials(prompt=False, f_config=None):
+    """
+    Returns (url, username, password).  A missing username or password is
+    asked for when prompt is set, otherwise it raises MissingCredentials.
+    """
+    f_config = Path(f_config or os.environ.get("FACTBOOK_CONFIG", F_CONFIG))
+    config = configparser.ConfigParser()
+    if f_config.exists():
+        config.read(str(f_config))
+    section = config["neo4j"] if config.has_section("neo4j") else {}
+
+    def setting(name, default=None):
+        return os.environ.get("NEO4J_" + name.upper()) or section.get(name) or default
+
+    url = setting("url", DEFAULT_URL)
+    username = setting("username")
+    password = setting("password")
+
+    if (username is None) or (password is None):
+        if not prompt:
+            raise MissingCredentials("No Neo4j username or password, set NEO4J_USERNAME "
+                                     "and NEO4J_PASSWORD or the [neo4j] section of {}".format(f_config))
+        if username is None:
+            username = input("Username: ")
+            print("\n")
+        if password is None:
+            password = getpass()
+    return url, username, password
@@ -0,0 +1,239 @@
+"""
+Parallel upload of the preprocessed tables over several Bolt sessions.
+
+neo4j_upload.upload_all sends one data set after the other over a single
+session, which leaves a multi-core Neo4j mostly idle.  Here:
+
+    1) the node data sets (country, region, good) load at the same time, they
+       have different labels and take no locks in common
+    2) every relationship type then loads in a phase of its own, the types
+       share the country nodes
+    3) contains, exports and imports edges are split into one partition per
+       worker by their country, so the workers lock different country nodes.
+       The other end (region or good) is shared by all of them, the rows of
+       a batch are sorted by it so the workers take those locks in the same
+       order
+    4) trades edges have a country at both ends.  The countries are split
+       into 2 * max_workers partitions and loaded in rounds: in every round
+       the partitions are paired off (round_robin) and a worker loads the
+       edges between the two partitions of its pair, the next round starts
+       when the round is done.  Within a round no two workers touch the same
+       country, the rows of a batch are sorted by both country ids
+
+The shared region and good nodes can still deadlock, a transaction that loses
+one is retried after a short random wait.  Every worker opens its own Graph (a Bolt session) with connect() and
+keeps counters of rows, batches, retries and seconds.
+
+    report, workers = upload_parallel(lambda: py2neo.Graph(url, auth=auth),
+                                      max_workers=4, **di_tables)
+"""
+import concurrent.futures
+import random
+import threading
+import time
+
+import neo4j_upload
+
+
+# (stage, row key of the country the edges are partitioned on, row key of the
+# other end, the rows of a batch are sorted on it)
+RELATIONSHIPS = {"TRADES edges": ("exports_id", "imports_id"),
+                 "CONTAINS edges": ("country_id", "regions"),
+                 "EXPORTS edges": ("country_id", "mapped_good"),
+                 "IMPORTS edges": ("country_id", "mapped_good")}
+
+# relationships with a country at the other end as well, loaded in rounds
+COUNTRY_PAIRS = ["TRADES edges"]
+
+
+def is_deadlock(error):
+    # py2neo errors carry the Neo4j status code,
+    # Neo.TransientError.Transaction.DeadlockDetected
+    return "DeadlockDetected" in str(getattr(error, "code", "")) or "DeadlockDetected" in str(error)
+
+
+def _part(value, n_parts):
+    # rows without a value go to the first partition
+    return 0 if value is None else hash(value) % n_parts
+
+
+def partition(rows, key, sort_key, n_parts):
+    """
+    Splits rows into n_parts lists by the value of key, every value ends up
+    in exactly one list.  Rows without a value go to the first list.
+    """
+    parts = [[] for _ in range(n_parts)]
+    for row in rows:
+        parts[_part(row[key], n_parts)].append(row)
+    for part in parts:
+        part.sort(key=lambda row: str(row[sort_key]))
+    return parts
+
+
+def round_robin(n_parts):
+    """
+    Rounds of pairs of the partitions 0 to n_parts - 1 (n_parts even), every
+    two partitions are paired in exactly one round and every partition is in
+    one pair of every round.
+    """
+    parts = list(range(n_parts))
+    rounds = []
+    for _ in range(n_parts - 1):
+        rounds.append([(parts[k], parts[-1 - k]) for k in range(n_parts // 2)])
+        # the first one stays, the others turn by one
+        parts = [parts[0], parts[-1]] + parts[1:-1]
+    return rounds
+
+
+def pair_rounds(rows, key, other_key, n_parts):
+    """
+    Splits the rows of edges between two countries into rounds of lists.  The
+    lists of a round hold the edges between the two partitions of a pair of
+    round_robin(n_parts) (and the first round the edges inside them), so no
+    two lists of a round have a country in common.
+    """
+    blocks = {}
+    for row in rows:
+        blocks.setdefault((_part(row[key], n_parts), _part(row[other_key], n_parts)), []).append(row)
+    rounds = []
+    for i, pairs in enumerate(round_robin(n_parts)):
+        lists = []
+        for a, b in pairs:
+            keys = [(a, b), (b, a)] + ([(a, a), (b, b)] if i == 0 else [])
+            rows_pair = [row for k in keys for row in blocks.get(k, [])]
+            rows_pair.sort(key=lambda row: (str(row[key]), str(row[other_key])))
+            lists.append(rows_pair)
+        rounds.append(lists)
+    return rounds
+
+
+class Worker:
+    """One Bolt session and its counters."""
+
+    def __init__(self, worker_id, connect, max_retries=5, backoff=0.1):
+        self.worker_id = worker_id
+        self._connect = connect
+        self._graph = None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rows = 0
+        self.batches = 0
+        self.retries = 0
+        self.seconds = 0.0
+
+    @property
+    def graph(self):
+        if self._graph is None:
+            self._graph = self._connect()
+        return self._graph
+
+    def send(self, cql, rows):
+        # one batch in one transaction, retried when it loses a deadlock
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            tx = self.graph.begin()
+            try:
+                tx.run(cql, rows=rows)
+                self.graph.commit(tx)
+                break
+            except Exception as error:
+                try:
+                    self.graph.rollback(tx)
+                except Exception:
+                    # Neo4j already rolled back the failed transaction
+                    pass
+                if (not is_deadlock(error)) or (attempt == self.max_retries):
+                    raise
+                self.retries += 1
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        self.rows += len(rows)
+        self.batches += 1
+        self.seconds += time.perf_counter() - start
+
+    def upload(self, cql, rows, batch_size=1000):
+        for start in range(0, len(rows), batch_size):
+            self.send(cql, rows[start:start + batch_size])
+
+    def counters(self):
+        return {"worker": self.worker_id,
+                "rows": self.rows,
+                "batches": self.batches,
+                "retries": self.retries,
+                "seconds": self.seconds,
+                "rows_per_second": self.rows / self.seconds if self.seconds > 0 else 0}
+
+
+def _n_batches(parts, batch_size):
+    return sum(-(-len(rows) // batch_size) for rows in parts)
+
+
+class _WorkerPool:
+    # hands every thread of the executor its own Worker
+    def __init__(self, connect, **kwargs):
+        self._connect = connect
+        self._kwargs = kwargs
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.workers = []
+
+    def get(self):
+        if not hasattr(self._local, "worker"):
+            with self._lock:
+                self._local.worker = Worker(len(self.workers), self._connect, **self._kwargs)
+                self.workers.append(self._local.worker)
+        return self._local.worker
+
+
+def upload_parallel(connect, df_country, df_trade, df_region, df_good, df_exp_good,
+                    df_imp_good, max_workers=4, batch_size=1000, max_retries=5):
+    """
+    Uploads every node and edge data set with max_workers sessions, nodes
+    first.  connect() returns a new py2neo Graph.  Returns the report of
+    neo4j_upload.upload_all (seconds are wall seconds of the data set) and
+    the counters of every worker.
+    """
+    datasets = neo4j_upload.build_datasets(df_country, df_trade, df_region, df_good,
+                                           df_exp_good, df_imp_good)
+    nodes = [d for d in datasets if d[0] not in RELATIONSHIPS]
+    edges = [d for d in datasets if d[0] in RELATIONSHIPS]
+    pool = _WorkerPool(connect, max_retries=max_retries)
+    report = {}
+
+    def load(stage, cql, rows):
+        start = time.perf_counter()
+        pool.get().upload(cql, rows, batch_size=batch_size)
+        return stage, time.perf_counter() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        print("Uploading {} to Neo4j".format(", ".join(d[0] for d in nodes)))
+        for stage, seconds in executor.map(lambda d: load(*d[:3]), nodes):
+            report[stage] = (seconds, _n_batches([d[2] for d in nodes if d[0] == stage], batch_size))
+
+        for stage, cql, rows, _ in edges:
+            print("Uploading {} to Neo4j".format(stage))
+            start = time.perf_counter()
+            if stage in COUNTRY_PAIRS:
+                rounds = pair_rounds(rows, *RELATIONSHIPS[stage], 2 * max_workers)
+            else:
+                rounds = [partition(rows, *RELATIONSHIPS[stage], max_workers)]
+            for lists in rounds:
+                # waits for the round before the next one starts
+                list(executor.map(lambda part: pool.get().upload(cql, part, batch_size=batch_size),
+                                  lists))
+            report[stage] = (time.perf_counter() - start,
+                             _n_batches([part for lists in rounds for part in lists], batch_size))
+
+    report = [{"stage": stage,
+               "rows": len(rows),
+               "batches": report[stage][1],
+               "seconds": report[stage][0]} for stage, _, rows, _ in datasets]
+    return report, [w.counters() for w in pool.workers]
+
+
+def print_workers(workers):
+    print("{:<8}{:>8}{:>9}{:>9}{:>10}{:>12}".format(
+        "worker", "rows", "batches", "retries", "seconds", "rows/sec"))
+    for di in workers:
+        print("{:<8}{:>8}{:>9}{:>9}{:>10.2f}{:>12.0f}".format(
+            di["worker"], di["rows"], di["batches"], di["retries"], di["seconds"],
+            di["rows_per_second"]))
@@ -0,0 +1,129 @@
+"""
+Constraints and indexes of the graph, declared in SCHEMA and created when
+missing.
+
+What exists is read from the rows of SHOW CONSTRAINTS and SHOW INDEXES and
+compared on the schema itself (node or relationship, label or type,
+properties and kind), not on names or the printed table, so constraints made
+by hand or by older versions of this script under other names are found too.
+
+The node keys are created before the load, the MATCH of every edge batch
+uses them.  Secondary indexes only serve later queries and are marked
+deferred: on a full reload they are dropped first and built after the load
+so the load doesn't have to keep them up to date.
+
+    schema = SchemaManager(graph)
+    schema.ensure()                  # constraints and non deferred indexes
+    ... upload ...
+    schema.ensure(deferred=True)     # the secondary indexes
+    schema.await_indexes()
+"""
+from collections import namedtuple
+
+
+# kind is "NODE KEY", "UNIQUE" or "RANGE" (an index), entity "NODE" or
+# "RELATIONSHIP"
+SchemaItem = namedtuple("SchemaItem", ["name", "kind", "entity", "label", "properties", "deferred"])
+
+SCHEMA = [
+    SchemaItem("country_name", "NODE KEY", "NODE", "country", ("name",), False),
+    SchemaItem("region_name", "NODE KEY", "NODE", "region", ("name",), False),
+    SchemaItem("good_name", "NODE KEY", "NODE", "good", ("name",), False),
+    # edges are matched on the registry id of the countries
+    SchemaItem("country_id", "UNIQUE", "NODE", "country", ("country_id",), False),
+    SchemaItem("country_primary_region", "RANGE", "NODE", "country", ("primary_region",), True),
+    SchemaItem("trades_year", "RANGE", "RELATIONSHIP", "trades", ("year",), True),
+    SchemaItem("trades_trade_source", "RANGE", "RELATIONSHIP", "trades", ("trade_source",), True),
+    # the editions of snapshot_cia
+    SchemaItem("trades_valid_from", "RANGE", "RELATIONSHIP", "trades", ("valid_from",), True),
+]
+
+# the constraint types of SHOW CONSTRAINTS, they changed names in Neo4j 5.7
+CONSTRAINT_KINDS = {"NODE_KEY": "NODE KEY",
+                    "UNIQUENESS": "UNIQUE",
+                    "NODE_PROPERTY_UNIQUENESS": "UNIQUE"}
+
+
+def key(item):
+    # what makes two schema items the same, whatever their names
+    return (item.kind, item.entity, item.label, tuple(item.properties))
+
+
+def create_statement(item):
+    if item.entity == "NODE":
+        var, pattern = "n", "(n:{})".format(item.label)
+    else:
+        var, pattern = "e", "()-[e:{}]-()".format(item.label)
+    properties = ", ".join(var + "." + p for p in item.properties)
+    if item.kind == "RANGE":
+        return "CREATE RANGE INDEX {} IF NOT EXISTS FOR {} ON ({})".format(
+            item.name, pattern, properties)
+    return "CREATE CONSTRAINT {} IF NOT EXISTS FOR {} REQUIRE ({}) IS {}".format(
+        item.name, pattern, properties, item.kind)
+
+
+class SchemaManager:
+    def __init__(self, graph, schema=SCHEMA):
+        self.graph = graph
+        self.schema = schema
+
+    def existing(self):
+        """{key: name} of the constraints and range indexes in the database."""
+        di = {}
+        rows = self.graph.run("""SHOW CONSTRAINTS
+                                 YIELD name, type, entityType, labelsOrTypes, properties""").data()
+        for row in rows:
+            if row["type"] in CONSTRAINT_KINDS:
+                item = SchemaItem(row["name"], CONSTRAINT_KINDS[row["type"]], row["entityType"],
+                                  row["labelsOrTypes"][0], tuple(row["properties"]), False)
+                di[key(item)] = item.name
+
+        rows = self.graph.run("""SHOW INDEXES
+                                 YIELD name, type, entityType, labelsOrTypes, properties""").data()
+        for row in rows:
+            # the lookup indexes have no labels or properties
+            if (row["type"] == "RANGE") and row["labelsOrTypes"]:
+                item = SchemaItem(row["name"], "RANGE", row["entityType"],
+                                  row["labelsOrTypes"][0], tuple(row["properties"]), False)
+                di[key(item)] = item.name
+        return di
+
+    def missing(self, deferred=False):
+        """The items not in the database, deferred ones or the others."""
+        di_existing = self.existing()
+        missing = []
+        for item in self.schema:
+            if item.deferred != deferred:
+                continue
+            # constraints come with an index of their own
+            covered = (item.kind == "RANGE") and any(
+                key(item)[1:] == k[1:] for k in di_existing if k[0] != "RANGE")
+            if (key(item) not in di_existing) and not covered:
+                missing.append(item)
+        return missing
+
+    def ensure(self, deferred=False):
+        """Creates the missing items, returns their names."""
+        created = []
+        for item in self.missing(deferred):
+            self.graph.run(create_statement(item))
+            created.append(item.name)
+        return created
+
+    def drop_deferred(self):
+        """
+        Drops the deferred indexes, before a full reload.  Returns the names
+        dropped.
+        """
+        di_existing = self.existing()
+        dropped = []
+        for item in self.schema:
+            if item.deferred and (key(item) in di_existing):
+                name = di_existing[key(item)]
+                self.graph.run("DROP INDEX {} IF EXISTS".format(name))
+                dropped.append(name)
+        return dropped
+
+    def await_indexes(self, timeout_seconds=300):
+        # new indexes are built in the background
+        self.graph.run("CALL db.awaitIndexes($timeout)", timeout=timeout_seconds)
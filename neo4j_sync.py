@@ -0,0 +1,137 @@
+"""
+Incremental sync of the preprocessed tables into an existing Neo4j graph.
+
+Instead of deleting the whole graph and uploading everything again, the
+content_hash stored on every node and edge by neo4j_upload is read back and
+compared with the hashes of the new rows.  Only inserts, changed rows and
+deletes are sent, so a refresh scales with the size of the change and the
+graph stays queryable while it runs.
+"""
+import time
+
+import neo4j_upload
+
+
+# For every data set: the query returning the key columns and content_hash of
+# what is in the graph, and the statement deleting rows by their key columns.
+# The key columns have the same names as in neo4j_upload.build_datasets.
+SYNC_CQL = {
+    "COUNTRY nodes": (
+        """MATCH (n:country)
+           RETURN n.name AS country, n.content_hash AS content_hash""",
+        """UNWIND $rows AS row
+           MATCH (n:country {name: row.country})
+           DETACH DELETE n"""),
+    "TRADES edges": (
+        """MATCH (n:country)-[e:trades]->(m:country)
+           RETURN n.name AS exports, m.name AS imports,
+                  e.content_hash AS content_hash""",
+        """UNWIND $rows AS row
+           MATCH (:country {name: row.exports})-[e:trades]->(:country {name: row.imports})
+           DELETE e"""),
+    "REGION nodes": (
+        """MATCH (n:region)
+           RETURN n.name AS regions, n.content_hash AS content_hash""",
+        """UNWIND $rows AS row
+           MATCH (n:region {name: row.regions})
+           DETACH DELETE n"""),
+    "CONTAINS edges": (
+        """MATCH (n:region)-[e:contains]->(m:country)
+           RETURN n.name AS regions, m.name AS country,
+                  e.content_hash AS content_hash""",
+        """UNWIND $rows AS row
+           MATCH (:region {name: row.regions})-[e:contains]->(:country {name: row.country})
+           DELETE e"""),
+    "GOOD nodes": (
+        """MATCH (n:good)
+           RETURN n.name AS mapped_good, n.content_hash AS content_hash""",
+        """UNWIND $rows AS row
+           MATCH (n:good {name: row.mapped_good})
+           DETACH DELETE n"""),
+    "EXPORTS edges": (
+        """MATCH (c:country)-[e:exports]->(g:good)
+           RETURN c.name AS country, g.name AS mapped_good,
+                  e.sub_good AS goods, e.content_hash AS content_hash""",
+        """UNWIND $rows AS row
+           MATCH (:country {name: row.country})-[e:exports {sub_good: row.goods}]->(:good {name: row.mapped_good})
+           DELETE e"""),
+    "IMPORTS edges": (
+        """MATCH (g:good)-[e:imports]->(c:country)
+           RETURN c.name AS country, g.name AS mapped_good,
+                  e.sub_good AS goods, e.content_hash AS content_hash""",
+        """UNWIND $rows AS row
+           MATCH (:good {name: row.mapped_good})-[e:imports {sub_good: row.goods}]->(:country {name: row.country})
+           DELETE e""")
+}
+
+
+def diff_rows(rows, existing, key_cols):
+    """
+    Compares the new rows with the existing {key: content_hash} of the graph.
+    Returns the rows to insert, the rows to update and the keys to delete
+    (as dicts of the key columns).
+    """
+    inserts, updates = [], []
+    current_keys = set()
+    for row in rows:
+        key = tuple(row[c] for c in key_cols)
+        current_keys.add(key)
+        if key not in existing:
+            inserts.append(row)
+        elif existing[key] != row["content_hash"]:
+            updates.append(row)
+
+    deletes = [dict(zip(key_cols, key)) for key in existing
+               if key not in current_keys]
+    return inserts, updates, deletes
+
+
+def sync_all(graph, df_country, df_trade, df_region, df_good, df_exp_good,
+             df_imp_good, batch_size=1000):
+    """
+    Brings the graph in line with the preprocessed tables by sending only the
+    differences.  Returns a report with one dict per data set.
+    """
+    datasets = neo4j_upload.build_datasets(df_country, df_trade, df_region,
+                                           df_good, df_exp_good, df_imp_good)
+
+    # diff everything first, the graph is only read here
+    changes = []
+    for stage, cql, rows, key_cols in datasets:
+        cql_existing, cql_delete = SYNC_CQL[stage]
+        existing = {tuple(di[c] for c in key_cols): di["content_hash"]
+                    for di in graph.run(cql_existing).data()}
+        inserts, updates, deletes = diff_rows(rows, existing, key_cols)
+        changes.append((stage, cql, cql_delete, inserts, updates, deletes))
+
+    report = []
+    # deletes go edges first so DETACH DELETE of nodes has less to do
+    for stage, _, cql_delete, _, _, deletes in reversed(changes):
+        print("Deleting {} {}".format(len(deletes), stage))
+        start = time.perf_counter()
+        neo4j_upload.upload_batches(graph, cql_delete, deletes,
+                                    batch_size=batch_size)
+        report.append({"stage": stage, "deletes": len(deletes),
+                       "seconds": time.perf_counter() - start})
+    report.reverse()
+
+    # inserts and updates go nodes first, the same order as a full upload
+    for di, (stage, cql, _, inserts, updates, _) in zip(report, changes):
+        print("Upserting {} new and {} changed {}".format(
+            len(inserts), len(updates), stage))
+        start = time.perf_counter()
+        neo4j_upload.upload_batches(graph, cql, inserts + updates,
+                                    batch_size=batch_size)
+        di["inserts"] = len(inserts)
+        di["updates"] = len(updates)
+        di["seconds"] += time.perf_counter() - start
+    return report
+
+
+def print_report(report):
+    print("{:<16}{:>9}{:>9}{:>9}{:>10}".format(
+        "stage", "inserts", "updates", "deletes", "seconds"))
+    for di in report:
+        print("{:<16}{:>9}{:>9}{:>9}{:>10.2f}".format(
+            di["stage"], di["inserts"], di["updates"], di["deletes"],
+            di["seconds"]))
@@ -0,0 +1,296 @@
+"""
+Bulk upload of the preprocessed tables into Neo4j.
+
+Every data set (country, trades, region, contains, good, exports, imports) is
+sent as parameterized UNWIND batches instead of one graph.run() per row.  Each
+batch is its own transaction and the Cypher text never changes between batches
+so Neo4j only has to plan each statement once.  Passing the values as
+parameters also means names containing quotes no longer break the query.
+"""
+import hashlib
+import json
+import time
+
+import pandas as pd
+
+
+# ==============================================================================
+# Cypher statements.  Values are only ever passed in through $rows.
+CQL_COUNTRY = """
+UNWIND $rows AS row
+MERGE (n:country {name: row.country})
+SET n.country_id = row.country_id,
+    n.link = row.link,
+    n.amount_export = row.amount_export,
+    n.year_export = row.year_export,
+    n.amount_import = row.amount_import,
+    n.year_import = row.year_import,
+    n.primary_region = row.primary_region,
+    n.gdp = row.gdp,
+    n.year_gdp = row.year_gdp,
+    n.real_gdp = row.real_gdp,
+    n.real_gdp_per_capita = row.real_gdp_per_capita,
+    n.year_real_gdp = row.year_real_gdp,
+    n.population = row.population,
+    n.year_population = row.year_population,
+    n.date_retrieved = date(row.retrieved),
+    n.content_hash = row.content_hash
+"""
+
+CQL_TRADES = """
+UNWIND $rows AS row
+MATCH (n:country {country_id: row.exports_id}), (m:country {country_id: row.imports_id})
+MERGE (n)-[e:trades]->(m)
+SET e.amount = row.amount,
+    e.year = row.year,
+    e.percentage_exports = row.percentage_exports,
+    e.percentage_imports = row.percentage_imports,
+    e.export_trade_rank = row.export_trade_rank,
+    e.import_trade_rank = row.import_trade_rank,
+    e.trade_source = row.trade_type,
+    e.retrieved = date(row.retrieved),
+    e.content_hash = row.content_hash
+"""
+
+CQL_REGION = """
+UNWIND $rows AS row
+MERGE (n:region {name: row.regions})
+SET n.content_hash = row.content_hash
+"""
+
+CQL_CONTAINS = """
+UNWIND $rows AS row
+MATCH (n:region {name: row.regions}), (m:country {country_id: row.country_id})
+MERGE (n)-[e:contains]->(m)
+SET e.rank = row.rank,
+    e.retrieved = date(row.retrieved),
+    e.content_hash = row.content_hash
+"""
+
+CQL_GOOD = """
+UNWIND $rows AS row
+MERGE (n:good {name: row.mapped_good})
+SET n.sub_goods = row.goods,
+    n.content_hash = row.content_hash
+"""
+
+CQL_EXPORTS = """
+UNWIND $rows AS row
+MATCH (g:good {name: row.mapped_good}), (c:country {country_id: row.country_id})
+MERGE (c)-[e:exports {sub_good: row.goods}]->(g)
+SET e.rank = row.rank,
+    e.year = row.year,
+    e.retrieved = date(row.retrieved),
+    e.content_hash = row.content_hash
+"""
+
+CQL_IMPORTS = """
+UNWIND $rows AS row
+MATCH (g:good {name: row.mapped_good}), (c:country {country_id: row.country_id})
+MERGE (g)-[e:imports {sub_good: row.goods}]->(c)
+SET e.rank = row.rank,
+    e.year = row.year,
+    e.retrieved = date(row.retrieved),
+    e.content_hash = row.content_hash
+"""
+
+
+# ==============================================================================
+# Neo4j type of every value that isn't a string, by row key (the property of
+# the same name, retrieved is date_retrieved on countries and goods is
+# sub_goods on good nodes).  The batched upload converts its rows to these
+# types and neo4j_bulk_import writes them into the csv headers, so both load
+# the same graph.
+VALUE_TYPES = {"country_id": "int",
+               "exports_id": "int",
+               "imports_id": "int",
+               "amount_export": "float",
+               "year_export": "int",
+               "amount_import": "float",
+               "year_import": "int",
+               "gdp": "float",
+               "year_gdp": "int",
+               "real_gdp": "float",
+               "real_gdp_per_capita": "float",
+               "year_real_gdp": "int",
+               "population": "float",
+               "year_population": "int",
+               "amount": "float",
+               "year": "int",
+               "percentage_exports": "float",
+               "percentage_imports": "float",
+               "export_trade_rank": "float",
+               "import_trade_rank": "float",
+               "rank": "int",
+               "retrieved": "date",
+               "date_retrieved": "date",
+               "sub_goods": "string[]"}
+
+
+# ==============================================================================
+# Row builders.  These turn the preprocessed DataFrames into the list of dicts
+# that is sent as $rows.  to_dict("records") already returns native python
+# types which is what the bolt driver needs.  Dates are sent as text for
+# date().  Countries are matched on their registry id (see country_registry),
+# names that are not registered have no id.
+def _typed(df):
+    # the columns of df as VALUE_TYPES, missing values as None (null)
+    for col in df.columns:
+        type_ = VALUE_TYPES.get(col)
+        if type_ == "int":
+            values = df[col].astype("Int64").astype(object)
+        elif type_ == "float":
+            values = df[col].astype(float).astype(object)
+        elif type_ == "date":
+            values = pd.to_datetime(df[col]).dt.strftime("%Y-%m-%d")
+        else:
+            continue
+        df[col] = values.where(df[col].notnull(), None)
+    return df
+
+
+def country_rows(df_country):
+    df = df_country[["country", "country_id", "link", "regions", "retrieved",
+                     "year_exports", "year_imports", "year_gdp",
+                     "year_real_gdp", "amount_real_gdp_per_capita",
+                     "population", "year_population"]].copy()
+    df.rename(columns={"regions": "primary_region",
+                       "year_exports": "year_export",
+                       "year_imports": "year_import",
+                       "amount_real_gdp_per_capita": "real_gdp_per_capita"},
+              inplace=True)
+    df["link"] = df["link"].str.strip("/")
+    # amounts are uploaded in billions
+    df["amount_export"] = (df_country["amount_exports"] / 10**9).round(3)
+    df["amount_import"] = (df_country["amount_imports"] / 10**9).round(3)
+    df["gdp"] = (df_country["amount_gdp"] / 10**9).round(3)
+    df["real_gdp"] = (df_country["amount_real_gdp"] / 10**9).round(3)
+    df["population"] = df["population"].astype(float)
+    return _typed(df).to_dict("records")
+
+
+def trade_rows(df_trade):
+    cols = ["exports",
+            "imports",
+            "exports_id",
+            "imports_id",
+            "percentage_exports",
+            "percentage_imports",
+            "year",
+            "amount",
+            "trade_type",
+            "export_trade_rank",
+            "import_trade_rank",
+            "retrieved"]
+    df = df_trade[cols].copy()
+    df["amount"] = (df["amount"] / 10**9).round(3)
+    return _typed(df).to_dict("records")
+
+
+def region_rows(df_region):
+    return [{"regions": r} for r in df_region["regions"].unique()]
+
+
+def contains_rows(df_region):
+    cols = ["regions", "country", "country_id", "rank", "retrieved"]
+    df = df_region[cols].copy()
+    return _typed(df).to_dict("records")
+
+
+def good_rows(df_good):
+    return df_good[["mapped_good", "goods"]].to_dict("records")
+
+
+def trade_good_rows(df_trade_good):
+    cols = ["goods", "mapped_good", "country", "country_id", "rank", "year", "retrieved"]
+    # goods without a category can never match a good node
+    mask = df_trade_good["mapped_good"].notnull()
+    df = df_trade_good.loc[mask, cols].copy()
+    df["country"] = df["country"].astype(object)
+    return _typed(df).to_dict("records")
+
+
+def add_content_hashes(rows):
+    """
+    Adds a content_hash of every row's values.  It is stored on the node or
+    edge so later runs can tell what changed (see neo4j_sync).  The retrieved
+    date is left out, a new scrape of the same figures is not a change.
+    """
+    for row in rows:
+        di = {k: v for k, v in row.items() if k != "retrieved"}
+        text = json.dumps(di, sort_keys=True, default=str)
+        row["content_hash"] = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    return rows
+
+
+def build_datasets(df_country, df_trade, df_region, df_good, df_exp_good,
+                   df_imp_good):
+    """
+    Returns (stage, cql, rows, key columns) for every data set in upload
+    order.  Nodes come before the edges that MATCH on them.  The key columns
+    identify a node or edge, everything else is a property.
+    """
+    datasets = [("COUNTRY nodes", CQL_COUNTRY, country_rows(df_country),
+                 ["country"]),
+                ("TRADES edges", CQL_TRADES, trade_rows(df_trade),
+                 ["exports", "imports"]),
+                ("REGION nodes", CQL_REGION, region_rows(df_region),
+                 ["regions"]),
+                ("CONTAINS edges", CQL_CONTAINS, contains_rows(df_region),
+                 ["regions", "country"]),
+                ("GOOD nodes", CQL_GOOD, good_rows(df_good),
+                 ["mapped_good"]),
+                ("EXPORTS edges", CQL_EXPORTS, trade_good_rows(df_exp_good),
+                 ["country", "mapped_good", "goods"]),
+                ("IMPORTS edges", CQL_IMPORTS, trade_good_rows(df_imp_good),
+                 ["country", "mapped_good", "goods"])
+                ]
+    for _, _, rows, _ in datasets:
+        add_content_hashes(rows)
+    return datasets
+
+
+# ==============================================================================
+def upload_batches(graph, cql, rows, batch_size=1000):
+    """
+    Sends rows to Neo4j in batches of batch_size, one transaction per batch.
+    Returns the number of batches sent.
+    """
+    n_batches = 0
+    for start in range(0, len(rows), batch_size):
+        tx = graph.begin()
+        tx.run(cql, rows=rows[start:start + batch_size])
+        graph.commit(tx)
+        n_batches += 1
+    return n_batches
+
+
+def upload_all(graph, df_country, df_trade, df_region, df_good, df_exp_good,
+               df_imp_good, batch_size=1000):
+    """
+    Uploads every node and edge data set.  Nodes are loaded before the edges
+    that MATCH on them.  Returns the timing report, one dict per stage.
+    """
+    datasets = build_datasets(df_country, df_trade, df_region, df_good,
+                              df_exp_good, df_imp_good)
+
+    report = []
+    for stage, cql, rows, _ in datasets:
+        print("Uploading {} to Neo4j".format(stage))
+        start = time.perf_counter()
+        n_batches = upload_batches(graph, cql, rows, batch_size=batch_size)
+        seconds = time.perf_counter() - start
+        report.append({"stage": stage,
+                       "rows": len(rows),
+                       "batches": n_batches,
+                       "seconds": seconds})
+    return report
+
+
+def print_report(report):
+    print("{:<16}{:>8}{:>9}{:>10}{:>12}".format(
+        "stage", "rows", "batches", "seconds", "rows/sec"))
+    for di in report:
+        rate = di["rows"] / di["seconds"] if di["seconds"] > 0 else 0
+        print("{:<16}{:>8}{:>9}{:>10.2f}{:>12.0f}".format(
+            di["stage"], di["rows"], di["batches"], di["seconds"], rate))
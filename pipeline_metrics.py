@@ -0,0 +1,162 @@
+"""
+Per-stage timing and throughput for scrape_cia and preprocess_upload_neo4j.
+
+A RunMetrics records for every stage of a run the wall time, rows processed,
+bytes fetched, Neo4j round trips and peak memory, and writes it as a JSON run
+report.  The peak memory of a stage is the peak of the python allocations
+while it ran (tracemalloc), the peak RSS is the peak of the whole process so
+far and only grows from one stage to the next.  One stage can be run under
+cProfile and dumped for snakeviz/pstats.
+
+    metrics = RunMetrics("scrape", profile_stage="parse Exports")
+    metrics.start("fetch")
+    ...
+    metrics.count(bytes=len(content))
+    metrics.start("parse Exports")     # ends the fetch stage
+    ...
+    metrics.finish()
+    metrics.write_report(Path("output", "run_report_scrape.json"))
+"""
+import cProfile
+import datetime
+import json
+import time
+import tracemalloc
+
+from pathlib2 import Path
+
+try:
+    # not available on windows
+    import resource
+except ImportError:
+    resource = None
+
+
+def _peak_rss_mb():
+    # peak of the process since it started, not of the running stage
+    if resource is None:
+        return None
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class RunMetrics:
+    def __init__(self, name, profile_stage=None, profile_dir="output",
+                 trace_memory=True):
+        self.name = name
+        self.profile_stage = profile_stage
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.started = datetime.datetime.now()
+        self.stages = []
+        self._current = None
+        self._start_time = None
+        self._profiler = None
+
+        # tracemalloc gives the peak of python allocations per stage, it slows
+        # allocations down so trace_memory=False when only timing matters
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def start(self, stage):
+        # ends the running stage, if any, and starts the next one
+        self.finish()
+        self._current = {"stage": stage,
+                         "seconds": 0.0,
+                         "rows": 0,
+                         "bytes": 0,
+                         "round_trips": 0}
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        if stage == self.profile_stage:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._start_time = time.perf_counter()
+
+    def count(self, rows=0, bytes=0, round_trips=0):
+        if self._current is None:
+            return
+        self._current["rows"] += rows
+        self._current["bytes"] += bytes
+        self._current["round_trips"] += round_trips
+
+    def finish(self):
+        if self._current is None:
+            return
+        di = self._current
+        di["seconds"] = time.perf_counter() - self._start_time
+        di["rows_per_second"] = di["rows"] / di["seconds"] if di["seconds"] > 0 else 0
+        if self.trace_memory:
+            di["peak_alloc_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        di["process_peak_rss_mb"] = _peak_rss_mb()
+
+        if self._profiler is not None:
+            self._profiler.disable()
+            f_name = "profile_{}_{}.prof".format(self.name, di["stage"].replace(" ", "_"))
+            f_profile = Path(self.profile_dir, f_name)
+            self._profiler.dump_stats(str(f_profile))
+            di["profile"] = str(f_profile)
+            self._profiler = None
+
+        self.stages.append(di)
+        self._current = None
+
+    def report(self):
+        return {"run": self.name,
+                "started": self.started.isoformat(timespec="seconds"),
+                "total_seconds": sum(di["seconds"] for di in self.stages),
+                "stages": self.stages}
+
+    def write_report(self, f_report):
+        self.finish()
+        with open(f_report, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def print_report(self):
+        self.finish()
+        print("{:<28}{:>9}{:>9}{:>12}{:>8}{:>10}{:>16}".format(
+            "stage", "seconds", "rows", "bytes", "trips", "peak MB", "process peak MB"))
+        for di in self.stages:
+            peak = "{:.1f}".format(di["peak_alloc_mb"]) if "peak_alloc_mb" in di else "-"
+            print("{:<28}{:>9.2f}{:>9}{:>12}{:>8}{:>10}{:>16.1f}".format(
+                di["stage"], di["seconds"], di["rows"], di["bytes"],
+                di["round_trips"], peak, di["process_peak_rss_mb"] or 0))
+
+
+class CountingGraph:
+    """
+    Wraps a py2neo Graph and counts every call that goes to the database as a
+    round trip of the running stage.
+    """
+
+    def __init__(self, graph, metrics):
+        self._graph = graph
+        self._metrics = metrics
+
+    def run(self, *args, **kwargs):
+        self._metrics.count(round_trips=1)
+        return self._graph.run(*args, **kwargs)
+
+    def begin(self, *args, **kwargs):
+        return CountingTransaction(self._graph.begin(*args, **kwargs),
+                                   self._metrics)
+
+    def commit(self, tx):
+        self._metrics.count(round_trips=1)
+        return self._graph.commit(getattr(tx, "_tx", tx))
+
+    def __getattr__(self, name):
+        return getattr(self._graph, name)
+
+
+class CountingTransaction:
+    def __init__(self, tx, metrics):
+        self._tx = tx
+        self._metrics = metrics
+
+    def run(self, *args, **kwargs):
+        self._metrics.count(round_trips=1)
+        return self._tx.run(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._tx, name)
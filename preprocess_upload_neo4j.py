@@ -12,9 +12,28 @@ exported to:
 """
 import pandas as pd
 from pathlib2 import Path
-from getpass import getpass
-import py2neo
-from json import dumps
+import neo4j_bulk_import
+import neo4j_upload
+import neo4j_parallel_upload
+import neo4j_schema
+import table_store
+import pipeline_metrics
+import neo4j_sync
+import country_registry
+import goods_normalizer
+import gds_ranking
+import trade_stream
+import trade_analytics
+import stage_dag
+import trade_reconcile
+import neo4j_config
+
+
+# Tables read from the output folder, see table_store.SCHEMAS
+TABLES = ["exports", "exports_goods", "exports_partners",
+          "imports", "imports_goods", "imports_partners",
+          "gdp", "real_gdp", "real_gdp_per_capita",
+          "population", "goods_grouping", "country_region"]
 
 
 # ==============================================================================
@@ -25,154 +44,143 @@ from json import dumps
 # ==============================================================================
 
 
-def main():
-    # Output files
-    f_out_country  = Path("output", "article_page_rank_countries.csv")
-    f_out_trade    = Path("output", "trade_partners.csv")
+def latest_by_country(di_metrics, key="country"):
+    """
+    Takes {metric name: DataFrame with key (country or country_id), year and
+    amount} and returns one row per key with amount_<metric> and
+    year_<metric> for the latest year of every metric.
+    """
+    # one long table of (key, metric, year, amount)
+    cols = [key, "year", "amount"]
+    df_long = pd.concat([df[cols].astype({"year": float}).assign(metric=name)
+                         for name, df in di_metrics.items()],
+                        ignore_index=True)
+
+    # rows without a year are only used when a country has nothing else
+    year = df_long["year"].fillna(-1)
+    idx = year.groupby([df_long[key], df_long["metric"]]).idxmax()
+    df_wide = df_long.loc[idx].pivot(index=key,
+                                     columns="metric",
+                                     values=["amount", "year"])
+
+    cols = [(value, name) for name in di_metrics for value in ["amount", "year"]]
+    df_wide = df_wide[cols].astype(float)
+    df_wide.columns = [value + "_" + name for value, name in cols]
+    return df_wide.reset_index()
+
+
+def read_tables(folder="output", skip=()):
+    """
+    Reads every table produced by scrape_cia.py (and goods_grouping) and
+    returns {table name: DataFrame}.  Tables in skip are returned empty.
+    """
+    # With the exception of goods_grouping the tables are obtained by running
+    # scrape_cia.py.  goods_grouping.csv was created by myself.
+    # The types come from the schemas in table_store.  Parquet is read when
+    # scrape_cia wrote it, otherwise the csv.
+    return {name: table_store.read_table(name, folder=folder) if name not in skip
+            else table_store.apply_schema(pd.DataFrame(columns=list(table_store.SCHEMAS[name])),
+                                          table_store.SCHEMAS[name])
+            for name in TABLES}
 
-    # Erase all existing data
-    erase_existing_neo4j = True
 
-    # default Neo4j host
-    url = "bolt://localhost:7687"
-    username = input("Username: ")
-    print("\n")
-    password = getpass()
+def with_country_ids(df, registry, cols=("country",)):
+    # the Factbook name and the registry id (<col>_id) of every country column
+    df = df.copy()
+    for col in cols:
+        df[col] = registry.canonical(df[col])
+        df[col + "_id"] = registry.resolve(df[col])
+    return df
 
-    graph = py2neo.Graph(url, auth=(username, password))
 
-    # Check the existing constraints
-    current_constraints = str(graph.run("""SHOW constraints"""))
-
-    if "['country']   | ['name']" not in current_constraints:
-        graph.run("""CREATE CONSTRAINT FOR (n:country) REQUIRE n.name IS NODE KEY""")
-
-    if "['region']    | ['name']" not in current_constraints:
-        graph.run("""CREATE CONSTRAINT FOR (n:region) REQUIRE n.name IS NODE KEY""")
-
-    if "['good']      | ['name']" not in current_constraints:
-        graph.run("""CREATE CONSTRAINT FOR (n:good) REQUIRE n.name IS NODE KEY""")
-
-    # deletes the existing database
-    if erase_existing_neo4j:
-        graph.run("""MATCH (n) DETACH DELETE n""")
-
-    print("DB connected to and conditions verified")
-    # List of files.  With the exception of goods_grouping the rest are obtained
-    # by running scrape_cia.py
-    # goods_grouping.csv was created by myself
-    f_exports = Path("output", "exports.csv")
-    f_exports_goods = Path("output", "exports_goods.csv")
-    f_exports_partners = Path("output", "exports_partners.csv")
-
-    f_imports = Path("output", "imports.csv")
-    f_imports_goods = Path("output", "imports_goods.csv")
-    f_imports_partners = Path("output", "imports_partners.csv")
-
-    f_gdp = Path("output", "gdp.csv")
-    f_gdp_capita = Path("output", "gdp_per_capita.csv")
-    f_real_gdp = Path("output", "real_gdp.csv")
-    f_real_gdp_capita = Path("output", "real_gdp_per_capita.csv")
-
-    f_goods_group = Path("output", "goods_grouping.csv")
-    f_pop = Path("output", "population.csv")
-    f_region = Path("output", "country_region.csv")
-
-    # Automatic data types works but I've had some bad experiences so I like to
-    # manually specify.  Retrieved is not used as a date so not parsing
-    di_types = {"link": str,
-                "country": str,
-                "amount": float,
-                "note": str,
-                "year": float,
-                "trade_country": str,
-                "percentage": float,
-                "trade_type": str,
-                "goods": str,
-                "mapped_good": str,
-                "rank": int,
-                "population": float,
-                "regions": str,
-                "retrieved": str
-                }
-    df_exp = pd.read_csv(f_exports, dtype=di_types)
-    df_exp_good = pd.read_csv(f_exports_goods, dtype=di_types)
-    df_exp_part = pd.read_csv(f_exports_partners, dtype=di_types)
-
-    df_imp = pd.read_csv(f_imports, dtype=di_types)
-    df_imp_good = pd.read_csv(f_imports_goods, dtype=di_types)
-    df_imp_part = pd.read_csv(f_imports_partners, dtype=di_types)
-
-    df_gdp = pd.read_csv(f_gdp, dtype=di_types)
-    df_real_gdp = pd.read_csv(f_real_gdp, dtype=di_types)
-    df_real_gdp_capita = pd.read_csv(f_real_gdp_capita, dtype=di_types)
-
-    df_pop = pd.read_csv(f_pop, dtype=str)
-    df_goods_group = pd.read_csv(f_goods_group, dtype=str)
-    df_region = pd.read_csv(f_region, dtype=di_types)
+# latest amount and year of these metrics go into the country table
+METRICS = ["exports", "imports", "gdp", "real_gdp", "real_gdp_per_capita"]
 
-    print("Files read")
 
-    # Preproccessing
+# ==============================================================================
+# Preprocessing stages, see PREPROCESS_STAGES.  Module level functions so they
+# can run in other processes.
+
+def stage_latest(df_exp, df_imp, df_gdp, df_real_gdp, df_real_gdp_capita, registry):
+    # latest amount and year of every metric per country
+    di_metrics = dict(zip(METRICS, [df_exp, df_imp, df_gdp, df_real_gdp, df_real_gdp_capita]))
+    di_metrics = {name: with_country_ids(df, registry) for name, df in di_metrics.items()}
+    # countries that are not in the registry can't be joined on
+    di_metrics = {name: df.loc[df["country_id"].notnull()] for name, df in di_metrics.items()}
+    return latest_by_country(di_metrics, key="country_id")
+
+
+def stage_country(df_region, df_pop, df_latest, registry):
     # Creating the country table
+    df_region = with_country_ids(df_region, registry)
+    df_pop = with_country_ids(df_pop, registry)
     df_country = df_region.loc[df_region["rank"] == 0].copy()
     df_country = df_country.reset_index(drop=True)
 
-    cols = ["country", "population", "year"]
-    df_country = pd.merge(df_country, df_pop[cols], on="country", how="left")
+    cols = ["country_id", "population", "year"]
+    df_pop = df_pop.loc[df_pop["country_id"].notnull()]
+    df_country = pd.merge(df_country, df_pop[cols], on="country_id", how="left")
 
     df_country.rename(columns={"year": "year_population"}, inplace=True)
     df_country["year_population"].fillna(1970, inplace=True)
     df_country["population"].fillna(0, inplace=True)
 
-    pairs = [(df_exp, "exports"),
-             (df_imp, "imports"),
-             (df_gdp, "gdp"),
-             (df_real_gdp, "real_gdp"),
-             (df_real_gdp_capita, "real_gdp_per_capita")
-           ]
-    for df_frame, name in pairs:
-        di = {"amount": "amount_" + name,
-              "year": "year_" + name}
-        cols = ["country"] + list(di.values())
-        df_foo = df_frame.copy()
-        df_foo.sort_values("year", ascending=False, inplace=True)
-        df_foo.drop_duplicates("country", inplace=True)
-        df_foo.rename(columns=di, inplace=True)
-        df_country = pd.merge(df_country, df_foo[cols], on="country", how="left")
-        df_country[di["amount"]].fillna(0, inplace=True)
-        df_country[di["year"]].fillna(1970, inplace=True)
+    df_country = pd.merge(df_country, df_latest, on="country_id", how="left")
+    for name in METRICS:
+        df_country["amount_" + name].fillna(0, inplace=True)
+        df_country["year_" + name].fillna(1970, inplace=True)
+    return df_country
 
 
-    # Creating a trade data set, this will act as the edges and combine both
-    # imports and exports
-    # estimates for the most recent year
+def stage_region(df_region, registry):
     cols = ["regions", "country"]
-    df_region = df_region.drop_duplicates(cols, keep="first").reset_index(drop=True)
+    df_region = with_country_ids(df_region, registry)
+    return df_region.drop_duplicates(cols, keep="first").reset_index(drop=True)
 
-    df_exp_good["year"].fillna(1970, inplace=True)
-    df_imp_good["year"].fillna(1970, inplace=True)
 
-    df_exp_good = pd.merge(df_exp_good, df_goods_group, how="left", on="goods")
-    df_imp_good = pd.merge(df_imp_good, df_goods_group, how="left", on="goods")
+def stage_trade_goods(df_goods, df_goods_group, registry):
+    # exports_goods or imports_goods with the goods category
+    df_goods = with_country_ids(df_goods, registry)
+    df_goods["year"].fillna(1970, inplace=True)
+    # new spellings are matched on their words, see goods_normalizer
+    df_goods["mapped_good"] = goods_normalizer.GoodsNormalizer(df_goods_group).map(df_goods["goods"])
+    # names as categoricals in id order, they repeat a lot
+    df_goods["country"] = registry.categorical(df_goods["country"])
+    return df_goods
 
-    df_exp.sort_values("year", ascending=False, inplace=True)
-    df_foo_exp = df_exp.drop_duplicates("country", keep="first").copy()
 
-    df_exp_part = pd.merge(df_exp_part, df_foo_exp[["country", "amount"]], how="left", on="country")
-    df_exp_part["amount"] = df_exp_part["amount"] * df_exp_part["percentage"]
-    di_foo = {"country": "exports", "trade_country": "imports"}
-    df_exp_part.rename(columns=di_foo, inplace=True)
+def stage_good(df_exp_good, df_imp_good):
+    cols = ["goods", "mapped_good"]
+    df_good = pd.concat([df_exp_good[cols], df_imp_good[cols]], ignore_index=True)
+    df_good = df_good.groupby("mapped_good")["goods"].unique().apply(list)
+    return df_good.reset_index()
 
-    df_imp.sort_values("year", ascending=False, inplace=True)
-    df_foo_imp = df_imp.drop_duplicates("country", keep="first").copy()
 
-    df_imp_part = pd.merge(df_imp_part, df_foo_imp[["country", "amount"]], how="left", on="country")
-    df_imp_part["amount"] = df_imp_part["amount"] * df_imp_part["percentage"]
+def stage_partners(df_part, df_latest, registry, trade_type):
+    """
+    The trades of a partners table with the amount, a share of the latest
+    exports or imports total of the reporting country.
+    """
+    df_part = with_country_ids(df_part, registry, cols=["country", "trade_country"])
+    # the partner amounts use the same latest totals as the country table
+    df_foo = df_latest[["country_id", "amount_" + trade_type]].rename(
+        columns={"amount_" + trade_type: "amount"})
+
+    df_part = pd.merge(df_part, df_foo, how="left", on="country_id")
+    df_part["amount"] = df_part["amount"] * df_part["percentage"]
+    other = "imports" if trade_type == "exports" else "exports"
+    di_foo = {"country": trade_type, "trade_country": other,
+              "country_id": trade_type + "_id", "trade_country_id": other + "_id"}
+    return df_part.rename(columns=di_foo)
 
-    di_foo = {"country": "imports", "trade_country": "exports"}
-    df_imp_part.rename(columns=di_foo, inplace=True)
 
+def stage_trade(df_exp_part, df_imp_part, df_country, registry, reconcile=None):
+    # Creating a trade data set, this will act as the edges and combine both
+    # imports and exports
+    # estimates for the most recent year
+    # With reconcile (keyword arguments of trade_reconcile.reconcile) the
+    # amounts of both reports are combined and balanced with the country
+    # totals instead of keeping the larger one
     df_trade = pd.concat([df_exp_part, df_imp_part], ignore_index=True, sort=False)
     # Some extra comma's in the formatting CIA's web page causing issues
     mask = df_trade["imports"].notnull() & df_trade["exports"].notnull()
@@ -180,6 +188,11 @@ def main():
 
     df_trade.sort_values(["year", "amount", "trade_type"], ascending=[False, False, True], inplace=True)
     df_trade.drop_duplicates(["imports", "exports"], inplace=True)
+    if reconcile is not None:
+        amount = trade_reconcile.reconcile(df_exp_part, df_imp_part, df_country, **reconcile)
+        known = (df_trade["exports_id"].notnull() & df_trade["imports_id"].notnull()).to_numpy()
+        df_trade.loc[known, "amount"] = amount[df_trade.loc[known, "exports_id"].to_numpy(dtype=int),
+                                               df_trade.loc[known, "imports_id"].to_numpy(dtype=int)]
     df_trade["amount"].fillna(0, inplace=True)
     df_trade["export_trade_rank"] = df_trade.groupby("exports")["amount"].rank("min", ascending=False)
     df_trade["import_trade_rank"] = df_trade.groupby("imports")["amount"].rank("min", ascending=False)
@@ -191,275 +204,335 @@ def main():
     # importing country.  Will redo that with the percentage of exporting and
     # importing
     df_trade.drop("percentage", axis=1, inplace=True)
-    di_exp = dict(zip(df_country["country"], df_country["amount_exports"]))
-    di_imp = dict(zip(df_country["country"], df_country["amount_imports"]))
+    di_exp = dict(zip(df_country["country_id"], df_country["amount_exports"]))
+    di_imp = dict(zip(df_country["country_id"], df_country["amount_imports"]))
 
-    df_trade["percentage_exports"] = df_trade["amount"] / df_trade["exports"].map(di_exp)
+    df_trade["percentage_exports"] = df_trade["amount"] / df_trade["exports_id"].map(di_exp).astype(float)
     df_trade["percentage_exports"].fillna(0, inplace=True)
 
-    df_trade["percentage_imports"] = df_trade["amount"] / df_trade["imports"].map(di_imp)
+    df_trade["percentage_imports"] = df_trade["amount"] / df_trade["imports_id"].map(di_imp).astype(float)
     df_trade["percentage_imports"].fillna(0, inplace=True)
 
+    # names as categoricals in id order, they repeat a lot
+    for col in ["exports", "imports"]:
+        df_trade[col] = registry.categorical(df_trade[col])
+    return df_trade
+
+
+# {output: (function, inputs, keyword arguments)}, the inputs are tables of
+# read_tables, the registry or outputs of other stages.  The stages without a
+# path between them can run at the same time.
+PREPROCESS_STAGES = {
+    "df_latest": stage_dag.Stage(stage_latest, ["exports", "imports", "gdp", "real_gdp",
+                                                "real_gdp_per_capita", "registry"], {}),
+    "df_country": stage_dag.Stage(stage_country, ["country_region", "population",
+                                                  "df_latest", "registry"], {}),
+    "df_region": stage_dag.Stage(stage_region, ["country_region", "registry"], {}),
+    "df_exp_good": stage_dag.Stage(stage_trade_goods, ["exports_goods", "goods_grouping",
+                                                       "registry"], {}),
+    "df_imp_good": stage_dag.Stage(stage_trade_goods, ["imports_goods", "goods_grouping",
+                                                       "registry"], {}),
+    "df_good": stage_dag.Stage(stage_good, ["df_exp_good", "df_imp_good"], {}),
+    "df_exp_part": stage_dag.Stage(stage_partners, ["exports_partners", "df_latest", "registry"],
+                                   {"trade_type": "exports"}),
+    "df_imp_part": stage_dag.Stage(stage_partners, ["imports_partners", "df_latest", "registry"],
+                                   {"trade_type": "imports"}),
+    "df_trade": stage_dag.Stage(stage_trade, ["df_exp_part", "df_imp_part", "df_country",
+                                              "registry"], {}),
+}
+
+OUTPUTS = ["df_country", "df_trade", "df_region", "df_good", "df_exp_good", "df_imp_good"]
+
+
+def run_preprocess(di_raw, registry=None, parallel=False, max_workers=None, reconcile=None):
+    """
+    preprocess with the report of stage_dag.run_stages.  With parallel the
+    stages run in a process pool of max_workers processes.
+    """
+    if registry is None:
+        registry = country_registry.CountryRegistry()
+    # registered before the stages so every process has the same ids
+    registry.update(di_raw["country_region"])
 
-    # Goods
-    cols = ["goods", "mapped_good"]
-    df_good = pd.concat([df_exp_good[cols], df_imp_good[cols]], ignore_index=True)
-    df_good = df_good.groupby("mapped_good")["goods"].unique().apply(list)
-    df_good = df_good.reset_index()
-
-    print("Files preprocessed and uploading to Neo4j")
-    # ==========================================================================
-    # Upload data sets to Neo4j
-    # If you upload the csv into the folder associated with the neo4j project
-    # it is faster but given the relative small scale of this project I've
-    # elected to upload manually.
-
-    print("Uploading COUNTRY nodes to Neo4j")
-    # upload node countries
-    for row in df_country.index:
-        cols = ["link",
-                "country",
-                "amount_exports",
-                "year_exports",
-                "amount_imports",
-                "year_imports",
-                "regions",
-                "retrieved",
-                "amount_gdp",
-                "year_gdp",
-                "amount_real_gdp",
-                "year_real_gdp",
-                "amount_real_gdp_per_capita",
-                "population",
-                "year_population"]
-        foo = df_country.loc[row, cols]
-        di = dict(zip(foo.index, foo.values))
-        cql = """
-                MERGE (n:country
-                        {{name: "{country}",
-                          link: "{link}",
-                          amount_export: {amount_export},
-                          year_export: {yr_export},
-                          amount_import: {amount_import},
-                          year_import: {yr_import},
-                          primary_region: "{region}",
-                          gdp: {gdp},
-                          year_gdp: {yr_gdp},
-                          real_gdp: {real_gdp},
-                          real_gdp_per_capita: {real_gdp_capita},
-                          year_real_gdp: {yr_real_gdp},
-                          population: {pop},
-                          year_population: {yr_pop},
-                          date_retrieved: TIMESTAMP("{retrieved}")
-                }}
-                )
-        """.format(
-                   country=di["country"],
-                   link=di["link"].strip("/"),
-                   amount_export=round(di["amount_exports"] / 1000000000, 3),
-                   yr_export=di["year_exports"],
-                   amount_import=round(di["amount_imports"] / 1000000000, 3),
-                   yr_import=di["year_imports"],
-                   region=di["regions"],
-                   gdp=round(di["amount_gdp"] / 1000000000, 3),
-                   yr_gdp=di["year_gdp"],
-                   real_gdp=round(di["amount_real_gdp"] / 1000000000, 3),
-                   real_gdp_capita=di["amount_real_gdp_per_capita"],
-                   yr_real_gdp=di["year_real_gdp"],
-                   pop=di["population"],
-                   yr_pop=di["year_population"],
-                   retrieved=di["retrieved"]
-                   )
-        graph.run(cql)
-
-    print("Uploading TRADES edges to Neo4j")
-    # Upload edges trade amounts
-    for row in df_trade.index:
-        cols = ["exports",
-                "imports",
-                "percentage_exports",
-                "percentage_imports",
-                "year",
-                "amount",
-                "trade_type",
-                "export_trade_rank",
-                "import_trade_rank",
-                "retrieved"]
-        foo = df_trade.loc[row, cols]
-        di = dict(zip(foo.index, foo.values))
-
-        cql = """
-                MATCH (n:country {{name: "{src_country}"}}), (m:country {{name: "{dest_country}"}})
-                MERGE (n)-[e:trades {{amount: {amount}, year:{year}, percentage_exports: {percent_exp}, percentage_imports: {percent_imp}, export_trade_rank: {export_rank}, import_trade_rank: {import_rank}, trade_source: "{trade_type}", retrieved: TIMESTAMP("{retrieved}")}}]->(m)
-        """.format(src_country=di["exports"],
-                   dest_country=di["imports"],
-                   amount=round(di["amount"] / 1000000000, 3),
-                   year=di["year"],
-                   percent_exp=di["percentage_exports"],
-                   percent_imp=di["percentage_imports"],
-                   trade_type=di["trade_type"],
-                   export_rank=di["export_trade_rank"],
-                   import_rank=di["import_trade_rank"],
-                   retrieved=di["retrieved"]
-                   )
-        graph.run(cql)
-
-    print("Uploading REGION nodes to Neo4j")
-    # upload node regions
-    for r in df_region["regions"].unique():
-        cql = """
-                MERGE (n:region
-                        {{name: "{region}"
-                }}
-                )
-        """.format(region=r)
-        graph.run(cql)
-
-    print("Uploading CONTAINS edges to Neo4j")
-    # upload edge located in
-    for row in df_region.index:
-        cols = ["regions",
-                "country",
-                "rank",
-                "retrieved"]
-        foo = df_region.loc[row, cols]
-        di = dict(zip(foo.index, foo.values))
-
-        cql = """
-                MATCH (n:region {{name: "{region}"}}), (m:country {{name: "{country}"}})
-                MERGE (n)-[e:contains {{rank: {rank}, retrieved: TIMESTAMP("{retrieved}")}}]->(m)
-        """.format(region=di["regions"],
-                   country=["country"],
-                   rank=di["rank"],
-                   retrieved=di["retrieved"]
-                   )
-        graph.run(cql)
-
-    print("Uploading GOOD nodes to Neo4j")
-    # uploading goods
-    for row in df_good.index:
-        mapped_good, goods = df_good.loc[row, ["mapped_good", "goods"]]
-        cql = """
-                MERGE (n:good {{name: "{mapped_good}", sub_goods: {goods}}})""".format(
-                    mapped_good=mapped_good,
-                    goods=goods)
-        graph.run(cql)
-
-    print("Uploading EXPORTS edges to Neo4j")
-    # uploading goods to exports
-    for row in df_exp_good.index:
-        cols = ["goods",
-                "mapped_good",
-                "country",
-                "rank",
-                "year",
-                "retrieved"]
-        foo = df_exp_good.loc[row, cols]
-        di = dict(zip(foo.index, foo.values))
-        cql = """
-                MATCH (g:good {{name: "{mapped_good}"}}), (c:country {{name: "{country}"}})
-                MERGE (c)-[e:exports {{rank: {rank}, year: {year}, sub_good: "{good}", retrieved: TIMESTAMP("{retrieved}")}}]->(g)
-        """.format(mapped_good=di["mapped_good"],
-                   good=di["goods"],
-                   country=di["country"],
-                   rank=di["rank"],
-                   year=di["year"],
-                   retrieved=di["retrieved"]
-                   )
-        graph.run(cql)
-
-    print("Uploading IMPORTS edges to Neo4j")
-    # uploading goods to imports
-    for row in df_imp_good.index:
-        cols = ["goods",
-                "mapped_good",
-                "country",
-                "rank",
-                "year",
-                "retrieved"]
-        foo = df_imp_good.loc[row, cols]
-        di = dict(zip(foo.index, foo.values))
-
-        # MERGE is giving a few errors, need to solve that.  CREATE will throw an
-        # error if the node exists
-        cql = """
-                MATCH (g:good {{name: "{mapped_good}"}}), (c:country {{name: "{country}"}})
-                MERGE (g)-[e:imports {{rank: {rank}, year: {year}, sub_good: "{good}", retrieved: TIMESTAMP("{retrieved}")}}]->(c)
-        """.format(mapped_good=di["mapped_good"],
-                   good=di["goods"],
-                   country=di["country"],
-                   rank=di["rank"],
-                   year=di["year"],
-                   retrieved=di["retrieved"]
-                   )
-        graph.run(cql)
-
-    print("Nodes and Edges uploaded")
-    # ==============================================================================
-    # Page Rank
-    print("Calculating pageRank")
-    cql_config = """CALL gds.graph.project(
-      'myGraph',
-      'country',
-      'trades',
-      {
-        relationshipProperties: 'amount'
-      }
-    )"""
-    graph.run(cql_config)
-
-    # Not needed since not that big but good practice to check
-    cql = """CALL gds.pageRank.write.estimate('myGraph', {
-      writeProperty: 'pageRank',
-      maxIterations: 20,
-      dampingFactor: 0.85
-    })
-    YIELD nodeCount, relationshipCount, bytesMin, bytesMax, requiredMemory"""
-    foo = graph.run(cql)
-
-    # add PageRank
-    cql = """
-    CALL gds.pageRank.mutate('myGraph', {
-      maxIterations: 20,
-      dampingFactor: 0.85,
-      mutateProperty: 'pagerank'
-    })
-    YIELD nodePropertiesWritten, ranIterations
+    stages = PREPROCESS_STAGES
+    if reconcile is not None:
+        stages = dict(stages, df_trade=stages["df_trade"]._replace(kwargs={"reconcile": reconcile}))
+    values, report = stage_dag.run_stages(stages, dict(di_raw, registry=registry),
+                                          parallel=parallel, max_workers=max_workers)
+    return {name: values[name] for name in OUTPUTS}, report
+
+
+def preprocess(di_raw, registry=None, reconcile=None):
     """
-    page_scores = graph.run(cql)
-
-    # writing PageRank
-    cql = """CALL gds.pageRank.write('myGraph', {
-      maxIterations: 20,
-      dampingFactor: 0.85,
-      writeProperty: 'pagerank'
-    })
-    YIELD nodePropertiesWritten, ranIterations"""
-    graph.run(cql)
-
-    print("Calculating articleRank")
-    # Writing ArticleRank
-    cql = """CALL gds.articleRank.write('myGraph', {
-      writeProperty: 'articlerank'
-    })
-    YIELD nodePropertiesWritten, ranIterations
+    Cleans and combines the tables from read_tables into the node and edge
+    tables.  Returns {"df_country", "df_trade", "df_region", "df_good",
+    "df_exp_good", "df_imp_good"}, the keyword arguments of the uploaders.
+    Country names are resolved with the registry (a new one when not given)
+    and the tables are joined on the country ids.  reconcile, see
+    stage_trade.
     """
-    graph.run(cql)
+    return run_preprocess(di_raw, registry, reconcile=reconcile)[0]
 
-    # Get the pageranks
-    cql = """MATCH (n:country)
-           RETURN n.name AS country, n.pagerank AS page_rank, n.articlerank AS article_rank"""
-    page_ranks = dumps(graph.run(cql).data())
-    df_foo = pd.DataFrame(eval(page_ranks))
 
-    df_country = pd.merge(df_country, df_foo, how="left")
+STAGES = ["preprocess", "upload", "rank", "export"]
 
-    print("Exporting Files")
-    # Exports
-    df_country.sort_values("page_rank", ascending=False, inplace=True)
-    df_country.to_csv(f_out_country, index=False)
 
-    df_trade.to_csv(f_out_trade, index=False)
+def connect(url, username, password, metrics=None):
+    # py2neo is only imported by the stages that talk to Neo4j
+    import py2neo
+    graph = py2neo.Graph(url, auth=(username, password))
+    if metrics is None:
+        return graph
+    # counts every call to Neo4j as a round trip of the running stage
+    return pipeline_metrics.CountingGraph(graph, metrics)
+
+
+def run(stages=STAGES, url="bolt://localhost:7687", username=None, password=None,
+        erase_existing_neo4j=True, incremental_sync=False, load_csv_import_dir=None,
+        stream_trades=False, stream_source="tables", chunksize=10000,
+        parallel_preprocess=False, max_workers=None,
+        batch_size=1000, upload_workers=None, reconcile_trades=False, mirror_weight=0.5,
+        rank_engine="gds",
+        gds_algorithms=gds_ranking.DEFAULT_ALGORITHMS, folder="output", metrics=None):
+    """
+    Runs the stages of STAGES that are given, see main for the options.  The
+    tables are always read and preprocessed, the rest only for its stage:
+
+        preprocess  the country registry and output/unmapped_goods.csv
+        upload      the nodes and edges to Neo4j
+        rank        pageRank and articleRank (and gds_algorithms) into
+                    output/article_page_rank_countries.csv
+        export      output/trade_partners.csv and the analytics tables, with
+                    the ranks of the last rank stage when it isn't run
+    """
+    f_out_country  = Path(folder, "article_page_rank_countries.csv")
+    f_out_trade    = Path(folder, "trade_partners.csv")
+    f_out_unmapped = Path(folder, "unmapped_goods.csv")
+    if metrics is None:
+        metrics = pipeline_metrics.RunMetrics("preprocess", profile_stage=None)
+    if stream_trades & reconcile_trades & ("upload" in stages):
+        # the streamed edges never see both partner tables at once
+        raise ValueError("reconcile_trades needs the whole partner tables, "
+                         "it can't be combined with stream_trades")
+
+    graph = None
+    if ("upload" in stages) or (("rank" in stages) and (rank_engine != "local")):
+        metrics.start("connect")
+        graph = connect(url, username, password, metrics)
+
+    if "upload" in stages:
+        # Constraints and indexes, see neo4j_schema.SCHEMA.  The node keys are
+        # needed by the upload, the secondary indexes are built after it.
+        schema = neo4j_schema.SchemaManager(graph)
+        created = schema.ensure()
+
+        # deletes the existing database
+        if erase_existing_neo4j & (not incremental_sync):
+            schema.drop_deferred()
+            graph.run("""MATCH (n) DETACH DELETE n""")
+
+        print("DB connected to and conditions verified")
+    else:
+        # only the batched upload streams the trades edges
+        stream_trades = False
+
+    metrics.start("read")
+    # the partner tables are streamed in the preprocess stage
+    partner_tables = ["exports_partners", "imports_partners"]
+    di_raw = read_tables(folder, skip=partner_tables if stream_trades else ())
+    metrics.count(rows=sum(len(df) for df in di_raw.values()))
+    print("Files read")
+
+    metrics.start("preprocess")
+    # country ids are kept between runs in output/country_registry.csv
+    f_registry = Path(folder, "country_registry.csv")
+    registry = country_registry.read_registry(f_registry)
+    reconcile = {"weight": mirror_weight} if reconcile_trades else None
+    di_tables, dag_report = run_preprocess(di_raw, registry, parallel=parallel_preprocess,
+                                           max_workers=max_workers, reconcile=reconcile)
+    registry.save(f_registry)
+    stage_dag.print_report(dag_report)
+    # goods that goods_grouping.csv doesn't cover yet
+    df_unmapped = goods_normalizer.unmapped_report(
+        goods_normalizer.GoodsNormalizer(di_raw["goods_grouping"]),
+        {"exports": di_tables["df_exp_good"], "imports": di_tables["df_imp_good"]})
+    df_unmapped.to_csv(f_out_unmapped, index=False)
+    if len(df_unmapped) > 0:
+        n_phrase = (df_unmapped["matched_by"] == "phrase").sum()
+        print("{} goods without a category and {} found by a phrase, see {}".format(
+            len(df_unmapped) - n_phrase, n_phrase, f_out_unmapped))
+    df_country = di_tables["df_country"]
+    df_trade = di_tables["df_trade"]
+
+    if stream_trades:
+        # the same latest totals preprocess uses for the partner amounts
+        di_metrics = {name: with_country_ids(di_raw[name], registry) for name in ["exports", "imports"]}
+        df_latest = latest_by_country({name: df.loc[df["country_id"].notnull()]
+                                       for name, df in di_metrics.items()})
+        builder = trade_stream.TradeEdgeBuilder(trade_stream.CountryIndex(df_latest, df_country),
+                                                registry=registry)
+        cache = None
+        if stream_source == "pages":
+            # the field pages of the last scrape however old they are, the
+            # scraping stack is only needed here
+            import fetch_cia
+            cache = fetch_cia.ResponseCache(Path("cache"), offline=True)
+        # exports partners first, ties between the two go to exports
+        for name in partner_tables:
+            for df in trade_stream.partner_chunks(name, folder=folder, cache=cache,
+                                                  chunksize=chunksize):
+                builder.add(df)
+                metrics.count(rows=len(df))
+        if incremental_sync | (load_csv_import_dir is not None) | (upload_workers is not None):
+            di_tables["df_trade"] = df_trade = builder.frame()
+
+    metrics.count(rows=len(df_country) + len(df_trade) + len(di_tables["df_good"]))
+
+    if "upload" in stages:
+        print("Files preprocessed and uploading to Neo4j")
+        metrics.start("upload")
+        # ======================================================================
+        # Upload data sets to Neo4j
+        # If you upload the csv into the folder associated with the neo4j
+        # project it is faster but given the relative small scale of this
+        # project I've elected to upload in parameterized batches by default.
+        if incremental_sync:
+            report = neo4j_sync.sync_all(graph, batch_size=batch_size, **di_tables)
+            neo4j_sync.print_report(report)
+        elif load_csv_import_dir is not None:
+            datasets = neo4j_upload.build_datasets(**di_tables)
+            report = neo4j_bulk_import.load_csv_import(graph, datasets, load_csv_import_dir)
+            neo4j_upload.print_report(report)
+        elif upload_workers is not None:
+            report, workers = neo4j_parallel_upload.upload_parallel(
+                lambda: connect(url, username, password),
+                max_workers=upload_workers, batch_size=batch_size, **di_tables)
+            neo4j_upload.print_report(report)
+            neo4j_parallel_upload.print_workers(workers)
+            # the workers don't go through the counting graph, a batch is a run and a commit
+            metrics.count(round_trips=2 * sum(di["batches"] + di["retries"] for di in workers))
+        else:
+            report = neo4j_upload.upload_all(graph, batch_size=batch_size, **di_tables)
+            if stream_trades:
+                # df_trade was empty, the edges come from the builder in batches
+                report[1] = trade_stream.upload_trades(graph, builder, batch_size=batch_size)
+            neo4j_upload.print_report(report)
+
+        metrics.count(rows=sum(di.get("rows", di.get("inserts", 0) + di.get("updates", 0)
+                                  + di.get("deletes", 0)) for di in report))
+        created += schema.ensure(deferred=True)
+        schema.await_indexes()
+        if len(created) > 0:
+            print("Created {}".format(", ".join(created)))
+        print("Nodes and Edges uploaded")
+
+    if "rank" in stages:
+        metrics.start("rank")
+        # ======================================================================
+        # Page Rank
+        # "gds" runs the ranking in Neo4j, "local" computes the same ranks with
+        # local_rank without needing the GDS plugin
+        if rank_engine == "local":
+            # scipy is only needed here
+            import local_rank
+            print("Calculating pageRank and articleRank locally")
+            df_foo = local_rank.rank_countries(df_country,
+                                               builder.edges() if stream_trades else df_trade)
+        else:
+            df_foo = gds_ranking.rank(graph, algorithms=gds_algorithms)
+
+        df_country = pd.merge(df_country, df_foo, how="left")
+        df_country.sort_values("page_rank", ascending=False, inplace=True)
+        df_country.to_csv(f_out_country, index=False)
+        metrics.count(rows=len(df_foo))
+    elif "export" in stages:
+        # the ranks of the last run of the rank stage
+        df_foo = pd.read_csv(f_out_country)
+        df_foo = df_foo[["country"] + [c for c in df_foo.columns if c not in df_country.columns]]
+        df_country = pd.merge(df_country, df_foo, how="left")
+        df_country.sort_values("page_rank", ascending=False, inplace=True)
+
+    if "export" in stages:
+        print("Exporting Files")
+        metrics.start("export")
+        # Exports
+        if stream_trades:
+            n_trade = builder.to_csv(f_out_trade)
+        else:
+            df_trade.to_csv(f_out_trade, index=False)
+            n_trade = len(df_trade)
+        metrics.count(rows=n_trade)
+
+        # analytics tables so routine questions don't need Neo4j, see
+        # trade_analytics.AnalyticsStore.  Streamed edges are taken in batches.
+        metrics.start("analytics")
+        di_analytics = trade_analytics.build_tables(df_country,
+                                                    builder.batches(chunksize) if stream_trades else df_trade,
+                                                    di_tables["df_exp_good"],
+                                                    di_tables["df_imp_good"])
+        trade_analytics.write_tables(di_analytics, folder=Path(folder, "analytics"))
+        metrics.count(rows=sum(len(df) for df in di_analytics.values()))
+    metrics.finish()
+    return metrics
+
+
+def main():
+    # Erase all existing data
+    erase_existing_neo4j = True
+    # Only send what changed since the last upload instead of erasing and
+    # uploading everything.  Takes precedence over erase_existing_neo4j.
+    incremental_sync = False
+    # Cold load with LOAD CSV instead of batches: set to the import folder of
+    # the Neo4j database, the node and relationship files are written there.
+    # Only for an empty graph, so erase_existing_neo4j should be set.
+    # (neo4j_bulk_import.py can also build the database with neo4j-admin)
+    load_csv_import_dir = None
+    # Build the trades edges from the partner tables in chunks of chunksize
+    # rows instead of one DataFrame, memory stays flat as the tables grow.
+    # The batched upload streams the edges, the other modes still need them all.
+    # stream_source "pages" parses the partners straight from the field pages
+    # of the last scrape in cache/ instead of reading the tables.
+    stream_trades = False
+    stream_source = "tables"
+    chunksize = 10000
+    # Run the independent preprocessing stages in a process pool, max_workers
+    # None uses one process per cpu.  The stage times and the critical path
+    # are printed either way.
+    parallel_preprocess = False
+    max_workers = None
+    # Number of rows sent to Neo4j per transaction
+    batch_size = 1000
+    # Upload over this many Bolt sessions at the same time (nodes first, then
+    # the edges partitioned by country), None uses the single session upload
+    upload_workers = None
+    # Combine the exporter's and the importer's report of a trade and balance
+    # them with the country totals (trade_reconcile.py) instead of keeping the
+    # larger one.  mirror_weight is the share of the exporter's report.
+    reconcile_trades = False
+    mirror_weight = 0.5
+    # Where pageRank and articleRank are computed, "gds" or "local"
+    rank_engine = "gds"
+    # centralities computed by GDS in the same pass, names of
+    # gds_ranking.ALGORITHMS, e.g. add "betweenness" or "louvain"
+    gds_algorithms = gds_ranking.DEFAULT_ALGORITHMS
+    # Timings per stage are written to the run report.  Set profile_stage to
+    # a stage name (e.g. "preprocess") to get a cProfile dump of it.
+    f_run_report = Path("output", "run_report_preprocess.json")
+    metrics = pipeline_metrics.RunMetrics("preprocess", profile_stage=None)
+
+    # NEO4J_URL, NEO4J_USERNAME and NEO4J_PASSWORD or factbook.ini, what is
+    # missing is asked for
+    url, username, password = neo4j_config.credentials(prompt=True)
+
+    run(STAGES, url=url, username=username, password=password,
+        erase_existing_neo4j=erase_existing_neo4j, incremental_sync=incremental_sync,
+        load_csv_import_dir=load_csv_import_dir, stream_trades=stream_trades,
+        stream_source=stream_source, chunksize=chunksize, parallel_preprocess=parallel_preprocess,
+        max_workers=max_workers, batch_size=batch_size, upload_workers=upload_workers,
+        reconcile_trades=reconcile_trades, mirror_weight=mirror_weight, rank_engine=rank_engine, gds_algorithms=gds_algorithms, metrics=metrics)
+
+    metrics.print_report()
+    metrics.write_report(f_run_report)
 
 
 if __name__=="__main__":
@@ -1,9 +1,25 @@
 import pandas as pd
-import requests
 import re
-from bs4 import BeautifulSoup
+import lxml.html
+from collections import namedtuple
 from pathlib2 import Path
 import datetime
+import fetch_cia
+import table_store
+import country_registry
+import pipeline_metrics
+
+
+# One country block on a field page.  lines are the stripped, non empty text
+# lines of the block, the first one being the country name.
+FieldRecord = namedtuple("FieldRecord", ["link", "country", "lines"])
+
+# every country on a field page is in a <div class="pb30 ...">
+PB30_XPATH = "//div[contains(concat(' ', normalize-space(@class), ' '), ' pb30 ')]"
+# text of a block, comments and scripts are not part of the text
+TEXT_XPATH = ".//text()[not(parent::script) and not(parent::style)]"
+# the Factbook is served as utf-8
+HTML_PARSER = lxml.html.HTMLParser(encoding="utf-8")
 
 
 def exports_p_parser(input):
@@ -19,206 +35,197 @@ def exports_p_parser(input):
     return amounts, note
 
 
-def currency_converter(input):
-    if not(bool(re.match(r"^\$\d+", input))):
-        return None
-
-    di = {"million":  10**6,
-          "billion":  10**9,
-          "trillion": 10**12}
-
-    input = input.strip("$")
-    items = input.split(" ")
+def field_records(content, skip_links):
+    """
+    Parses a field page once and yields a FieldRecord for every country block
+    whose link points to a country page not in skip_links.
+    """
+    tree = lxml.html.document_fromstring(content, parser=HTML_PARSER)
+    for div in tree.xpath(PB30_XPATH):
+        a = next(div.iter("a"), None)
+        link = "" if a is None else a.get("href", "")
 
+        process = (("/the-world-factbook/countries" in link)
+                 & (link not in skip_links))
+        if process:
+            text = [t.strip() for t in div.xpath(TEXT_XPATH)]
+            lines = "\n".join([t for t in text if t != ""]).splitlines()
+            yield FieldRecord(link, a.text_content(), lines)
+
+
+def page_records(content, skip_links):
+    """
+    The FieldRecords of a field page, or content itself when it already is
+    FieldRecords (taken from the country pages by crawl_cia).
+    """
+    if isinstance(content, (bytes, str)):
+        return field_records(content, skip_links)
+    return (rec for rec in content if rec.link not in skip_links)
+
+
+# Field value patterns.  Each one is applied to a whole column at once with
+# .str.extract instead of running a python function per row.
+#
+# Amounts look like "$1.476 billion (2020 est.)".  The amount and unit are only
+# read when the value starts with $<digit>.  The year is the 4 digits after the
+# first " (", anything else (foot notes) has no year.
+AMOUNT_RE = re.compile(r"^(?=(?:\$(?P<amount>\d[^ ]*) (?P<unit>[^ ]*))?)"
+                       r"(?:(?! \().)*(?: \((?P<year>\d{4}))?")
+# Partners look like "China 45%"
+PARTNER_RE = re.compile(r"^(?P<trade_country>.*) (?P<percentage>\d+(?:\.\d+)?)%$")
+
+UNIT_MULTIPLIER = {"million":  10**6,
+                   "billion":  10**9,
+                   "trillion": 10**12}
+
+
+def parse_amounts(s):
+    """
+    Splits a column of Factbook amount strings into float amounts (in dollars)
+    and the 4 digit year as a string.
+    """
+    df = s.str.extract(AMOUNT_RE)
     # it is possible for the full amount to be written.  To solve this we will
-    # will replace the commas and if the second value is invalid it will multiply
-    # by 1.
+    # will replace the commas and if the unit is invalid it will multiply by 1.
     # e.g. $2,732,370,000,000 (2020 est.)
-    amount = items[0].replace(",", "")
-    return str(float(amount) * di.get(items[1], 1))
+    amount = pd.to_numeric(df["amount"].str.replace(",", "", regex=False),
+                           errors="coerce")
+    multiplier = df["unit"].map(UNIT_MULTIPLIER).fillna(1)
+    df["amount"] = amount * multiplier
+    return df[["amount", "year"]]
+
+
+def parse_partners(s):
+    """
+    Splits a column of "country 45%" strings into the trade country and the
+    percentage as a fraction.  Values without a percentage are left as is.
+    """
+    df = s.str.extract(PARTNER_RE)
+    df["trade_country"] = df["trade_country"].str.strip().fillna(s)
+    df["percentage"] = df["percentage"].astype(float) / 100
 
+    # almost entirely is used in some cases, I'll be defining that as 90%
+    mask = df["trade_country"].str.contains("almost entirely", regex=False, na=False)
+    df.loc[mask, "percentage"] = 0.9
+    df.loc[mask, "trade_country"] = (df.loc[mask, "trade_country"]
+                                     .str.replace("almost entirely", "", regex=False)
+                                     .str.strip())
+    return df
 
-def import_export_get(url, f_name, skip_links, country_fixes):
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, 'lxml')
 
+def import_export_get(content, f_name, skip_links, country_fixes,
+                      folder="output", retrieved=None):
     outputs = []
-    for div in soup.findAll("div", {"class": "pb30"}):
+    for rec in page_records(content, skip_links):
         di_out = {}
-        try:
-            link = div.find("a").get("href")
-        except:
-            link = ""
-
-        process = (("/the-world-factbook/countries" in link)
-                 & (link not in skip_links))
-        if process:
-            di_out["link"] = link
-            di_out["country"] = div.find("a").text
-            amounts = div.get_text(strip=True, separator="\n").splitlines()[1:]
-            amounts = [a.strip() for a in amounts if a.strip() != ""]
-            amounts = [a for a in amounts if bool(re.search(r"\(\d{4}.+\)", a))]
-            di_out["amount"] = amounts
-            outputs.append(di_out)
+        di_out["link"] = rec.link
+        di_out["country"] = rec.country
+        amounts = [a.strip() for a in rec.lines[1:] if a.strip() != ""]
+        amounts = [a for a in amounts if bool(re.search(r"\(\d{4}.+\)", a))]
+        di_out["amount"] = amounts
+        outputs.append(di_out)
 
     df = pd.DataFrame(outputs)
 
-    mask = df["country"].isin(list(country_fixes.keys()))
-    df.loc[mask, "country"] = df.loc[mask, "country"].map(country_fixes)
+    df["country"] = country_registry.fix_names(df["country"], country_fixes)
 
     df = df.explode("amount").reset_index(drop=True)
-    df["amount"].fillna("", inplace=True)
-    df["year"] = df["amount"].apply(lambda x: x.split(" (", 1)[-1][:4])
-    # some foot notes are being recorded, removing empty years
-    mask = df["year"].str.contains("\d{4}", regex=True)
-    df.loc[~mask, "year"] = None
-
-    # Originally the currency converter changed data types but for future
-    # compatibility that has been taken out.
-    mask = df["amount"] != ""
-    df.loc[mask, "amount"] = df.loc[mask, "amount"].map(currency_converter)
-    df.loc[~mask, "amount"] = None
-    df["amount"] = df["amount"].astype(float)
-
-    df["retrieved"] = datetime.datetime.now()
+    # some foot notes are being recorded, those get an empty year
+    df[["amount", "year"]] = parse_amounts(df["amount"].fillna(""))
+
+    df["retrieved"] = pd.Timestamp(retrieved or datetime.datetime.now())
     # just because it is the CIA I will remove the exact time :P
     df["retrieved"] = df["retrieved"].dt.date
-    export_file = Path("output", f_name)
-    df.to_csv(export_file, index=False)
-
+    return table_store.write_table(df, Path(f_name).stem, folder=folder)
 
-def partners(url, trade_type, f_name, skip_links, country_fixes):
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, 'lxml')
 
-    outputs = []
-    for div in soup.findAll("div", {"class", "pb30"}):
-        di_out = {}
-        try:
-            link = div.find("a").get("href")
-        except:
-            link = ""
-
-        process = (("/the-world-factbook/countries" in link)
-                 & (link not in skip_links))
-        if process:
-            di_out["link"] = link
-            di_out["country"] = div.find("a").text
-            # t for text
-            # sometimes a bold or other wrapper appears combining the items in the list
-            t = div.get_text(strip=True, separator="\n").splitlines()[1:]
-            t = " ".join(t)
-            # occasionally get a trailing ,
-            t = re.sub(r",\s+\(", " (", t)
-            di_out["year"] = t.rsplit("(", 1)[-1][:4]
-            di_out["trade_country"] = [c.strip() for c in t.rsplit("(", 1)[0].split(",")]
-            outputs.append(di_out)
+def partner_records(content, skip_links):
+    """
+    Yields one dict per country and trade partner of a partners field page,
+    the partner still as the raw "country 45%" text.
+    """
+    for rec in page_records(content, skip_links):
+        # t for text
+        # sometimes a bold or other wrapper appears combining the items in the list
+        t = " ".join(rec.lines[1:])
+        # occasionally get a trailing ,
+        t = re.sub(r",\s+\(", " (", t)
+        year = t.rsplit("(", 1)[-1][:4]
+        for c in t.rsplit("(", 1)[0].split(","):
+            yield {"link": rec.link,
+                   "country": rec.country,
+                   "year": year,
+                   "trade_country": c.strip()}
 
-    df = pd.DataFrame(outputs)
-    df = df.explode("trade_country").reset_index(drop=True)
-    mask = df["trade_country"].str.contains("%")
-    df.loc[mask, "percentage"] = df.loc[mask, "trade_country"].apply(
-        lambda x: float(re.search("\d+%$", x)[0][:-1])/100)
-    df.loc[mask, "trade_country"] = df.loc[mask, "trade_country"].apply(
-        lambda x: x.rsplit(" ", 1)[0]).str.strip()
 
-    # almost entirely is used in some cases, I'll be defining that as 90%
-    mask = df["trade_country"].str.contains("almost entirely")
-    df.loc[mask, "percentage"] = 0.9
-    df.loc[mask, "trade_country"] = df.loc[mask, "trade_country"].apply(
-        lambda x: re.sub("almost entirely", "", x).strip())
+def partner_frame(records, trade_type, country_fixes, retrieved=None):
+    # turns partner_records (or a chunk of them) into the partners table
+    df = pd.DataFrame(list(records), columns=["link", "country", "year", "trade_country"])
+    df[["trade_country", "percentage"]] = parse_partners(df["trade_country"])
 
-    mask = df["country"].isin(list(country_fixes.keys()))
-    df.loc[mask, "country"] = df.loc[mask, "country"].map(country_fixes)
+    df["country"] = country_registry.fix_names(df["country"], country_fixes)
 
-    mask = df["trade_country"].isin(list(country_fixes.keys()))
-    df.loc[mask, "trade_country"] = df.loc[mask, "trade_country"].map(country_fixes)
+    df["trade_country"] = country_registry.fix_names(df["trade_country"], country_fixes)
 
     df["trade_type"] = trade_type
-    df["retrieved"] = datetime.datetime.now()
+    df["retrieved"] = pd.Timestamp(retrieved or datetime.datetime.now())
     # just because it is the CIA I will remove the exact time :P
     df["retrieved"] = df["retrieved"].dt.date
+    return df
 
-    export_file = Path("output", f_name)
-    df.to_csv(export_file, index=False)
 
+def partners(content, trade_type, f_name, skip_links, country_fixes,
+             folder="output", retrieved=None):
+    df = partner_frame(partner_records(content, skip_links), trade_type,
+                       country_fixes, retrieved=retrieved)
+    return table_store.write_table(df, Path(f_name).stem, folder=folder)
 
-def region(url, f_name, skip_links, country_fixes):
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, 'lxml')
 
+def region(content, f_name, skip_links, country_fixes,
+           folder="output", retrieved=None):
     outputs = []
-    for div in soup.findAll("div", {"class", "pb30"}):
-        try:
-            link = div.find("a").get("href")
-        except:
-            link = ""
-
-        process = (("/the-world-factbook/countries" in link)
-                 & (link not in skip_links))
-        if process:
-            country = div.get_text(strip=True, separator="\n").splitlines()[0]
-            # France has a few region no other countries in multiple regions
-            if country=="France":
-                list_regions = div.get_text(strip=True, separator="\n").splitlines()[1:]
-                list_regions = [r.strip(";").strip() for r in list_regions if ";" in r]
-            else:
-                list_regions = [div.get_text(strip=True, separator="\n").splitlines()[1]]
-
-            df_foo = pd.DataFrame()
-            df_foo["regions"] = list_regions
-            df_foo["country"] = country
-            df_foo["link"] = link
-            df_foo["rank"] = df_foo.index
+    for rec in page_records(content, skip_links):
+        country = rec.lines[0]
+        # France has a few region no other countries in multiple regions
+        if country=="France":
+            list_regions = [r.strip(";").strip() for r in rec.lines[1:] if ";" in r]
+        else:
+            list_regions = [rec.lines[1]]
+
+        for rank, r in enumerate(list_regions):
+            outputs.append({"regions": r,
+                            "country": country,
+                            "link": rec.link,
+                            "rank": rank})
 
-            outputs.append(df_foo)
-            del df_foo
-
-    df = pd.concat(outputs, ignore_index=True, sort=False)
+    df = pd.DataFrame(outputs)
 
-    mask = df["country"].isin(list(country_fixes.keys()))
-    df.loc[mask, "country"] = df.loc[mask, "country"].map(country_fixes)
+    df["country"] = country_registry.fix_names(df["country"], country_fixes)
 
-    df["retrieved"] = datetime.datetime.now()
+    df["retrieved"] = pd.Timestamp(retrieved or datetime.datetime.now())
     # just because it is the CIA I will remove the exact time :P
     df["retrieved"] = df["retrieved"].dt.date
-    export_file = Path("output", f_name)
-    df.to_csv(export_file, index=False)
+    return table_store.write_table(df, Path(f_name).stem, folder=folder)
 
 
-def trade_goods(url, trade_type, f_name, skip_links, country_fixes):
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, 'lxml')
-
+def trade_goods(content, trade_type, f_name, skip_links, country_fixes,
+                folder="output", retrieved=None):
     outputs = []
+    for rec in page_records(content, skip_links):
+        goods = rec.lines[1].strip()
+        year = goods.rsplit("(", 1)[-1].split(")")[0]
+        goods = [g.strip() for g in goods.rsplit("(")[0].split(",")]
+
+        for rank, g in enumerate(goods, start=1):
+            outputs.append({"goods": g,
+                            "country": rec.country,
+                            "link": rec.link,
+                            "year": year,
+                            "rank": rank})
 
-    for div in soup.findAll("div", {"class", "pb30"}):
-        try:
-            link = div.find("a").get("href")
-        except:
-            link = ""
-
-        process = (("/the-world-factbook/countries" in link)
-                 & (link not in skip_links))
-        if process:
-
-            goods = div.get_text(strip=True, separator="\n").splitlines()[1].strip()
-            year = goods.rsplit("(", 1)[-1].split(")")[0]
-            goods = [g.strip() for g in goods.rsplit("(")[0].split(",")]
-
-            df_foo = pd.DataFrame()
-            df_foo["goods"] = goods
-            df_foo["country"] = div.find("a").text
-            df_foo["link"] = link
-            df_foo["year"] = year
-            df_foo["rank"] = df_foo.index + 1
-
-            outputs.append(df_foo)
-
-    df = pd.concat(outputs, ignore_index=True, sort=False)
+    df = pd.DataFrame(outputs)
 
-    mask = df["country"].isin(list(country_fixes.keys()))
-    df.loc[mask, "country"] = df.loc[mask, "country"].map(country_fixes)
+    df["country"] = country_registry.fix_names(df["country"], country_fixes)
 
     df["trade_type"] = trade_type
 
@@ -227,173 +234,150 @@ def trade_goods(url, trade_type, f_name, skip_links, country_fixes):
     mask = df["year"].str.contains("^\d{4}$")
     df.loc[~mask, "year"] = ""
 
-    df["retrieved"] = datetime.datetime.now()
+    df["retrieved"] = pd.Timestamp(retrieved or datetime.datetime.now())
     # just because it is the CIA I will remove the exact time :P
     df["retrieved"] = df["retrieved"].dt.date
 
-    export_file = Path("output", f_name)
-    df.to_csv(export_file, index=False)
+    return table_store.write_table(df, Path(f_name).stem, folder=folder)
 
 
-def population(url, f_name, skip_links, country_fixes):
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, 'lxml')
-
+def population(content, f_name, skip_links, country_fixes,
+               folder="output", retrieved=None):
     outputs = []
-
-    for div in soup.findAll("div", {"class", "pb30"}):
-        try:
-            link = div.find("a").get("href")
-        except:
-            link = ""
-        process = (("/the-world-factbook/countries" in link)
-                 & (link not in skip_links))
-
-        if process:
-
-            t = div.get_text(strip=True, separator="\n").splitlines()[1:]
-            t = " ".join(t)
-            matches = re.findall(r"[\d,]+", t)
-            di = {"country": div.find("a").text}
-            if len(matches) > 0:
-                # Most of the countries follow the same format but not all.
-                # Akrotiri, Dhekelia
-                # This works well with the noteable exceptions of:
-                    # French Southern and Antarctic Islands
-                    # South Georgia and South Sandwich Islands
-                    # United States Pacific Island Wildlife Refuges
-                # Given the small size of those it will not be fixed this
-                # version
-                get_pop  = True
-                get_year = True
-                while (len(matches) > 0) & get_year:
-                    if get_pop:
-                        # always be 4 characters while that is impossible for
-                        # a population number
-                        if len(matches[0]) != 4:
-                            di["population"] = matches[0].replace(",","")
-                            get_pop = False
-                    elif get_year:
-                        if len(matches[0]) == 4:
-                            di["year"] = matches[0]
-                            get_year = False
-                    matches = matches[1:]
-
-            outputs.append(di)
+    for rec in page_records(content, skip_links):
+        t = " ".join(rec.lines[1:])
+        matches = re.findall(r"[\d,]+", t)
+        di = {"country": rec.country}
+        if len(matches) > 0:
+            # Most of the countries follow the same format but not all.
+            # Akrotiri, Dhekelia
+            # This works well with the noteable exceptions of:
+                # French Southern and Antarctic Islands
+                # South Georgia and South Sandwich Islands
+                # United States Pacific Island Wildlife Refuges
+            # Given the small size of those it will not be fixed this
+            # version
+            get_pop  = True
+            get_year = True
+            while (len(matches) > 0) & get_year:
+                if get_pop:
+                    # always be 4 characters while that is impossible for
+                    # a population number
+                    if len(matches[0]) != 4:
+                        di["population"] = matches[0].replace(",","")
+                        get_pop = False
+                elif get_year:
+                    if len(matches[0]) == 4:
+                        di["year"] = matches[0]
+                        get_year = False
+                matches = matches[1:]
+
+        outputs.append(di)
 
     df = pd.DataFrame(outputs)
 
-    mask = df["country"].isin(list(country_fixes.keys()))
-    df.loc[mask, "country"] = df.loc[mask, "country"].map(country_fixes)
+    df["country"] = country_registry.fix_names(df["country"], country_fixes)
 
-    df["retrieved"] = datetime.datetime.now()
+    df["retrieved"] = pd.Timestamp(retrieved or datetime.datetime.now())
     # just because it is the CIA I will remove the exact time :P
     df["retrieved"] = df["retrieved"].dt.date
 
-    export_file = Path("output", f_name)
-    df.to_csv(export_file, index=False)
-
-
-def main():
-    skip_links = ["/the-world-factbook/countries/",
-                  "/the-world-factbook/countries/world",
-                  "/the-world-factbook/countries/european-union",
-                  "/the-world-factbook/countries/antarctica"
-                    ]
-
-    # some of the countries are not standardized or wrong
-    di_country_name = {"Korea, South": "South Korea",
-                       "Korea, North": "North Korea",
-                       "US": "United States",
-                       "Untied States": "United States" # my personal favorite
-                        }
-
-    url_exports = "https://www.cia.gov/the-world-factbook/field/exports"
-    url_exports_partners = "https://www.cia.gov/the-world-factbook/field/exports-partners/"
-    url_exports_commodities = "https://www.cia.gov/the-world-factbook/field/exports-commodities/"
-
-    url_imports = "https://www.cia.gov/the-world-factbook/field/imports"
-    url_imports_partners = "https://www.cia.gov/the-world-factbook/field/imports-partners/"
-    url_imports_commodities = "https://www.cia.gov/the-world-factbook/field/imports-commodities/"
-
-    url_gdp = "https://www.cia.gov/the-world-factbook/field/gdp-official-exchange-rate/"
-    url_gdp_real = "https://www.cia.gov/the-world-factbook/field/real-gdp-purchasing-power-parity/"
-    url_gdp_real_capita = "https://www.cia.gov/the-world-factbook/field/real-gdp-per-capita/"
-    # no longer in use
-    # url_gdp_capita = "https://www.cia.gov/the-world-factbook/field/gdp-per-capita/"
-
-    url_population = "https://www.cia.gov/the-world-factbook/field/population"
-    url_map_references = "https://www.cia.gov/the-world-factbook/field/map-references"
+    return table_store.write_table(df, Path(f_name).stem, folder=folder)
+
+
+SKIP_LINKS = ["/the-world-factbook/countries/",
+              "/the-world-factbook/countries/world",
+              "/the-world-factbook/countries/european-union",
+              "/the-world-factbook/countries/antarctica"
+              ]
+
+# some of the countries are not standardized or wrong
+COUNTRY_FIXES = country_registry.ALIASES
+
+URL_EXPORTS = "https://www.cia.gov/the-world-factbook/field/exports"
+URL_EXPORTS_PARTNERS = "https://www.cia.gov/the-world-factbook/field/exports-partners/"
+URL_EXPORTS_COMMODITIES = "https://www.cia.gov/the-world-factbook/field/exports-commodities/"
+
+URL_IMPORTS = "https://www.cia.gov/the-world-factbook/field/imports"
+URL_IMPORTS_PARTNERS = "https://www.cia.gov/the-world-factbook/field/imports-partners/"
+URL_IMPORTS_COMMODITIES = "https://www.cia.gov/the-world-factbook/field/imports-commodities/"
+
+URL_GDP = "https://www.cia.gov/the-world-factbook/field/gdp-official-exchange-rate/"
+URL_GDP_REAL = "https://www.cia.gov/the-world-factbook/field/real-gdp-purchasing-power-parity/"
+URL_GDP_REAL_CAPITA = "https://www.cia.gov/the-world-factbook/field/real-gdp-per-capita/"
+# no longer in use
+# URL_GDP_CAPITA = "https://www.cia.gov/the-world-factbook/field/gdp-per-capita/"
+
+URL_POPULATION = "https://www.cia.gov/the-world-factbook/field/population"
+URL_MAP_REFERENCES = "https://www.cia.gov/the-world-factbook/field/map-references"
+
+# (progress label, url, parser, parser arguments)
+JOBS = [("Exports", URL_EXPORTS, import_export_get,
+         {"f_name": "exports.csv"}),
+        ("Exports goods", URL_EXPORTS_COMMODITIES, trade_goods,
+         {"trade_type": "exports", "f_name": "exports_goods.csv"}),
+        ("Exports partners", URL_EXPORTS_PARTNERS, partners,
+         {"trade_type": "exports", "f_name": "exports_partners.csv"}),
+        ("Imports", URL_IMPORTS, import_export_get,
+         {"f_name": "imports.csv"}),
+        ("Imports goods", URL_IMPORTS_COMMODITIES, trade_goods,
+         {"trade_type": "imports", "f_name": "imports_goods.csv"}),
+        ("Imports partners", URL_IMPORTS_PARTNERS, partners,
+         {"trade_type": "imports", "f_name": "imports_partners.csv"}),
+        ("GDP", URL_GDP, import_export_get,
+         {"f_name": "gdp.csv"}),
+        # ("GDP per capita", URL_GDP_CAPITA, import_export_get,
+        #  {"f_name": "gdp_per_capita.csv"}),
+        ("Real GDP", URL_GDP_REAL, import_export_get,
+         {"f_name": "real_gdp.csv"}),
+        ("Real GDP per capita", URL_GDP_REAL_CAPITA, import_export_get,
+         {"f_name": "real_gdp_per_capita.csv"}),
+        ("Population", URL_POPULATION, population,
+         {"f_name": "population.csv"}),
+        ("Regions", URL_MAP_REFERENCES, region,
+         {"f_name": "country_region.csv"})
+        ]
+
+
+def main(offline=False):
+    # Raw pages are kept in cache/ so reruns and parser development don't
+    # need to download everything again.  Offline only uses the cache.
+    cache = fetch_cia.ResponseCache(Path("cache"),
+                                    ttl=24 * 60 * 60,
+                                    offline=offline)
+
+    # Timings per stage are written to the run report.  Set profile_stage to
+    # a stage name (e.g. "parse Exports") to get a cProfile dump of it.
+    f_run_report = Path("output", "run_report_scrape.json")
+    metrics = pipeline_metrics.RunMetrics("scrape", profile_stage=None)
+
+    # all of the pages are downloaded at once, the parsing is done afterwards
+    metrics.start("fetch")
+    di_content = fetch_cia.fetch_all([url for _, url, _, _ in JOBS],
+                                     cache=cache)
+    metrics.count(rows=len(di_content),
+                  bytes=sum(len(c) for c in di_content.values() if c is not None))
 
     # good type still needs to be done
-    print("Exports")
-    import_export_get(url=url_exports,
-                      f_name="exports.csv",
-                      skip_links=skip_links,
-                      country_fixes=di_country_name)
-    print("Exports goods")
-    trade_goods(url=url_exports_commodities,
-                trade_type="exports",
-                f_name="exports_goods.csv",
-                skip_links=skip_links,
-                country_fixes=di_country_name)
-    print("Exports partners")
-    partners(url=url_exports_partners,
-             trade_type="exports",
-             f_name="exports_partners.csv",
-             skip_links=skip_links,
-             country_fixes=di_country_name)
-
-    print("Imports")
-    import_export_get(url=url_imports,
-                      f_name="imports.csv",
-                      skip_links=skip_links,
-                      country_fixes=di_country_name)
-    print("Imports goods")
-    trade_goods(url=url_imports_commodities,
-                trade_type="imports",
-                f_name="imports_goods.csv",
-                skip_links=skip_links,
-                country_fixes=di_country_name)
-    print("Imports partners")
-    partners(url=url_imports_partners,
-             trade_type="imports",
-             f_name="imports_partners.csv",
-             skip_links=skip_links,
-             country_fixes=di_country_name)
-
-    print("GDP")
-    import_export_get(url_gdp,
-                      f_name="gdp.csv",
-                      skip_links=skip_links,
-                      country_fixes=di_country_name)
-    # print("GDP per capita")
-    # import_export_get(url=url_gdp_capita,
-                      # f_name="gdp_per_capita.csv",
-                      # skip_links=skip_links,
-                      # country_fixes=di_country_name)
-    print("Real GDP")
-    import_export_get(url=url_gdp_real,
-                      f_name="real_gdp.csv",
-                      skip_links=skip_links,
-                      country_fixes=di_country_name)
-    print("Real GDP per capita")
-    import_export_get(url=url_gdp_real_capita,
-                      f_name="real_gdp_per_capita.csv",
-                      skip_links=skip_links,
-                      country_fixes=di_country_name)
-
-
-    print("Population")
-    population(url=url_population,
-               f_name="population.csv",
-               skip_links=skip_links,
-               country_fixes=di_country_name)
-    print("Regions")
-    region(url=url_map_references,
-           f_name="country_region.csv",
-           skip_links=skip_links,
-           country_fixes=di_country_name)
+    for label, url, parser, kwargs in JOBS:
+        print(label)
+        if di_content[url] is None:
+            print("Skipping {}, page could not be downloaded".format(label))
+            continue
+        metrics.start("parse " + label)
+        df = parser(di_content[url],
+                    skip_links=SKIP_LINKS,
+                    country_fixes=COUNTRY_FIXES,
+                    **kwargs)
+        metrics.count(rows=len(df), bytes=len(di_content[url]))
+        if parser is region:
+            # every country page gets its id in the shared registry
+            registry = country_registry.read_registry()
+            registry.update(df)
+            registry.save()
+
+    metrics.print_report()
+    metrics.write_report(f_run_report)
 
 
 if __name__=="__main__":
@@ -0,0 +1,266 @@
+"""
+Historical editions of the Factbook and a time-versioned trade graph.
+
+scrape_cia.py only sees the live Factbook.  This script parses archived
+editions from local disk, one folder per edition named by its date, with the
+field pages saved under the last part of their url:
+
+    archive/2021-06-01/exports.html
+    archive/2021-06-01/exports-partners.html
+    archive/2022-01-01/...
+
+The pages have to be in the layout of the current site (2021 onwards), which
+is what scrape_cia parses.  Pages are parsed in parallel processes and every
+edition is stored in its own folder (table_store.edition_folder).
+
+Every edition is then preprocessed on its own and the trades of all editions
+are combined into edge versions.  A version of a trades edge is valid from the
+edition where its figures first appear until the edition where they change or
+the edge disappears (valid_to is empty while it is still current).  PageRank
+and ArticleRank per edition are computed from the edges valid at that edition,
+no graph has to be rebuilt for it.
+
+Outputs:
+    output/snapshots/edition=<edition>/<table>.csv
+    output/snapshots/trades_versioned.csv
+    output/snapshots/rank_by_edition.csv
+"""
+import concurrent.futures
+
+import pandas as pd
+from pathlib2 import Path
+
+import country_registry
+import local_rank
+import neo4j_config
+import neo4j_upload
+import preprocess_upload_neo4j
+import scrape_cia
+import table_store
+
+
+# The properties of a trades edge, a change in any of them starts a new
+# version of the edge
+VERSION_COLS = ["amount",
+                "year",
+                "percentage_exports",
+                "percentage_imports",
+                "export_trade_rank",
+                "import_trade_rank",
+                "trade_type"]
+
+CQL_TRADES_VERSIONED = """
+UNWIND $rows AS row
+MATCH (n:country {country_id: row.exports_id}), (m:country {country_id: row.imports_id})
+MERGE (n)-[e:trades {valid_from: date(row.valid_from)}]->(m)
+SET e.valid_to = date(row.valid_to),
+    e.amount = row.amount,
+    e.year = row.year,
+    e.percentage_exports = row.percentage_exports,
+    e.percentage_imports = row.percentage_imports,
+    e.export_trade_rank = row.export_trade_rank,
+    e.import_trade_rank = row.import_trade_rank,
+    e.trade_source = row.trade_type
+"""
+
+def page_name(url):
+    # the file name of a field page in the archive
+    return url.rstrip("/").rsplit("/", 1)[-1] + ".html"
+
+
+def _parse_page(edition, f_page, job, folder):
+    # runs in a worker process, reads the page itself so only the path is sent
+    label, _, parser, kwargs = scrape_cia.JOBS[job]
+    with open(f_page, "rb") as f:
+        content = f.read()
+    df = parser(content,
+                skip_links=scrape_cia.SKIP_LINKS,
+                country_fixes=scrape_cia.COUNTRY_FIXES,
+                folder=table_store.edition_folder(edition, folder),
+                retrieved=pd.Timestamp(edition),
+                **kwargs)
+    return edition, label, len(df)
+
+
+def ingest_archive(archive_dir, folder="output", max_workers=None):
+    """
+    Parses the field pages of every edition in archive_dir into the edition
+    folders.  Returns the editions found.
+    """
+    editions = sorted(p.name for p in Path(archive_dir).iterdir() if p.is_dir())
+
+    tasks = []
+    for edition in editions:
+        table_store.edition_folder(edition, folder).mkdir(parents=True, exist_ok=True)
+        for job, (label, url, _, _) in enumerate(scrape_cia.JOBS):
+            f_page = Path(archive_dir, edition, page_name(url))
+            if f_page.exists():
+                tasks.append((edition, str(f_page), job))
+            else:
+                print("{}: no {} page".format(edition, label))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_parse_page, edition, f_page, job, folder)
+                   for edition, f_page, job in tasks]
+        for future in concurrent.futures.as_completed(futures):
+            edition, label, n_rows = future.result()
+            print("{}: {} {} rows".format(edition, label, n_rows))
+    return editions
+
+
+def _preprocess_edition(edition, folder, registry, reconcile=None):
+    # goods_grouping is maintained by hand and shared by all editions
+    di_raw = {}
+    for name in preprocess_upload_neo4j.TABLES:
+        f_folder = folder if name == "goods_grouping" else table_store.edition_folder(edition, folder)
+        di_raw[name] = table_store.read_table(name, folder=f_folder)
+    return edition, preprocess_upload_neo4j.preprocess(di_raw, registry, reconcile=reconcile)
+
+
+def preprocess_editions(editions, folder="output", max_workers=None, reconcile=None):
+    """
+    Returns {edition: preprocessed tables} for the editions that have every
+    table preprocess_upload_neo4j needs.  reconcile, see
+    preprocess_upload_neo4j.stage_trade.
+    """
+    complete = []
+    for edition in editions:
+        f_folder = table_store.edition_folder(edition, folder)
+        missing = [name for name in preprocess_upload_neo4j.TABLES
+                   if (name != "goods_grouping") and not Path(f_folder, name + ".csv").exists()]
+        if len(missing) > 0:
+            print("Skipping edition {}, missing {}".format(edition, ", ".join(missing)))
+        else:
+            complete.append(edition)
+
+    # every country of every edition is registered before the editions are
+    # split over the processes so a country has the same id in all of them
+    registry = country_registry.read_registry(Path(folder, "country_registry.csv"))
+    for edition in complete:
+        registry.update(table_store.read_table("country_region",
+                                               folder=table_store.edition_folder(edition, folder)))
+    registry.save(Path(folder, "country_registry.csv"))
+
+    di_editions = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for edition, di_tables in executor.map(_preprocess_edition, complete,
+                                               [folder] * len(complete),
+                                               [registry] * len(complete),
+                                               [reconcile] * len(complete)):
+            di_editions[edition] = di_tables
+    return di_editions
+
+
+def versioned_trades(di_trade):
+    """
+    Takes {edition: df_trade} and returns one row per version of a trades
+    edge with valid_from and valid_to (dates, valid_to empty while current).
+    An edge gets a new version when one of VERSION_COLS changes or when it
+    is missing from an edition in between.
+    """
+    editions = sorted(di_trade)
+    position = {edition: i for i, edition in enumerate(editions)}
+    df = pd.concat([df.assign(edition=edition) for edition, df in di_trade.items()],
+                   ignore_index=True)
+    df["_pos"] = df["edition"].map(position)
+    df["_hash"] = pd.util.hash_pandas_object(df[VERSION_COLS].astype(str), index=False)
+    df = df.sort_values(["exports", "imports", "_pos"]).reset_index(drop=True)
+
+    # a row continues the version before it if it is the same edge in the
+    # next edition with the same figures
+    previous = df.shift()
+    continues = ((df["exports"] == previous["exports"])
+                 & (df["imports"] == previous["imports"])
+                 & (df["_pos"] == previous["_pos"] + 1)
+                 & (df["_hash"] == previous["_hash"]))
+    df["_version"] = (~continues).cumsum()
+
+    last_pos = df.groupby("_version")["_pos"].max()
+    df = df.drop_duplicates("_version", keep="first").copy()
+    df["valid_from"] = pd.to_datetime(df["edition"]).dt.date
+    dates = list(pd.to_datetime(editions).date) + [None]
+    df["valid_to"] = df["_version"].map(last_pos + 1).map(lambda i: dates[i])
+    return df.drop(columns=["edition", "_pos", "_hash", "_version"]).reset_index(drop=True)
+
+
+def valid_at(df_versions, edition):
+    # the edge versions valid at the edition
+    date = pd.Timestamp(edition).date()
+    mask = ((df_versions["valid_from"] <= date)
+            & df_versions["valid_to"].map(lambda d: (d is None) or (date < d)))
+    return df_versions[mask]
+
+
+def rank_by_edition(di_country, df_versions):
+    """
+    pageRank and articleRank for every edition from the trades valid at it.
+    Takes {edition: df_country} and the output of versioned_trades.
+    """
+    frames = []
+    for edition, df_country in sorted(di_country.items()):
+        df = local_rank.rank_countries(df_country, valid_at(df_versions, edition))
+        df.insert(0, "edition", edition)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def upload_versioned(graph, di_country, df_versions, batch_size=1000):
+    """
+    Uploads every country (with its figures of the latest edition it appears
+    in) and all versions of the trades edges.
+    """
+    df_country = pd.concat([df.assign(edition=edition) for edition, df in di_country.items()],
+                           ignore_index=True)
+    df_country = df_country.sort_values("edition").drop_duplicates("country", keep="last")
+
+    rows = neo4j_upload.add_content_hashes(neo4j_upload.country_rows(df_country))
+    print("Uploading COUNTRY nodes to Neo4j")
+    neo4j_upload.upload_batches(graph, neo4j_upload.CQL_COUNTRY, rows, batch_size=batch_size)
+
+    # the rows are kept as dicts so the ids stay ints (None when unregistered)
+    rows = neo4j_upload.trade_rows(df_versions)
+    for row, valid_from, valid_to in zip(rows, df_versions["valid_from"], df_versions["valid_to"]):
+        row["valid_from"] = str(valid_from)
+        row["valid_to"] = None if valid_to is None else str(valid_to)
+    print("Uploading {} TRADES edge versions to Neo4j".format(len(rows)))
+    neo4j_upload.upload_batches(graph, CQL_TRADES_VERSIONED, rows, batch_size=batch_size)
+
+
+def main():
+    archive_dir = Path("archive")
+    # Upload the versioned graph to Neo4j as well
+    upload_neo4j = False
+    # None uses one process per cpu
+    max_workers = None
+    # balance the trades of every edition with its country totals, see
+    # trade_reconcile.py, e.g. {"weight": 0.5}
+    reconcile = None
+
+    print("Parsing editions")
+    editions = ingest_archive(archive_dir, max_workers=max_workers)
+
+    print("Preprocessing editions")
+    di_editions = preprocess_editions(editions, max_workers=max_workers, reconcile=reconcile)
+    if len(di_editions) == 0:
+        print("No complete editions in {}".format(archive_dir))
+        return
+
+    df_versions = versioned_trades({e: di["df_trade"] for e, di in di_editions.items()})
+    di_country = {e: di["df_country"] for e, di in di_editions.items()}
+    df_rank = rank_by_edition(di_country, df_versions)
+
+    f_folder = Path("output", "snapshots")
+    table_store.write_table(df_versions, "trades_versioned", folder=f_folder)
+    table_store.write_table(df_rank, "rank_by_edition", folder=f_folder)
+    print("{} editions, {} trades edge versions".format(len(di_editions), len(df_versions)))
+
+    if upload_neo4j:
+        # only needed for the upload
+        import py2neo
+        url, username, password = neo4j_config.credentials(prompt=True)
+        graph = py2neo.Graph(url, auth=(username, password))
+        upload_versioned(graph, di_country, df_versions)
+
+
+if __name__=="__main__":
+    main()
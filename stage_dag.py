@@ -0,0 +1,164 @@
+"""
+Runs a DAG of DataFrame stages, serially or in a process pool.
+
+A stage is a module level function, the names of the values it takes (raw
+tables or the outputs of other stages) and fixed keyword arguments.  Stages
+whose inputs are ready run at the same time.  Between processes DataFrames are
+sent as Arrow IPC buffers when pyarrow is installed, which is a single memory
+copy instead of pickling every python object in the frame.
+
+    stages = {"latest": Stage(stage_latest, ["exports", "imports"], {}),
+              "country": Stage(stage_country, ["country_region", "latest"], {})}
+    values, report = run_stages(stages, di_raw, parallel=True)
+    print_report(report)
+
+The report has the time of every stage and the critical path, the chain of
+dependent stages that bounds the wall time however many processes are used.
+"""
+import concurrent.futures
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+Stage = namedtuple("Stage", ["func", "inputs", "kwargs"])
+
+# a DataFrame serialized as an Arrow IPC stream
+ArrowFrame = namedtuple("ArrowFrame", ["buffer"])
+
+
+def encode(value):
+    if (pa is None) or not isinstance(value, pd.DataFrame):
+        return value
+    try:
+        table = pa.Table.from_pandas(value)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # mixed types in an object column, pickled instead
+        return value
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return ArrowFrame(sink.getvalue())
+
+
+def decode(value):
+    if not isinstance(value, ArrowFrame):
+        return value
+    df = pa.ipc.open_stream(value.buffer).read_pandas()
+    # list columns come back as numpy arrays
+    for col in df.columns:
+        if (df[col].dtype == object) and df[col].map(lambda v: isinstance(v, np.ndarray)).any():
+            df[col] = df[col].map(lambda v: list(v) if isinstance(v, np.ndarray) else v)
+    return df
+
+
+def _run_stage(func, kwargs, args):
+    # runs in a worker process
+    start = time.perf_counter()
+    result = func(*[decode(a) for a in args], **kwargs)
+    return encode(result), time.perf_counter() - start
+
+
+def _order(stages, values):
+    # stage names in an order where every input comes first
+    order, done = [], set(values)
+    while len(order) < len(stages):
+        ready = [name for name, stage in stages.items()
+                 if (name not in done) and all(i in done for i in stage.inputs)]
+        if len(ready) == 0:
+            missing = sorted(set(stages) - done)
+            raise ValueError("stages with missing or circular inputs: {}".format(missing))
+        order += ready
+        done.update(ready)
+    return order
+
+
+def critical_path(stages, seconds):
+    """The chain of stages with the longest total time, and that time."""
+    finish, previous = {}, {}
+    for name in _order(stages, set(i for s in stages.values() for i in s.inputs) - set(stages)):
+        deps = [i for i in stages[name].inputs if i in stages]
+        before = max(deps, key=lambda d: finish[d], default=None)
+        previous[name] = before
+        finish[name] = seconds[name] + (finish[before] if before is not None else 0)
+
+    name = max(finish, key=finish.get)
+    path = []
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return path[::-1], max(finish.values())
+
+
+def run_stages(stages, values, parallel=False, max_workers=None):
+    """
+    Runs the stages on the initial values ({name: value}).  Returns every
+    value, initial and computed, and a report of the run.
+    """
+    values = dict(values)
+    order = _order(stages, values)
+    seconds, started = {}, {}
+    start = time.perf_counter()
+
+    if not parallel:
+        for name in order:
+            stage = stages[name]
+            started[name] = time.perf_counter() - start
+            values[name] = stage.func(*[values[i] for i in stage.inputs], **stage.kwargs)
+            seconds[name] = time.perf_counter() - start - started[name]
+    else:
+        # every value is encoded once however many stages use it
+        encoded = {}
+
+        def arg(name):
+            if name not in encoded:
+                encoded[name] = encode(values[name])
+            return encoded[name]
+
+        pending = set(order)
+        running = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for name in [n for n in order if n in pending]:
+                    stage = stages[name]
+                    if all((i in values) or (i in encoded) for i in stage.inputs):
+                        started[name] = time.perf_counter() - start
+                        future = executor.submit(_run_stage, stage.func, stage.kwargs,
+                                                 [arg(i) for i in stage.inputs])
+                        running[future] = name
+                        pending.discard(name)
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    encoded[name], seconds[name] = future.result()
+
+        for name in order:
+            values[name] = decode(encoded[name])
+
+    path, path_seconds = critical_path(stages, seconds)
+    report = {"parallel": parallel,
+              "wall_seconds": time.perf_counter() - start,
+              "stages": [{"stage": name,
+                          "started": started[name],
+                          "seconds": seconds[name]} for name in order],
+              "critical_path": path,
+              "critical_path_seconds": path_seconds}
+    return values, report
+
+
+def print_report(report):
+    print("{:<20}{:>10}{:>10}".format("stage", "started", "seconds"))
+    for di in report["stages"]:
+        print("{:<20}{:>10.3f}{:>10.3f}".format(di["stage"], di["started"], di["seconds"]))
+    print("critical path: {} ({:.3f}s of {:.3f}s wall)".format(
+        " -> ".join(report["critical_path"]), report["critical_path_seconds"],
+        report["wall_seconds"]))
@@ -0,0 +1,161 @@
+"""
+Storage of the tables passed from scrape_cia to preprocess_upload_neo4j.
+
+Every table has an explicit schema.  Tables are always written as CSV to the
+output folder for humans and, when pyarrow is installed, as Parquet next to it.
+Reading prefers the Parquet file so types don't have to be inferred again and
+falls back to the CSV with the schema applied.
+"""
+import pandas as pd
+from pathlib2 import Path
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+# Column types.  "Int64" is pandas' nullable integer, years and ranks can be
+# missing.  "date" columns hold datetime.date values.
+AMOUNT_SCHEMA = {"link": "str",
+                 "country": "str",
+                 "amount": "float64",
+                 "note": "str",
+                 "year": "Int64",
+                 "retrieved": "date"}
+
+GOODS_SCHEMA = {"goods": "str",
+                "country": "str",
+                "link": "str",
+                "year": "Int64",
+                "rank": "Int64",
+                "trade_type": "str",
+                "retrieved": "date"}
+
+PARTNERS_SCHEMA = {"link": "str",
+                   "country": "str",
+                   "year": "Int64",
+                   "trade_country": "str",
+                   "percentage": "float64",
+                   "trade_type": "str",
+                   "retrieved": "date"}
+
+SCHEMAS = {"exports": AMOUNT_SCHEMA,
+           "imports": AMOUNT_SCHEMA,
+           "gdp": AMOUNT_SCHEMA,
+           "gdp_per_capita": AMOUNT_SCHEMA,
+           "real_gdp": AMOUNT_SCHEMA,
+           "real_gdp_per_capita": AMOUNT_SCHEMA,
+           "exports_goods": GOODS_SCHEMA,
+           "imports_goods": GOODS_SCHEMA,
+           "exports_partners": PARTNERS_SCHEMA,
+           "imports_partners": PARTNERS_SCHEMA,
+           "population": {"country": "str",
+                          "population": "Int64",
+                          "year": "Int64",
+                          "retrieved": "date"},
+           "country_region": {"regions": "str",
+                              "country": "str",
+                              "link": "str",
+                              "rank": "Int64",
+                              "retrieved": "date"},
+           "goods_grouping": {"goods": "str",
+                              "mapped_good": "str"}
+           }
+
+
+def apply_schema(df, schema):
+    df = df.copy()
+    for col, dtype in schema.items():
+        if col not in df.columns:
+            continue
+        if dtype == "date":
+            df[col] = pd.to_datetime(df[col]).dt.date
+        elif dtype == "str":
+            mask = df[col].notnull()
+            df[col] = df[col].astype(object)
+            df.loc[mask, col] = df.loc[mask, col].astype(str)
+        else:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(dtype)
+    return df
+
+
+def write_table(df, name, folder="output", parquet=True):
+    """
+    Writes folder/<name>.csv and, if pyarrow is available and parquet is set,
+    folder/<name>.parquet.
+    """
+    df = apply_schema(df, SCHEMAS.get(name, {}))
+    df.to_csv(Path(folder, name + ".csv"), index=False)
+    if parquet & (pyarrow is not None):
+        df.to_parquet(Path(folder, name + ".parquet"), index=False)
+    return df
+
+
+def read_table(name, folder="output"):
+    """
+    Reads a table written by write_table.  Uses the Parquet file when it is
+    there (and pyarrow is installed), otherwise the CSV.
+    """
+    schema = SCHEMAS.get(name, {})
+    f_parquet = Path(folder, name + ".parquet")
+    if f_parquet.exists() & (pyarrow is not None):
+        df = pd.read_parquet(f_parquet)
+    else:
+        # everything is read as text and converted by the schema afterwards
+        df = pd.read_csv(Path(folder, name + ".csv"), dtype=str)
+    return apply_schema(df, schema)
+
+
+def iter_table(name, folder="output", chunksize=10000):
+    """
+    Reads a table written by write_table in chunks of chunksize rows, each
+    with the schema applied, so large tables never have to be in memory at
+    once.
+    """
+    schema = SCHEMAS.get(name, {})
+    f_parquet = Path(folder, name + ".parquet")
+    if f_parquet.exists() & (pyarrow is not None):
+        from pyarrow import parquet
+        for batch in parquet.ParquetFile(f_parquet).iter_batches(batch_size=chunksize):
+            yield apply_schema(batch.to_pandas(), schema)
+    else:
+        for df in pd.read_csv(Path(folder, name + ".csv"), dtype=str, chunksize=chunksize):
+            yield apply_schema(df, schema)
+
+
+# ==============================================================================
+# Editions
+# Historical editions of the Factbook (see snapshot_cia) are stored in one
+# folder per edition, output/snapshots/edition=<edition>/<name>.csv, so an
+# edition can be written, replaced or read on its own.
+def edition_folder(edition, folder="output"):
+    return Path(folder, "snapshots", "edition={}".format(edition))
+
+
+def list_editions(folder="output"):
+    root = Path(folder, "snapshots")
+    if not root.exists():
+        return []
+    return sorted(p.name.split("=", 1)[1] for p in root.iterdir()
+                  if p.is_dir() and p.name.startswith("edition="))
+
+
+def read_editions(name, editions=None, folder="output"):
+    """
+    Reads table name of every edition (or of the given ones) that has it and
+    concatenates them with an edition column.
+    """
+    if editions is None:
+        editions = list_editions(folder)
+    frames = []
+    for edition in editions:
+        f_folder = edition_folder(edition, folder)
+        if not Path(f_folder, name + ".csv").exists():
+            continue
+        df = read_table(name, folder=f_folder)
+        df.insert(0, "edition", edition)
+        frames.append(df)
+    if len(frames) == 0:
+        return pd.DataFrame(columns=["edition"] + list(SCHEMAS.get(name, {})))
+    return pd.concat(frames, ignore_index=True)
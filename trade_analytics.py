@@ -0,0 +1,243 @@
+"""
+Precomputed analytics tables and a small cached query API over them.
+
+The routine questions (who are the largest partners of a country, how is its
+trade split over the regions, which goods categories does it depend on, the
+top countries by pageRank) are answered from tables written at the end of
+preprocess_upload_neo4j instead of Cypher against Neo4j:
+
+    output/analytics/top_partners      top k partners per country and direction
+    output/analytics/region_share      share of trade per partner region
+    output/analytics/goods_exposure    goods categories per country and direction
+    output/analytics/rankings          pageRank, articleRank and the largest
+                                       export and import partner per country
+
+They are written with table_store, so as Parquet when pyarrow is installed.
+
+    store = AnalyticsStore()
+    store.top_partners("Germany", "exports")
+    store.top_countries(50)
+"""
+import functools
+
+import pandas as pd
+from pathlib2 import Path
+
+import country_registry
+import table_store
+
+
+F_ANALYTICS = Path("output", "analytics")
+
+# the partner columns of df_trade for each direction
+DIRECTIONS = {"exports": ("exports", "imports", "percentage_exports"),
+              "imports": ("imports", "exports", "percentage_imports")}
+
+
+def _partner_rows(df_trade):
+    # one row per trade and direction, from the side of country
+    frames = []
+    for direction, (col, partner_col, share_col) in DIRECTIONS.items():
+        df = df_trade[[col, partner_col, "amount", share_col, "year"]].astype(
+            {col: object, partner_col: object})
+        df = df.rename(columns={col: "country", partner_col: "partner", share_col: "share"})
+        df.insert(1, "direction", direction)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _top_k(df, k):
+    df = df.sort_values(["direction", "country", "amount"], ascending=[True, True, False])
+    df["rank"] = df.groupby(["direction", "country"]).cumcount() + 1
+    return df.loc[df["rank"] <= k].reset_index(drop=True)
+
+
+def top_partners(df_trade, k=5):
+    """
+    The k largest partners of every country by trade amount, for exports
+    (partner imports from the country) and imports.  share is the part of
+    the country's total exports or imports.
+    """
+    return _top_k(_partner_rows(df_trade), k)
+
+
+def _region_amounts(df_trade, di_region):
+    # trade amount per country, direction and primary region of the partner
+    frames = []
+    for direction, (col, partner_col, _) in DIRECTIONS.items():
+        df = pd.DataFrame({"country": df_trade[col].astype(object),
+                           "direction": direction,
+                           "region": df_trade[partner_col].astype(object).map(di_region),
+                           "amount": df_trade["amount"]})
+        df["region"] = df["region"].fillna("unknown")
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _region_shares(df_amounts):
+    df = df_amounts.groupby(["direction", "country", "region"], as_index=False)["amount"].sum()
+    total = df.groupby(["direction", "country"])["amount"].transform("sum")
+    df["share"] = (df["amount"] / total).fillna(0)
+    return df[["country", "direction", "region", "amount", "share"]]
+
+
+def region_share(df_trade, df_country):
+    """
+    Share of every country's exports and imports by the primary region of
+    the partner.
+    """
+    di_region = dict(zip(df_country["country"], df_country["regions"]))
+    return _region_shares(_region_amounts(df_trade, di_region))
+
+
+def goods_exposure(df_exp_good, df_imp_good):
+    """
+    Per country and direction the goods categories it lists, how many of its
+    listed goods fall in them, their share of the list and the best (lowest)
+    rank a good of the category has.
+    """
+    frames = []
+    for direction, df in [("exports", df_exp_good), ("imports", df_imp_good)]:
+        df = df.loc[df["mapped_good"].notnull(), ["country", "mapped_good", "rank"]]
+        df = df.astype({"country": object})
+        df = df.groupby(["country", "mapped_good"], as_index=False).agg(
+            goods=("rank", "size"), best_rank=("rank", "min"))
+        df["share"] = df["goods"] / df.groupby("country")["goods"].transform("sum")
+        df.insert(1, "direction", direction)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def rankings(df_country, df_top_partners):
+    # the ranking outputs with the largest partner each way (the README table)
+    cols = ["country", "regions", "page_rank", "article_rank", "amount_exports",
+            "amount_imports", "amount_gdp", "population"]
+    df = df_country[[c for c in cols if c in df_country.columns]].copy()
+    df = df.sort_values("page_rank", ascending=False).reset_index(drop=True)
+    df["page_rank_position"] = df["page_rank"].rank(method="min", ascending=False).astype("Int64")
+    df["article_rank_position"] = df["article_rank"].rank(method="min", ascending=False).astype("Int64")
+
+    df_first = df_top_partners.loc[df_top_partners["rank"] == 1]
+    for direction in DIRECTIONS:
+        di = dict(df_first.loc[df_first["direction"] == direction, ["country", "partner"]].values)
+        df["top_{}_partner".format(direction)] = df["country"].map(di)
+    return df
+
+
+def build_tables(df_country, df_trade, df_exp_good, df_imp_good, k=5):
+    """
+    Returns {table name: DataFrame} of every analytics table.  df_trade can
+    also be an iterable of df_trade batches (TradeEdgeBuilder.batches), of
+    every batch only its top k partners and region sums are kept.
+    """
+    if isinstance(df_trade, pd.DataFrame):
+        df_trade = [df_trade]
+    di_region = dict(zip(df_country["country"], df_country["regions"]))
+    tops, regions = [], []
+    for df in df_trade:
+        tops.append(_top_k(_partner_rows(df), k))
+        regions.append(_region_shares(_region_amounts(df, di_region)))
+    # the top k of the top k of every batch
+    df_top = _top_k(pd.concat(tops, ignore_index=True), k)
+    return {"top_partners": df_top,
+            "region_share": _region_shares(pd.concat(regions, ignore_index=True)),
+            "goods_exposure": goods_exposure(df_exp_good, df_imp_good),
+            "rankings": rankings(df_country, df_top)}
+
+
+def write_tables(di_tables, folder=F_ANALYTICS):
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    for name, df in di_tables.items():
+        table_store.write_table(df, name, folder=folder)
+
+
+class AnalyticsStore:
+    """
+    Serves the analytics tables.  The tables are read once and split per
+    country, every query result is kept in an LRU cache of cache_size
+    entries.  Results are shared between calls and must not be modified.
+    Country names are resolved with the country registry first, so "UK" and
+    "United Kingdom" are the same query.
+    """
+
+    def __init__(self, folder=F_ANALYTICS, cache_size=1024,
+                 f_registry=country_registry.F_REGISTRY):
+        self.folder = folder
+        self.f_registry = f_registry
+        self._registry = None
+        self._groups = {}
+        self._empty = {}
+        self._k = None
+        self._rankings = None
+        # per instance so every store has its own cache
+        self._cached = {name: functools.lru_cache(maxsize=cache_size)(getattr(self, "_" + name))
+                        for name in ["top_partners", "region_share", "goods_exposure"]}
+        self.top_countries = functools.lru_cache(maxsize=cache_size)(self._top_countries)
+
+    def canonical(self, country):
+        # the Factbook name of country, unknown names stay
+        if self._registry is None:
+            self._registry = country_registry.read_registry(self.f_registry)
+        return self._registry.canonical(pd.Series([country])).iloc[0]
+
+    def _group(self, name, country, direction):
+        if name not in self._groups:
+            df = table_store.read_table(name, folder=self.folder)
+            self._groups[name] = {key: df_key.reset_index(drop=True)
+                                  for key, df_key in df.groupby(["country", "direction"])}
+            # countries without rows get the columns of the table and no rows
+            self._empty[name] = df.iloc[:0]
+            if name == "top_partners":
+                # the k the table was built with
+                self._k = int(df["rank"].max()) if len(df) > 0 else None
+        df = self._groups[name].get((country, direction))
+        return df if df is not None else self._empty[name]
+
+    def top_partners(self, country, direction="exports", k=5):
+        """
+        The k largest partners of country.  The table only holds the k of
+        build_tables (5), a larger k raises ValueError.
+        """
+        return self._cached["top_partners"](self.canonical(country), direction, k)
+
+    def region_share(self, country, direction="exports"):
+        return self._cached["region_share"](self.canonical(country), direction)
+
+    def goods_exposure(self, country, direction="exports"):
+        return self._cached["goods_exposure"](self.canonical(country), direction)
+
+    def _top_partners(self, country, direction="exports", k=5):
+        df = self._group("top_partners", country, direction)
+        if (self._k is not None) and (k > self._k):
+            raise ValueError("top_partners only holds the top {} partners of every country, "
+                             "build the tables with a larger k".format(self._k))
+        return df.head(k)
+
+    def _region_share(self, country, direction="exports"):
+        return self._group("region_share", country, direction).sort_values(
+            "share", ascending=False, ignore_index=True)
+
+    def _goods_exposure(self, country, direction="exports"):
+        return self._group("goods_exposure", country, direction).sort_values(
+            "share", ascending=False, ignore_index=True)
+
+    def _top_countries(self, n=50, by="page_rank"):
+        if self._rankings is None:
+            self._rankings = table_store.read_table("rankings", folder=self.folder)
+        return self._rankings.nlargest(n, by).reset_index(drop=True)
+
+    def cache_info(self):
+        di = {name: cached.cache_info() for name, cached in self._cached.items()}
+        di["top_countries"] = self.top_countries.cache_info()
+        return di
+
+    def clear_cache(self):
+        # call after the tables were rewritten
+        self._registry = None
+        self._groups = {}
+        self._empty = {}
+        self._k = None
+        self._rankings = None
+        for cached in self._cached.values():
+            cached.cache_clear()
+        self.top_countries.cache_clear()
@@ -0,0 +1,211 @@
+"""
+The trade graph in memory, for traversals without Neo4j.
+
+The same nodes and edges as the upload (country, region and good nodes,
+trades, contains, exports and imports edges) built straight from the
+preprocessed tables.  Nodes are numbered per label and every edge type is
+kept as CSR arrays in both directions with its properties as columns in edge
+order, so the edges of a node are one slice of each array.
+
+    g = TradeGraph.from_output()
+    g.neighbors("Germany", "trades")                       # who Germany exports to
+    g.k_hop("Germany", "trades", k=2)                      # and who they export to
+    g.neighbors("Germany", "trades", where={"year": lambda y: y >= 2020})
+
+    # countries importing aerospace goods that trade with a European exporter
+    importers = g.traverse("good", ["aerospace"], [("imports", "out")])
+    from_europe = g.traverse("region", ["Europe"], [("contains", "out"), ("trades", "out")])
+    sorted(importers & from_europe)
+
+Names of countries, regions and goods are the names of the nodes in Neo4j.
+Edges to names that aren't nodes are dropped, the same as the MATCH of the
+upload.
+"""
+import numpy as np
+import pandas as pd
+
+
+# edge type: (start label, end label, start column, end column, properties)
+RELATIONSHIPS = {
+    "trades": ("country", "country", "exports", "imports",
+               ["amount", "year", "percentage_exports", "percentage_imports",
+                "export_trade_rank", "import_trade_rank", "trade_type"]),
+    "contains": ("region", "country", "regions", "country", ["rank"]),
+    "exports": ("country", "good", "country", "mapped_good", ["goods", "rank", "year"]),
+    "imports": ("good", "country", "mapped_good", "country", ["goods", "rank", "year"]),
+}
+
+
+class Adjacency:
+    """
+    The edges of one type as CSR arrays.  Edge e goes from node start[e]
+    to node end[e], the edges of node i are indptr[i]:indptr[i + 1] of
+    indices and of every property column.  The reverse arrays hold the same
+    edges by end node, rev_edges maps them to the forward edge order.
+    """
+
+    def __init__(self, start, end, n_start, n_end, properties):
+        order = np.lexsort((end, start))
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(start, minlength=n_start))])
+        self.indices = end[order]
+        self.properties = {name: values[order] for name, values in properties.items()}
+
+        start = start[order]
+        self.rev_edges = np.lexsort((start, self.indices))
+        self.rev_indptr = np.concatenate([[0], np.cumsum(np.bincount(self.indices, minlength=n_end))])
+        self.rev_indices = start[self.rev_edges]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def edges(self, ids, direction="out"):
+        """(neighbor ids, edge ids) of node ids, a node id or an array of them."""
+        indptr = self.indptr if direction == "out" else self.rev_indptr
+        if np.ndim(ids) == 0:
+            positions = np.arange(indptr[ids], indptr[ids + 1])
+        else:
+            # the slices of all ids at once
+            starts = indptr[ids]
+            lengths = indptr[ids + 1] - starts
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            positions = offsets + np.arange(lengths.sum())
+        if direction == "out":
+            return self.indices[positions], positions
+        return self.rev_indices[positions], self.rev_edges[positions]
+
+    def mask(self, edge_ids, where):
+        """
+        Edges of edge_ids that pass where, {property: value or function of
+        the property array returning a boolean array}.
+        """
+        keep = np.ones(len(edge_ids), dtype=bool)
+        for name, condition in (where or {}).items():
+            values = self.properties[name][edge_ids]
+            keep &= condition(values) if callable(condition) else (values == condition)
+        return keep
+
+
+class TradeGraph:
+    def __init__(self, nodes, adjacency, node_properties):
+        # label -> array of names, the position is the node id
+        self.nodes = nodes
+        self.ids = {label: {name: i for i, name in enumerate(names)}
+                    for label, names in nodes.items()}
+        # edge type -> Adjacency
+        self.adjacency = adjacency
+        # label -> list of property dicts by node id
+        self.node_properties = node_properties
+
+    @classmethod
+    def from_tables(cls, df_country, df_trade, df_region, df_exp_good, df_imp_good,
+                    df_good=None):
+        """Builds the graph from the tables of preprocess_upload_neo4j.preprocess."""
+        goods = pd.concat([df["mapped_good"] for df in [df_exp_good, df_imp_good]
+                           + ([df_good] if df_good is not None else [])])
+        nodes = {"country": np.array(df_country["country"].astype(object).drop_duplicates(),
+                                     dtype=object),
+                 "region": np.array(df_region["regions"].dropna().unique(), dtype=object),
+                 "good": np.array(sorted(goods.dropna().unique()), dtype=object)}
+        ids = {label: pd.Series(np.arange(len(names)), index=names)
+               for label, names in nodes.items()}
+
+        tables = {"trades": df_trade, "contains": df_region,
+                  "exports": df_exp_good, "imports": df_imp_good}
+        adjacency = {}
+        for name, (start_label, end_label, start_col, end_col, properties) in RELATIONSHIPS.items():
+            df = tables[name]
+            start = df[start_col].astype(object).map(ids[start_label])
+            end = df[end_col].astype(object).map(ids[end_label])
+            mask = (start.notnull() & end.notnull()).to_numpy()
+            adjacency[name] = Adjacency(start[mask].to_numpy(dtype=np.int64),
+                                        end[mask].to_numpy(dtype=np.int64),
+                                        len(nodes[start_label]), len(nodes[end_label]),
+                                        {p: df[p].to_numpy()[mask] for p in properties})
+
+        df_country = df_country.drop_duplicates("country")
+        node_properties = {"country": df_country.astype({"country": object}).to_dict("records"),
+                           "region": [{"name": r} for r in nodes["region"]],
+                           "good": [{"name": g} for g in nodes["good"]]}
+        return cls(nodes, adjacency, node_properties)
+
+    @classmethod
+    def from_output(cls, folder="output"):
+        """Preprocesses the scraped tables in folder and builds the graph."""
+        import country_registry
+        import preprocess_upload_neo4j
+        di_tables = preprocess_upload_neo4j.preprocess(
+            preprocess_upload_neo4j.read_tables(folder), country_registry.CountryRegistry())
+        return cls.from_tables(**di_tables)
+
+    def _labels(self, edge_type, direction):
+        # (label walked from, label walked to)
+        start_label, end_label = RELATIONSHIPS[edge_type][:2]
+        return (start_label, end_label) if direction == "out" else (end_label, start_label)
+
+    def node(self, name, label="country"):
+        return self.node_properties[label][self.ids[label][name]]
+
+    def edges(self, name, edge_type="trades", direction="out", where=None):
+        """
+        The edges of a node as {"name": neighbor names, property: values}.
+        direction "out" follows the edges from start to end (trades: the
+        countries name exports to), "in" the other way.
+        """
+        from_label, to_label = self._labels(edge_type, direction)
+        adjacency = self.adjacency[edge_type]
+        neighbors, edge_ids = adjacency.edges(self.ids[from_label][name], direction)
+        keep = adjacency.mask(edge_ids, where)
+        di = {"name": self.nodes[to_label][neighbors[keep]]}
+        for prop, values in adjacency.properties.items():
+            di[prop] = values[edge_ids[keep]]
+        return di
+
+    def neighbors(self, name, edge_type="trades", direction="out", where=None):
+        """Names of the nodes one edge_type edge away, see edges."""
+        from_label, to_label = self._labels(edge_type, direction)
+        adjacency = self.adjacency[edge_type]
+        neighbors, edge_ids = adjacency.edges(self.ids[from_label][name], direction)
+        if where:
+            neighbors = neighbors[adjacency.mask(edge_ids, where)]
+        return list(self.nodes[to_label][np.unique(neighbors)])
+
+    def _step(self, ids, edge_type, direction, where=None):
+        # ids of the nodes one step away from any of ids
+        adjacency = self.adjacency[edge_type]
+        neighbors, edge_ids = adjacency.edges(np.asarray(ids, dtype=np.int64), direction)
+        if where:
+            neighbors = neighbors[adjacency.mask(edge_ids, where)]
+        return np.unique(neighbors)
+
+    def k_hop(self, name, edge_type="trades", k=2, direction="out", where=None):
+        """
+        {name: hops} of every node reached in 1 to k steps over edge_type
+        edges (start and end label the same, trades), the start node left out.
+        """
+        label, _ = self._labels(edge_type, direction)
+        start = self.ids[label][name]
+        hops = np.full(len(self.nodes[label]), -1)
+        hops[start] = 0
+        frontier = np.array([start])
+        for hop in range(1, k + 1):
+            frontier = self._step(frontier, edge_type, direction, where)
+            frontier = frontier[hops[frontier] < 0]
+            if len(frontier) == 0:
+                break
+            hops[frontier] = hop
+        reached = np.flatnonzero(hops > 0)
+        return dict(zip(self.nodes[label][reached], hops[reached].tolist()))
+
+    def traverse(self, label, names, steps):
+        """
+        Names of the nodes reached from the nodes names of label by following
+        steps, a list of (edge type, direction) or (edge type, direction,
+        where).  Returns a set.
+        """
+        ids = np.array([self.ids[label][n] for n in names], dtype=np.int64)
+        for step in steps:
+            edge_type, direction = step[:2]
+            where = step[2] if len(step) > 2 else None
+            from_label, label = self._labels(edge_type, direction)
+            ids = self._step(ids, edge_type, direction, where)
+        return set(self.nodes[label][ids])
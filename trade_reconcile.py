@@ -0,0 +1,127 @@
+"""
+Reconciles the two reports of every trade with the country totals.
+
+A trade can be reported twice, by the exporter in its exports partners and by
+the importer in its imports partners (mirror flows), and the two rarely agree.
+stage_trade keeps the larger one, so the partners of a country can add up to
+more than its exports or imports total.  Here instead:
+
+    - each side is a country x country matrix, exporters as rows and
+      importers as columns, indexed by the country ids of the registry
+    - a trade reported by both sides is weight * the exporter's amount +
+      (1 - weight) * the importer's, a trade reported by one side keeps it
+    - a rest of the world row and column hold the trade with partners that
+      aren't listed (the total minus the listed partners)
+    - the matrix is balanced with iterative proportional fitting (RAS) until
+      every row adds up to the exports total of its country and every column
+      to the imports total.  The rest of the world has no total of its own
+      and takes up the difference
+
+so the percentage_exports and percentage_imports of a country add up to at
+most 1.  ras works on stacks of matrices as well (editions x n x n).
+
+    amount = reconcile(df_exp_part, df_imp_part, df_country, weight=0.5)
+    amount[exports_id, imports_id]
+"""
+import numpy as np
+import pandas as pd
+
+
+def flow_matrix(df_part, n):
+    """
+    n x n matrix of the amounts of a partners table, exports_id as rows and
+    imports_id as columns, NaN where the trade isn't reported.  A trade listed
+    twice keeps the latest year and then the larger amount, as in stage_trade.
+    """
+    df = df_part.loc[df_part["exports_id"].notnull() & df_part["imports_id"].notnull()
+                     & df_part["amount"].notnull()]
+    df = df.sort_values(["year", "amount"], ascending=False).drop_duplicates(["exports_id", "imports_id"])
+    A = np.full((n, n), np.nan)
+    A[df["exports_id"].to_numpy(dtype=int), df["imports_id"].to_numpy(dtype=int)] = df["amount"].to_numpy(dtype=float)
+    return A
+
+
+def combine_mirror(X, M, weight=0.5):
+    """
+    One matrix of the exporter reports X and the importer reports M.  weight
+    is the share of the exporter's amount where both report a trade, a
+    number or an array that broadcasts to X (weight[:, None] per exporter).
+    Trades neither side reports are 0.
+    """
+    both = ~np.isnan(X) & ~np.isnan(M)
+    one = np.where(np.isnan(X), np.nan_to_num(M), X)
+    return np.where(both, weight * X + (1 - weight) * M, one)
+
+
+def with_rest_of_world(A, total_exports, total_imports):
+    """
+    A with an extra last column, the exports to partners that aren't listed,
+    and an extra last row, the imports from them.  Countries without a total
+    get 0.
+    """
+    n = A.shape[-1]
+    B = np.zeros(A.shape[:-2] + (n + 1, n + 1))
+    B[..., :n, :n] = A
+    B[..., :n, n] = np.clip(np.nan_to_num(total_exports) - A.sum(axis=-1), 0, None)
+    B[..., n, :n] = np.clip(np.nan_to_num(total_imports) - A.sum(axis=-2), 0, None)
+    return B
+
+
+def _factors(sums, totals):
+    # scale of every row (column), rows without a total or without trades stay
+    with np.errstate(divide="ignore", invalid="ignore"):
+        factors = totals / sums
+    return np.where((sums > 0) & np.isfinite(factors), factors, 1.0)
+
+
+def ras(A, row_totals, col_totals, max_iterations=100, tolerance=1e-6):
+    """
+    Scales the rows of A to row_totals and the columns to col_totals in turn
+    until every row is within tolerance (relative) of its total.  Rows and
+    columns with a NaN total are free.  A can be a stack (..., m, k) with
+    totals (..., m) and (..., k).  Returns (balanced A, iterations).
+    """
+    A = np.array(A, dtype=float)
+    row_totals = np.asarray(row_totals, dtype=float)
+    col_totals = np.asarray(col_totals, dtype=float)
+    fixed = ~np.isnan(row_totals) & (row_totals > 0)
+
+    for iteration in range(1, max_iterations + 1):
+        A *= _factors(A.sum(axis=-1), row_totals)[..., :, None]
+        A *= _factors(A.sum(axis=-2), col_totals)[..., None, :]
+        # the columns fit after their step, only the rows can be off
+        sums = A.sum(axis=-1)
+        off = np.abs(sums - row_totals)[fixed & (sums > 0)] / row_totals[fixed & (sums > 0)]
+        if (len(off) == 0) or (off.max() <= tolerance):
+            break
+    return A, iteration
+
+
+def country_totals(df_country, column, n):
+    # the totals of df_country by country id, NaN for the others
+    df = df_country.loc[df_country["country_id"].notnull()]
+    totals = np.full(n, np.nan)
+    totals[df["country_id"].to_numpy(dtype=int)] = df[column].to_numpy(dtype=float)
+    return totals
+
+
+def reconcile(df_exp_part, df_imp_part, df_country, weight=0.5, max_iterations=100,
+              tolerance=1e-6):
+    """
+    The reconciled amounts of the partner tables of stage_partners as a
+    matrix by [exports_id, imports_id], 0 where no side reports a trade.
+    """
+    ids = pd.concat([df[col] for df in [df_exp_part, df_imp_part] for col in ["exports_id", "imports_id"]]
+                    + [df_country["country_id"]]).dropna()
+    n = int(ids.max()) + 1 if len(ids) > 0 else 0
+
+    A = combine_mirror(flow_matrix(df_exp_part, n), flow_matrix(df_imp_part, n), weight=weight)
+    total_exports = country_totals(df_country, "amount_exports", n)
+    total_imports = country_totals(df_country, "amount_imports", n)
+
+    B = with_rest_of_world(A, total_exports, total_imports)
+    B, iterations = ras(B, np.append(total_exports, np.nan), np.append(total_imports, np.nan),
+                        max_iterations=max_iterations, tolerance=tolerance)
+    if iterations == max_iterations:
+        print("Trade reconciliation stopped after {} iterations".format(iterations))
+    return B[:n, :n]
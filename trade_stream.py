@@ -0,0 +1,251 @@
+"""
+Streaming construction of the trades edges.
+
+preprocess_upload_neo4j builds df_trade by concatenating both partner tables
+into one DataFrame.  TradeEdgeBuilder gives the same edges from chunks of the
+partner tables (table_store.iter_table) or straight from the cached field
+pages (partner_chunks).  It only keeps one compact entry per edge,
+country names are replaced by the integer ids of a CountryIndex, and hands the
+finished edges out in batches that go straight to the uploader.
+
+    builder = TradeEdgeBuilder(CountryIndex(df_latest, df_country))
+    for df in table_store.iter_table("exports_partners"):
+        builder.add(df)
+    ...
+    upload_trades(graph, builder)
+"""
+import datetime
+import time
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+from pathlib2 import Path
+
+import neo4j_upload
+import table_store
+
+
+# the columns and column order of df_trade in preprocess_upload_neo4j
+TRADE_COLS = ["link", "exports", "year", "imports", "trade_type", "retrieved",
+              "amount", "export_trade_rank", "import_trade_rank",
+              "percentage_exports", "percentage_imports"]
+
+
+class CountryIndex:
+    """
+    Integer ids for country names and, per id, the totals a trade edge needs:
+    the latest exports and imports amounts (for the edge amount) and the
+    amounts of the country table (for the percentages).  Partner names that
+    are not known get a new id and no totals.
+    """
+
+    def __init__(self, df_latest, df_country):
+        self.names = list(pd.concat([df_latest["country"], df_country["country"]])
+                          .dropna().drop_duplicates())
+        self.ids = {name: i for i, name in enumerate(self.names)}
+
+        def totals(df, col):
+            values = np.full(len(self.names), np.nan)
+            values[[self.ids[c] for c in df["country"]]] = df[col].astype(float)
+            return values
+
+        self.latest_exports = totals(df_latest, "amount_exports")
+        self.latest_imports = totals(df_latest, "amount_imports")
+        self.total_exports = totals(df_country, "amount_exports")
+        self.total_imports = totals(df_country, "amount_imports")
+
+    def encode(self, names):
+        ids = np.empty(len(names), dtype=np.int64)
+        for i, name in enumerate(names):
+            if name not in self.ids:
+                self.ids[name] = len(self.names)
+                self.names.append(name)
+            ids[i] = self.ids[name]
+        return ids
+
+    def lookup(self, values, ids):
+        # ids added by encode have no totals
+        out = np.full(len(ids), np.nan)
+        known = ids < len(values)
+        out[known] = values[ids[known]]
+        return out
+
+
+class TradeEdgeBuilder:
+    """
+    Keeps the preferred partner row for every (exports, imports) pair, the
+    same choice as the sort and drop_duplicates in preprocess: the latest
+    year, then the highest amount, then exports before imports, then the
+    first row added.  Chunks of exports partners should be added before the
+    imports partners for the last rule to match.  With a country registry the
+    names are resolved through it and the edges get exports_id and imports_id.
+    """
+
+    def __init__(self, index, registry=None):
+        self.index = index
+        self.registry = registry
+        # (exports id, imports id) -> (sort key, link, year, trade_type, retrieved, amount)
+        self._edges = {}
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._edges)
+
+    def add(self, df_part):
+        """Adds a chunk of a partners table, exports or imports."""
+        df_part = df_part[df_part["country"].notnull() & df_part["trade_country"].notnull()]
+        if len(df_part) == 0:
+            return
+        if self.registry is not None:
+            df_part = df_part.assign(country=self.registry.canonical(df_part["country"]),
+                                     trade_country=self.registry.canonical(df_part["trade_country"]))
+
+        ids_country = self.index.encode(df_part["country"].tolist())
+        ids_partner = self.index.encode(df_part["trade_country"].tolist())
+        is_exports = (df_part["trade_type"] == "exports").to_numpy()
+
+        # the amount is a share of the reporting country's latest total
+        total = np.where(is_exports,
+                         self.index.lookup(self.index.latest_exports, ids_country),
+                         self.index.lookup(self.index.latest_imports, ids_country))
+        amount = total * df_part["percentage"].to_numpy(dtype=float, na_value=np.nan)
+        ids_exports = np.where(is_exports, ids_country, ids_partner)
+        ids_imports = np.where(is_exports, ids_partner, ids_country)
+        year = df_part["year"].to_numpy(dtype=float, na_value=np.nan)
+
+        for e, i, y, a, link, trade_type, retrieved in zip(
+                ids_exports.tolist(), ids_imports.tolist(), year.tolist(),
+                amount.tolist(), df_part["link"], df_part["trade_type"],
+                df_part["retrieved"]):
+            # smaller is preferred, missing years and amounts go last
+            key = (y != y, 0 if y != y else -y,
+                   a != a, 0 if a != a else -a,
+                   trade_type, self._seq)
+            self._seq += 1
+            current = self._edges.get((e, i))
+            if (current is None) or (key < current[0]):
+                self._edges[(e, i)] = (key, link, y, trade_type, retrieved, a)
+
+    def _finish(self):
+        # edge order and ranks, computed on integer ids and floats only
+        pairs = sorted(self._edges, key=lambda pair: self._edges[pair][0])
+        df = pd.DataFrame(pairs, columns=["exports", "imports"])
+        df["amount"] = [self._edges[pair][5] for pair in pairs]
+        df["amount"] = df["amount"].fillna(0)
+        df["export_trade_rank"] = df.groupby("exports")["amount"].rank("min", ascending=False)
+        df["import_trade_rank"] = df.groupby("imports")["amount"].rank("min", ascending=False)
+        return pairs, df
+
+    def batches(self, batch_size=10000):
+        """Yields the finished edges as df_trade chunks of batch_size rows."""
+        pairs, df_ids = self._finish()
+        names = np.array(self.index.names, dtype=object)
+        for start in range(0, len(pairs), batch_size):
+            df_ids_batch = df_ids.iloc[start:start + batch_size]
+            values = [self._edges[pair] for pair in pairs[start:start + batch_size]]
+            exports = df_ids_batch["exports"].to_numpy()
+            imports = df_ids_batch["imports"].to_numpy()
+            amount = df_ids_batch["amount"].to_numpy()
+
+            df = pd.DataFrame({"link": [v[1] for v in values],
+                               "exports": names[exports],
+                               "year": [v[2] for v in values],
+                               "imports": names[imports],
+                               "trade_type": [v[3] for v in values],
+                               "retrieved": [v[4] for v in values],
+                               "amount": amount,
+                               "export_trade_rank": df_ids_batch["export_trade_rank"].to_numpy(),
+                               "import_trade_rank": df_ids_batch["import_trade_rank"].to_numpy()})
+            df["year"] = df["year"].astype("Int64").fillna(1970)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                df["percentage_exports"] = amount / self.index.lookup(self.index.total_exports, exports)
+                df["percentage_imports"] = amount / self.index.lookup(self.index.total_imports, imports)
+            df["percentage_exports"] = df["percentage_exports"].fillna(0)
+            df["percentage_imports"] = df["percentage_imports"].fillna(0)
+            df.index = range(start, start + len(df))
+            if self.registry is None:
+                yield df[TRADE_COLS]
+            else:
+                df["exports_id"] = self.registry.resolve(df["exports"])
+                df["imports_id"] = self.registry.resolve(df["imports"])
+                yield df[TRADE_COLS + ["exports_id", "imports_id"]]
+
+    def frame(self):
+        # every edge at once, for the code that needs all of df_trade
+        return pd.concat(list(self.batches()), sort=False)
+
+    def edges(self):
+        # exports and imports only, enough for local_rank
+        pairs = list(self._edges)
+        names = np.array(self.index.names, dtype=object)
+        return pd.DataFrame({"exports": names[[e for e, _ in pairs]],
+                             "imports": names[[i for _, i in pairs]]})
+
+    def to_csv(self, f_out, batch_size=10000):
+        n_rows = 0
+        for df in self.batches(batch_size):
+            df.to_csv(f_out, mode="w" if n_rows == 0 else "a", header=n_rows == 0, index=False)
+            n_rows += len(df)
+        return n_rows
+
+
+def page_chunks(content, trade_type, skip_links, country_fixes, chunksize=10000,
+                retrieved=None):
+    """
+    Yields partners table chunks straight from a partners field page, for
+    TradeEdgeBuilder.add, without building the whole table.  The chunks have
+    the types of the partners table, the same as table_store.iter_table.
+    """
+    # the scraping stack is only needed when reading pages
+    import scrape_cia
+    records = scrape_cia.partner_records(content, skip_links)
+    while True:
+        chunk = list(islice(records, chunksize))
+        if len(chunk) == 0:
+            return
+        df = scrape_cia.partner_frame(chunk, trade_type, country_fixes, retrieved=retrieved)
+        yield table_store.apply_schema(df, table_store.SCHEMAS["exports_partners"])
+
+
+def partner_chunks(name, folder="output", cache=None, chunksize=10000):
+    """
+    Chunks of the partners table name ("exports_partners" or
+    "imports_partners") for TradeEdgeBuilder.add.  With a cache
+    (fetch_cia.ResponseCache) that has the field page scrape_cia fetched the
+    chunks are parsed straight from it, otherwise they are read from the
+    table in folder.
+    """
+    if cache is not None:
+        import scrape_cia
+        for _, url, parser, kwargs in scrape_cia.JOBS:
+            if (parser is not scrape_cia.partners) or (Path(kwargs["f_name"]).stem != name):
+                continue
+            content = cache.get(url)
+            if content is not None:
+                # the day the page was fetched, as scrape_cia would have written
+                retrieved = datetime.datetime.fromtimestamp(cache.index[url]["fetched"])
+                return page_chunks(content, kwargs["trade_type"], scrape_cia.SKIP_LINKS,
+                                   scrape_cia.COUNTRY_FIXES, chunksize=chunksize,
+                                   retrieved=retrieved)
+        print("No cached page of {}, reading the table".format(name))
+    return table_store.iter_table(name, folder=folder, chunksize=chunksize)
+
+
+def upload_trades(graph, builder, batch_size=1000):
+    """
+    Uploads the edges of the builder as TRADES edges, one batch at a time.
+    Returns the report entry in the format of neo4j_upload.upload_all.
+    """
+    print("Uploading TRADES edges to Neo4j")
+    start = time.perf_counter()
+    n_rows, n_batches = 0, 0
+    for df in builder.batches(batch_size):
+        rows = neo4j_upload.add_content_hashes(neo4j_upload.trade_rows(df))
+        n_batches += neo4j_upload.upload_batches(graph, neo4j_upload.CQL_TRADES, rows,
+                                                 batch_size=batch_size)
+        n_rows += len(rows)
+    return {"stage": "TRADES edges",
+            "rows": n_rows,
+            "batches": n_batches,
+            "seconds": time.perf_counter() - start}